@@ -33,6 +33,12 @@ if  __name__ == "__main__":
     parser.add_argument('--ncore',  type=int, default=None,
                         help='Number of cores to use for multiprocessing. ncore=1 means no multiprocessing.')
 
+    parser.add_argument('--nprocess',  type=int, default=1,
+                        help='Number of frames built concurrently by --build (process pool). 1 means frame after frame.')
+
+    parser.add_argument('--maxinflight',  type=int, default=None,
+                        help='Maximum number of frames in memory at once with --nprocess (default: nprocess).')
+
     # --------------- #
     #  Cube Building  #
     # --------------- #
@@ -66,11 +72,18 @@ if  __name__ == "__main__":
     
     parser.add_argument('--tracematchnomasks', action="store_true", default=False,
                         help='build te tracematch solution for the given night without saved the masks')
+
+    parser.add_argument('--tracemaskcache', action="store_true", default=False,
+                        help='build the trace masks for a grid of j-shifts (used for the trace flexure correction when building cubes)')
     
     # - Hexagonal Grid
     parser.add_argument('--hexagrid', action="store_true", default=False,
                         help='build the hexagonal grid (index<->qr<->xy) for the given night')
 
+    # - Calibration Bundle
+    parser.add_argument('--calibbundle', action="store_true", default=False,
+                        help='store the night calibrations (tracematch, masks, wavelength solution, hexagrid) as a memory-mappable bundle, used instead of the pkl files once built.')
+    
     # - Wavelength Solution
     parser.add_argument('--wavesol', action="store_true", default=False,
                         help='build the wavelength solution for the given night.')
@@ -108,6 +121,16 @@ if  __name__ == "__main__":
     parser.add_argument('--nofig',    action="store_true", default=False,
                         help='')
 
+    parser.add_argument('--timing',    action="store_true", default=False,
+                        help='record the wall/cpu time and memory of the pipeline stages.\n'+
+                             'Per-cube values are stored in the cube headers (PT* keywords) and\n'+
+                             'the night report is saved as {date}_Timing.json/.csv in the night directory.')
+
+    parser.add_argument('--timinghook',  type=str, default=None,
+                        help='[implies --timing] coma separated stage:hook, hook being cprofile, tracemalloc\n'+
+                             'or module.function (called with the stage record). e.g.\n'+
+                             '--timinghook extract_cube:cprofile,background:tracemalloc')
+
     args = parser.parse_args()
 
     # Matplotlib
@@ -120,13 +143,23 @@ if  __name__ == "__main__":
     # --------- #
     date = args.infile
 
+    # --------- #
+    #  Timing   #
+    # --------- #
+    from pysedm.utils import timing
+    if args.timing or args.timinghook is not None:
+        timing.enable(hooks=None if args.timinghook is None else
+                          timing.parse_hooks(args.timinghook, savedir=io.get_datapath(date)))
+
     # ------------ #
     # Short Cuts   #
     # ------------ #
     if args.allcalibs:
         args.tracematch = True
+        args.tracemaskcache = True
         args.hexagrid   = True
         args.wavesol    = True
+        args.calibbundle = True
         args.build      = "dome"
         args.flat       = True
 
@@ -146,66 +179,80 @@ if  __name__ == "__main__":
         
     if args.build is not None and len(args.build) >0:
         for target in args.build.split(","):
-            build_night_cubes(date, target=target,
-                             lamps=True, only_lamps=False, skip_calib=True,
-                             fileindex=fileindex,
-                             nobackground=bool(args.nobackground),
-                             # - options
-                             build_guider = False if args.noguider else True,
-                             solve_wcs = args.solvewcs,
-                             savefig = False if args.nofig else True,
-                             flexure_corrected = False if args.noflexure else True,
-                             traceflexure_corrected = False if args.notraceflexure else True,
-                             ncore=args.ncore)
+            with timing.stage("build_cubes"):
+                build_night_cubes(date, target=target,
+                                 lamps=True, only_lamps=False, skip_calib=True,
+                                 fileindex=fileindex,
+                                 nobackground=bool(args.nobackground),
+                                 # - options
+                                 build_guider = False if args.noguider else True,
+                                 solve_wcs = args.solvewcs,
+                                 savefig = False if args.nofig else True,
+                                 flexure_corrected = False if args.noflexure else True,
+                                 traceflexure_corrected = False if args.notraceflexure else True,
+                                 ncore=args.ncore, nprocess=args.nprocess,
+                                 maxinflight=args.maxinflight)
             
     if args.buildcal is not None:
         if args.buildcal=="*": args.buildcal=args.build
         if len(args.buildcal) >0:
             for target in args.buildcal.split(","):
-                calibrate_night_cubes(date, target=target, 
-                                    lamps=True, only_lamps=False, skip_calib=True)
+                with timing.stage("calibrate_cubes"):
+                    calibrate_night_cubes(date, target=target, 
+                                        lamps=True, only_lamps=False, skip_calib=True)
                     
             
     # - Background
     if args.buildbkgd is not None and len(args.buildbkgd) > 0:
         for target in args.buildbkgd.split(","):
-            build_backgrounds(date, target=target,
-                                  show_progress=True,
-                                  multiprocess=False, # Force no multiprocessing here
-                                  lamps=True, only_lamps=True, skip_calib=True, 
-                                  ncore=args.ncore)
+            with timing.stage("build_backgrounds"):
+                build_backgrounds(date, target=target,
+                                      show_progress=True,
+                                      multiprocess=False, # Force no multiprocessing here
+                                      lamps=True, only_lamps=True, skip_calib=True, 
+                                      ncore=args.ncore)
             
     # -----------
     # 
     # ----------- 
     # - TraceMatch
-    if args.tracematch or args.tracematchnomasks:
-        build_tracematcher(date, save_masks= True if not args.tracematchnomasks else False,
-                           rebuild=args.rebuild, ncore=args.ncore)
+    if args.tracematch or args.tracematchnomasks or args.tracemaskcache:
+        with timing.stage("build_tracematcher"):
+            build_tracematcher(date, save_masks= True if (args.tracematch and not args.tracematchnomasks) else False,
+                               save_maskcache=args.tracemaskcache,
+                               rebuild=args.rebuild, ncore=args.ncore)
         
     # - Hexagonal Grid        
     if args.hexagrid:
-        build_hexagonalgrid(date)
+        with timing.stage("build_hexagonalgrid"):
+            build_hexagonalgrid(date)
         
     # - Wavelength Solution
     if args.wavesol:
         ntest = None if "None" in args.wavesoltest else int(args.wavesoltest)
         spaxelrange = None if "None" in args.spaxelrange else np.asarray(args.spaxelrange.split(","), dtype="int")
 
-        build_wavesolution(date, ntest=ntest, use_fine_tuned_traces=False,
-                            idxrange=spaxelrange,
-                            lamps=["Hg","Cd","Xe"], saveindividuals=args.wavesolplots,
-                            savefig = False if args.nofig else True,
-                            rebuild=args.rebuild)
+        with timing.stage("build_wavesolution"):
+            build_wavesolution(date, ntest=ntest, use_fine_tuned_traces=False,
+                                idxrange=spaxelrange,
+                                lamps=["Hg","Cd","Xe"], saveindividuals=args.wavesolplots,
+                                savefig = False if args.nofig else True,
+                                rebuild=args.rebuild, ncore=args.ncore)
 
+    # - Calibration Bundle
+    if args.calibbundle:
+        with timing.stage("build_calibration_bundle"):
+            build_calibration_bundle(date)
+        
     # - Flat Fielding
     if args.flat:
         lbda_min,lbda_max = np.asarray(args.flatlbda.split(","), dtype="float")
-        build_flatfield(date,
-                        lbda_min=lbda_min,
-                        lbda_max=lbda_max,
-                        ref=args.flatref, build_ref=True,
-                        savefig=~args.nofig, ncore=args.ncore)
+        with timing.stage("build_flatfield"):
+            build_flatfield(date,
+                            lbda_min=lbda_min,
+                            lbda_max=lbda_max,
+                            ref=args.flatref, build_ref=True,
+                            savefig=~args.nofig, ncore=args.ncore)
         # Now calc stats
         from pysedm import ccd
         from pysedm.io import get_datapath
@@ -226,3 +273,6 @@ if  __name__ == "__main__":
         stat_f.close()
         print("nspax, min, avg, med, max Wid: %d, %.3f, %.3f, %.3f, %.3f" %
               (len(b), min(b), np.nanmean(b), np.nanmedian(b), max(b)))
+
+    # - Timing report (no-op if the timing is not enabled)
+    timing.write_report(io.get_datapath(date)+"%s_Timing"%date)
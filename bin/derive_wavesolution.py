@@ -1,15 +1,12 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import tempfile
-
 #################################
 #
 #   MAIN 
 #
 #################################
 if  __name__ == "__main__":
-    import subprocess
     import argparse
     import pysedm
     import numpy as np
@@ -17,7 +14,7 @@ if  __name__ == "__main__":
     #   Options         #
     # ================= #
     parser = argparse.ArgumentParser(
-        description="""tool to subprocess wavelength solution build.
+        description="""tool to build the wavelength solution using multiprocessing.
             """, formatter_class=argparse.RawTextHelpFormatter)
 
     parser.add_argument('infile', type=str, default=None,
@@ -27,10 +24,10 @@ if  __name__ == "__main__":
     #  Wavesoltuion   #
     # --------------- #
     parser.add_argument('--nsub',  type=str, default=2,
-                        help='Number of subprocess to launch. [default 2]')
+                        help='Number of processes fitting the traces. [default 2]')
     
     parser.add_argument('--merge',  action="store_true", default=False,
-                        help='Set this keyword to perform the Wavesolution merging. The rest will be ignored.')
+                        help='Set this keyword to merge WaveSolution_range pickles (built with --spaxelrange). The rest will be ignored.')
     # --------------- #
     #  Subprocessing  #
     # --------------- #
@@ -74,41 +71,17 @@ if  __name__ == "__main__":
         import sys
         sys.exit(0)
 
-    nsplit = int(args.nsub)
-    
-    # - TraceMatch Indexes
-    tmap = pysedm.load_nightly_tracematch(date, withmask=False)
-    idxall = tmap.get_traces_within_polygon( pysedm.sedm.INDEX_CCD_CONTOURS)
-    
-    # Split it in equal parts:
-    k, m      = divmod( np.nanmax(idxall)+10, nsplit)
-    idxbounds = [[i * k + min(i, m),(i + 1) * k + min(i + 1, m)] for i in range(nsplit)]
-    
-    
-    options = []
-    if args.nofig:
-        options += ["--nofig"]
-    if args.wavesolplots:
-        options += ["--wavesolplots"]
-    if args.spaxelrange not in ['None']:
-        print(args.spaxelrange)
-        options += ["--spaxelrange","%s,%s"%(args.spaxelrange[0],args.spaxelrange[1])]
-    if args.rebuild:
-        print(args.rebuild)
-        options += ["--rebuild"]
-
-   
-    processes = []     
-    for i,bounds in enumerate(idxbounds):          
-        command = ["ccd_to_cube.py", date, "--wavesol","--spaxelrange","%s,%s"%(bounds[0],bounds[1])] + options
-        print("launching command: "+" ".join(command))
-        fd, path = tempfile.mkstemp()
-        f = open(path, "w")
-        p = subprocess.Popen(command, stdout=f)
-        processes.append((p,f))
+    # - In-process multiprocessing: the lamps are loaded once and shared with
+    #   the workers. No subprocess and no merging needed.
+    from pysedm.script.ccd_to_cube import build_wavesolution
+    spaxelrange = None if "None" in args.spaxelrange else np.asarray(args.spaxelrange.split(","), dtype="int")
+    build_wavesolution(date, ncore=int(args.nsub), idxrange=spaxelrange,
+                       use_fine_tuned_traces=False,
+                       lamps=["Hg","Cd","Xe"], saveindividuals=args.wavesolplots,
+                       savefig = False if args.nofig else True,
+                       rebuild=args.rebuild)
 
-    for (p, f) in processes:
-        p.wait()
-        f.seek(0)
-        # TODO log f here
-        f.close()
+    if spaxelrange is None:
+        wsol = pysedm.load_nightly_wavesolution(date)
+        wsol.calc_dispersion_stats(savefile=pysedm.io.get_datapath(date) +
+                                   "%s_wavesolution_stats.txt" % date)
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time the pipeline stages on a synthetic (or existing) night and save a json report.
+-v20261018: 1st version.
+"""
+
+#################################
+#
+#   MAIN
+#
+#################################
+if  __name__ == "__main__":
+
+    import argparse
+    import tempfile
+
+    # ================= #
+    #   Options         #
+    # ================= #
+    parser = argparse.ArgumentParser(
+        description=""" Benchmark the pysedm pipeline stages on a synthetic night.
+        The night is built in the given redux directory if it does not exist yet.
+        """,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('rootdir', type=str, nargs="?", default=None,
+                        help='redux directory where the night is (or is built). Default: a temporary directory')
+
+    parser.add_argument('--date', type=str, default=None,
+                        help='night to use (YYYYMMDD). Default: the synthetic night date')
+
+    parser.add_argument('--stages', type=str, default=None,
+                        help='coma separated list of the stages to run. Default: all. Available: \n'+
+                             'build_tracematcher,load_trace_masks,build_hexagonalgrid,build_wavesolution,\n'+
+                             'build_backgrounds,extract_cube,flexure,byecr,extractstar')
+
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of time each stage is timed')
+
+    parser.add_argument('--ncore', type=int, default=1,
+                        help='number of processes for the stages that accept it')
+
+    parser.add_argument('--spacing', type=float, default=None,
+                        help='[synthetic night] distance (ccd pixels) between spaxels. Larger means less traces (faster)\n'+
+                             'but the flexure stage needs >800 spaxels (default spacing: ~880 spaxels)')
+
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='[synthetic night] random seed')
+
+    parser.add_argument('--tracemalloc', action="store_true", default=False,
+                        help='measure the memory peak of each stage with tracemalloc (slower)')
+
+    parser.add_argument('--nobuild', action="store_true", default=False,
+                        help='do not build the synthetic night (use an existing night)')
+
+    parser.add_argument('--output', type=str, default="pysedm_bench.json",
+                        help='json report filename')
+
+    args = parser.parse_args()
+
+    # ================= #
+    #   The Scripts     #
+    # ================= #
+    from pysedm.bench import run_benchmarks, synthetic
+
+    rootdir = args.rootdir if args.rootdir is not None else tempfile.mkdtemp(prefix="pysedm_bench_")
+    night_prop = {"seed": args.seed}
+    if args.spacing is not None:
+        night_prop["spacing"] = args.spacing
+
+    report = run_benchmarks(rootdir, date=args.date if args.date is not None else synthetic.BENCH_DATE,
+                            stages=args.stages.split(",") if args.stages is not None else None,
+                            repeat=args.repeat, ncore=args.ncore, savefile=args.output,
+                            trace_memory=args.tracemalloc, build_night=not args.nobuild,
+                            **night_prop)
+    print("report saved in %s"%args.output)
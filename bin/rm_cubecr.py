@@ -80,8 +80,8 @@ if  __name__ == "__main__":
                 cube = get_sedmcube(filecube)
 
                 print(" Starting byecr cosmic ray removal ".center(50, "-"))
-                targetid = io.filename_to_id(filecube)
-                byecrclass = byecr.get_cr_spaxels_from_byecr(date, targetid)
+                # the cube is already loaded, no need to fetch it again from its id.
+                byecrclass = byecr.SEDM_BYECR(date if not args.inputcube else cube.get_night(), cube)
                 cr_df = byecrclass.get_cr_spaxel_info(lbda_index=args.byecr_lbda,
                                               cut_criteria=args.byecr_cut,
                                               wspectral=args.byecr_wspectral)
@@ -141,7 +141,8 @@ def build_wcs(radec, spxy, rotation=2, scale=0.55):
 
 def fit_cube_pos(filename, lbdarange=[6000, 8000], guess="guess", show=False, **kwargs):
     """ """
-    sl = spectroscopy.Slice.from_cubefile(filename)
+    sl = sedm.get_sedmcube(filename, lazy=True).get_slice(lbda_min=lbdarange[0], lbda_max=lbdarange[1],
+                                                          slice_object=True)
     if guess in ["brightest"]:
         centroid = np.nanmean(np.asarray(
             sl.index_to_xy(sl.get_brightest_spaxels(5))), axis=0)
@@ -513,8 +514,9 @@ class Astrometry():
 
     def load_slice(self, lbdarange=[5000, 6000]):
         """ """
-        self.slice = spectroscopy.Slice.from_cubefile(
-            self.filename, lbdarange=lbdarange)
+        # - lazy: only the rows of the wavelength range are read.
+        self.slice = sedm.get_sedmcube(self.filename, lazy=True).get_slice(
+            lbda_min=lbdarange[0], lbda_max=lbdarange[1], slice_object=True)
 
     def load_guider(self, load_gaiacat=True):
         """ """
@@ -28,12 +28,12 @@ LEGENDRE_GAUSS= False
 def build_background(ccd,
                     smoothing=[0,5],
                     start=2, jump=10, multiprocess=True, 
-                    savefile=None, ncore=None):
+                    savefile=None, ncore=None, show_progress=False):
     """ """
     from .io import is_stdstars, filename_to_background_name
     ccd.fit_background(start=start, jump=jump, multiprocess=multiprocess, 
                        set_it=False, is_std= is_stdstars(ccd.header), smoothing=smoothing,
-                       ncore=ncore)
+                       ncore=ncore, show_progress=show_progress)
     
     ccd._background.writeto( filename_to_background_name(ccd.filename).replace('.gz','') )
     if savefile is not None:
@@ -72,17 +72,21 @@ def get_contvalue_sdt(spec):
 
 def fit_background(ccd, start=2, jump=10, multiprocess=True,
                        ncore=None, is_std=False, show_progress=False):
-    """ calling `get_contvalue` for each ccd column (xslice).
-    This uses astropy's ProgressBar.map 
+    """ Fit the continuum of every `jump` ccd column (starting at `start`).
 
-    Returns 
+    - normal case: all the columns are fitted at once by the
+      vectorized engine (see fit_columns_continuum()). No multiprocessing needed.
+    - is_std: a gaussian + polynomial continuum is fitted on each ccd column (xslice)
+      calling `get_contvalue_sdt` (within a multiprocessing Pool if multiprocess)
+
+    Returns
     -------
-    dictionary 
+    dictionary
     """
-    # Running from ipython notebook
-    
-    
     index_column = range(ccd.width)[start::jump]
+    if not is_std:
+        return fit_columns_continuum(ccd, index_column)
+
     if show_progress:
         notebook = tools.is_running_from_notebook()
         bar = ProgressBar( len(index_column), ipython_widget=notebook)
@@ -120,7 +124,101 @@ def fit_background(ccd, start=2, jump=10, multiprocess=True,
         return res
     
     # - No multiprocessing 
-    return {index_column[i_]: get_contvalue(ccd.get_xslice(spec_)) if not is_std else get_contvalue_sdt(ccd.get_xslice(spec_)) for i_,spec_ in enumerate(bar)}
+    return {i_: get_contvalue(ccd.get_xslice(i_)) if not is_std else get_contvalue_sdt(ccd.get_xslice(i_)) for i_ in index_column}
+
+def fit_columns_continuum(ccd, columns, degree=DEGREE, clipping=[2,2], niter=3):
+    """ Fit, at once, the Legendre polynomial continuum of the pixels outside the traces
+    of the given ccd columns.
+
+    This solves the weighted (1/variance) linear least-squares problem of all the columns
+    simultaneously (batched normal equations). Pixels are sigma-clipped
+    (median+/-clipping*nMAD) as in CCDSlice.fit_continuum(). The clipping is then iterated
+    `niter`-1 times on the residuals to the current continuum model.
+
+    The Legendre polynomials are defined for the ccd-row y within [0, SEDM_CCD_SIZE[1]]
+    scaled to [-1,1], i.e. as evaluated by Background.contvalue_to_polynome().
+
+    Parameters
+    ----------
+    ccd: [CCD]
+        ccd (with a tracematch) whose background should be fitted.
+
+    columns: [list of int]
+        ccd columns to be fitted.
+
+    degree: [int] -optional-
+        number of Legendre polynomials (modefit convention; DEGREE=5 means a0...a4)
+
+    clipping: [float, float] -optional-
+        lower and upper clipping in unit of nMAD.
+
+    niter: [int] -optional-
+        number of fit+clipping iterations (niter=1 means no re-clipping after the fit)
+
+    Returns
+    -------
+    dictionary ({column: {"a0":, "a0.err":, ..., "chi2":}}, the contvalues of Background)
+    """
+    from astropy.stats import mad_std
+    from numpy.polynomial import legendre
+
+    columns = np.asarray(columns)
+    if not ccd.has_var():
+        warnings.warn("Setting the default variance for 'fit_columns_continuum' ")
+        ccd.set_default_variance()
+
+    data  = np.asarray(ccd.data.T[columns], dtype="float")
+    error = np.sqrt(np.abs(np.asarray(ccd.var.T[columns], dtype="float")))
+    ncolumns, height = data.shape
+
+    # - pixels outside the traces
+    intrace = np.zeros((ncolumns, height+1), dtype="int")
+    colpos, _, ybounds = ccd.tracematch.get_traces_crossing_columns(columns)
+    # b0 < y < b1 pixels are within the trace
+    first = np.clip(np.floor(ybounds[:,0]).astype("int")+1, 0, height)
+    last  = np.clip(np.ceil(ybounds[:,1]).astype("int"), 0, height)
+    flagok = first<last
+    np.add.at(intrace, (colpos[flagok], first[flagok]),  1)
+    np.add.at(intrace, (colpos[flagok], last[flagok]),  -1)
+
+    isvalid = (np.cumsum(intrace, axis=1)[:,:-1] == 0) & np.isfinite(data) & (error>0)
+    data_   = np.where(isvalid, data, np.NaN)
+
+    # - Legendre design matrix
+    design = legendre.legvander(np.arange(height)/SEDM_CCD_SIZE[1]*2-1., degree-1) # (height, degree)
+
+    model  = np.nanmedian(data_, axis=1)[:,None]*np.ones(height) # first clipping around the median
+    for i in range(niter):
+        res   = data_ - model
+        nmad  = mad_std(res, axis=1, ignore_nan=True)[:,None]
+        flagin= isvalid & (-clipping[0]*nmad < res) & (res < clipping[1]*nmad)
+
+        weights  = np.where(flagin, 1./np.where(isvalid, error, 1)**2, 0)
+        normal   = np.einsum("ch,hd,he->cde", weights, design, design)
+        projdata = np.einsum("ch,hd->cd", weights*np.where(flagin, data, 0), design)
+        # - not enough points to constrain the polynomial
+        degenerate = np.sum(flagin, axis=1) < degree
+        normal[degenerate] = np.eye(degree)
+        params   = np.linalg.solve(normal, projdata[:,:,None])[:,:,0]
+        params[degenerate] = np.NaN
+        model    = np.dot(params, design.T)
+
+    if np.any(degenerate):
+        warnings.warn("%d column(s) have not enough background pixels, their continuum is set to NaN"%degenerate.sum())
+
+    covariance = np.linalg.inv(normal)
+    errors     = np.sqrt(np.abs(np.diagonal(covariance, axis1=1, axis2=2)))
+    chi2       = np.sum(weights*np.where(flagin, data-model, 0)**2, axis=1)
+
+    contvalues = {}
+    for k, i_ in enumerate(columns):
+        contvalues[i_] = {}
+        for d in range(degree):
+            contvalues[i_]["a%d"%d]     = params[k,d]
+            contvalues[i_]["a%d.err"%d] = errors[k,d]
+        contvalues[i_]["chi2"] = chi2[k]
+
+    return contvalues
 
 def _get_xaxis_polynomial_(xyv, degree=DEGREE, legendre=LEGENDRE,
                          xmodel=None, clipping = [5,5]):
@@ -138,34 +236,61 @@ def _get_xaxis_polynomial_(xyv, degree=DEGREE, legendre=LEGENDRE,
 
         
 class Background( BaseObject ):
-    """ """
+    """ CCD background modelled by the continuum fitted on a subset of ccd columns.
+
+    The background image is evaluated lazily from the column continuum parameters
+    (`contvalues`), the smoothing and the ccd shape. It can also be evaluated only
+    on some rows/columns (e.g. the box of a trace), see get_background().
+    """
     PROPERTIES      = ["contvalues" ]
-    SIDE_PROPERTIES = ['filename',"header","y"]
-    DERIVED_PROPERTIES = ['input_columns', "input_background","background"]
+    SIDE_PROPERTIES = ['filename',"header","y", "smoothing", "shape"]
+    DERIVED_PROPERTIES = ['input_columns', "input_background","background", "interpolator"]
     
     def load(self, filename):
-        """ """
+        """ load a background .fits file.
+        Both the parametric files (see writeto()) and the former files
+        containing the full background image are supported.
+        """
         data_ = pf.open(filename)
-        
-        # - background
-        self._derived_properties['background'] = data_[0].data
-        self._side_properties['header'] = data_[0].header
+        header = data_[0].header
         # - contvalues
         contheader = data_["POLYVALUES"].header
         params = [int(k.replace("VALUE","")) for k,v in contheader.items() if "VALUE" in k]
         columns = data_["COLUMNS"].data
         convalues = {col:{contheader['VALUE%d'%i]: c_ for i,c_ in zip(params, cval_i)}
                          for col, cval_i in zip(columns, data_["POLYVALUES"].data)}
-        self.create(convalues) 
+        self.create(convalues)
+        self._side_properties['filename'] = filename
+        
+        # - background
+        if data_[0].data is not None:
+            # former format, the full image is stored
+            self._side_properties['shape'] = np.shape(data_[0].data)
+            self._derived_properties['background'] = data_[0].data
+        else:
+            self._side_properties['shape'] = (header["BKGDNY"], header["BKGDNX"])
+            self._side_properties['smoothing'] = [header["BKGDSMY"], header["BKGDSMX"]]
+            if "BKGDSUM" in header and header["BKGDSUM"] != self.get_checksum():
+                raise IOError("The checksum of the background parameters of %s does not match (corrupted file)"%filename)
+            
+        self._side_properties['header'] = header
+        data_.close()
         
     def create(self, contvalues):
         """ setup the instance based on the input 'contvalue' """
         self._properties['contvalues']    = contvalues
         self._derived_properties['input_columns'] = None
+        self._derived_properties['input_background'] = None
+        self._derived_properties['interpolator'] = None
+        self._derived_properties['background'] = None
         
     def build(self, width, height, smoothing= [0,5]):
-        """ """
-        self._derived_properties['background'] = self.get_background(height, width, smoothing=smoothing)
+        """ set the shape and the smoothing of the background image.
+        The image is evaluated only when needed (see background and get_background()) """
+        self._side_properties['shape'] = (height, width)
+        self._side_properties['smoothing'] = smoothing
+        self._derived_properties['interpolator'] = None
+        self._derived_properties['background'] = None
         
     def contvalue_to_polynome(self, contvalue_):
         """ """
@@ -183,29 +308,65 @@ class Background( BaseObject ):
         del(poly)
         return model
 
+    def get_background(self, rows=None, columns=None, dtype=None, chunksize=256):
+        """ evaluate the background image (or only a part of it)
 
-    def get_background(self, width, height, smoothing = [0,5]):
-        """ """
-        from scipy import ndimage, interpolate
-        # get the blured image
-        self._filtered = ndimage.filters.gaussian_filter( self.input_background, smoothing)
-        # resample
-        orig_shape = np.shape(self.input_background)
-        x = np.linspace(0,1, orig_shape[0])
-        y = np.linspace(0,1, orig_shape[1])
-        nk = interpolate.RectBivariateSpline(x,y, self._filtered, kx=3,ky=3)
+        Parameters
+        ----------
+        rows, columns: [None, slice, array of int] -optional-
+            ccd rows (y) and columns (x) where the background should be evaluated.
+            None means all of them. e.g. rows=slice(ymin, ymax), columns=slice(xmin, xmax)
+            to get the background in the box of a trace.
+
+        dtype: [string or numpy dtype] -optional-
+            dtype of the returned array (e.g. "float32"). Default float64.
+
+        chunksize: [int] -optional-
+            the image is evaluated by blocks of `chunksize` rows (to limit the memory
+            footprint when dtype is smaller than float64).
+
+        Returns
+        -------
+        2d array (nrows, ncolumns)
+        """
+        if dtype is None:
+            dtype = "float64"
+            
+        yrows = np.arange(self.shape[0])[rows if rows is not None else slice(None)]
+        xcols = np.arange(self.shape[1])[columns if columns is not None else slice(None)]
+        # - The image is already known (e.g. former format)
+        if self._derived_properties["background"] is not None:
+            return np.asarray(self._derived_properties["background"][np.ix_(yrows, xcols)], dtype=dtype)
         
-        return nk(np.linspace(0,1,width),np.linspace(0,1,height))
+        yscaled = np.linspace(0, 1, self.shape[0])[yrows]
+        xscaled = np.linspace(0, 1, self.shape[1])[xcols]
+        image = np.empty((len(yscaled), len(xscaled)), dtype=dtype)
+        for i in range(0, len(yscaled), chunksize):
+            image[i:i+chunksize] = self.interpolator(yscaled[i:i+chunksize], xscaled)
+        return image
 
+    def get_checksum(self):
+        """ md5 checksum of the parameters defining the background
+        (columns, contvalues, smoothing and shape) """
+        import hashlib
+        params = np.sort(list(list(self._contvalues.values())[0].keys()))
+        md5 = hashlib.md5()
+        md5.update(np.asarray(self.input_columns, dtype="int64").tobytes())
+        md5.update(np.asarray([[self._contvalues[i][p] for p in params] for i in self.input_columns],
+                                  dtype="float64").tobytes())
+        md5.update(",".join(params).encode())
+        md5.update(np.asarray(list(self.smoothing)+list(self.shape), dtype="float64").tobytes())
+        return md5.hexdigest()
 
     # ----------------- #
     #   I/O and Plots   #
     # ----------------- #
-    def writeto(self, savefile, overwrite=True, **header_kwargs):
+    def writeto(self, savefile, overwrite=True, store_image=False, **header_kwargs):
         """ save the background as a .fits file
         
         The object will be structured as follows:
-        0 PrimaryHDU: Background image 
+        0 PrimaryHDU: empty (or the Background image if store_image)
+                      [shape, smoothing and checksum in the header]
         1 POLYVALUES: list of values associated to the best fits of column continuum
                       [parameter names in the header]
         2 COLUMNS: list of the fitted columns
@@ -220,23 +381,27 @@ class Background( BaseObject ):
         overwrite: [bool] -optional-
             Shall this overwrite an existing file if any.
 
+        store_image: [bool] -optional-
+            Shall the full background image be stored too (former format) ?
+            This is not needed since the image is evaluated from the parameters.
+
         **header_kwargs additional information to be saved in the Primary header.
         
         Returns
         -------
         Void
         """
-        img_shape = np.shape(self.background)
-        
-        self.header["NAXIS"] = len(img_shape)
-        self.header['NAXIS1'] = img_shape[0]
-        self.header['NAXIS2'] = img_shape[1]
         self.header['TYPE']   = "background"
-        for k,v in header_kwargs:
+        self.header['BKGDNY'] = (self.shape[0], "number of ccd rows of the background")
+        self.header['BKGDNX'] = (self.shape[1], "number of ccd columns of the background")
+        self.header['BKGDSMY'] = (self.smoothing[0], "gaussian smoothing along the rows")
+        self.header['BKGDSMX'] = (self.smoothing[1], "gaussian smoothing along the columns")
+        self.header['BKGDSUM'] = (self.get_checksum(), "md5 of the background parameters")
+        for k,v in header_kwargs.items():
             self.header[k] = v
             
         # --- Build the HDU
-        hdu = [pf.PrimaryHDU(self.background, self.header)] # Background
+        hdu = [pf.PrimaryHDU(self.background if store_image else None, self.header)]
         
         params = np.sort(list(list(self._contvalues.values())[0].keys()))
         header_POLY = pf.Header()
@@ -307,19 +472,58 @@ class Background( BaseObject ):
         return self._side_properties['y']
     
 
+    @property
+    def shape(self):
+        """ shape of the background image (nrows, ncolumns) """
+        if self._side_properties['shape'] is None:
+            self._side_properties['shape'] = tuple(SEDM_CCD_SIZE[::-1])
+        return self._side_properties['shape']
+
+    @property
+    def smoothing(self):
+        """ gaussian smoothing applied to the input_background """
+        if self._side_properties['smoothing'] is None:
+            self._side_properties['smoothing'] = [0,5]
+        return self._side_properties['smoothing']
+
     # -- Background
     @property
     def background(self):
-        """ """
+        """ full background image (evaluated the first time it is accessed) """
+        if self._derived_properties["background"] is None and self._contvalues is not None:
+            self._derived_properties["background"] = self.get_background()
         return self._derived_properties["background"]
+    
     @property
     def input_background(self):
         """ """
         if self._derived_properties["input_background"] is None:
-            self._derived_properties["input_background"] = \
-              np.asarray([self.contvalue_to_polynome(self._contvalues[i])
-                            for i in self.input_columns]).T
+            if not LEGENDRE or np.any(["mu0" in self._contvalues[i] for i in self.input_columns]):
+                self._derived_properties["input_background"] = \
+                  np.asarray([self.contvalue_to_polynome(self._contvalues[i])
+                                for i in self.input_columns]).T
+            else:
+                # - all columns at once (same as contvalue_to_polynome)
+                from numpy.polynomial import legendre
+                params = np.asarray([[self._contvalues[i]["a%d"%d] for d in range(DEGREE)]
+                                         for i in self.input_columns])
+                yscaled = np.linspace(-1, 1, self.n_inputcolumns*2)
+                design = legendre.legvander(yscaled, DEGREE-1)
+                self._derived_properties["input_background"] = np.dot(design, params.T)
         return self._derived_properties["input_background"]
+
+    @property
+    def interpolator(self):
+        """ spline of the smoothed input_background (in [0,1]x[0,1] coordinates) """
+        if self._derived_properties["interpolator"] is None:
+            from scipy import ndimage, interpolate
+            # get the blured image
+            self._filtered = ndimage.gaussian_filter( self.input_background, self.smoothing)
+            orig_shape = np.shape(self.input_background)
+            x = np.linspace(0,1, orig_shape[0])
+            y = np.linspace(0,1, orig_shape[1])
+            self._derived_properties["interpolator"] = interpolate.RectBivariateSpline(x,y, self._filtered, kx=3,ky=3)
+        return self._derived_properties["interpolator"]
     
     # -- Fits tools
     @property
@@ -0,0 +1,8 @@
+""" Synthetic SEDM night and pipeline benchmarks.
+
+- synthetic.build_synthetic_night(): writes a deterministic night in the redux directory layout.
+- benchmarks.run_benchmarks(): times the pipeline stages on such a night and returns/saves a json report.
+"""
+
+from .synthetic import build_synthetic_night
+from .benchmarks import run_benchmarks
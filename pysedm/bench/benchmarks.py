@@ -0,0 +1,363 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Timed benchmarks of the pipeline stages.
+
+Each stage has a setup function (not timed) returning the function to time.
+The stages are ran in order on a night (usually a synthetic one, see synthetic.py)
+since each one needs the products of the previous ones (TraceMatch, HexaGrid,
+WaveSolution, backgrounds, cube...).
+
+```
+from pysedm.bench import run_benchmarks
+report = run_benchmarks("/tmp/sedmbench", savefile="bench.json")
+```
+"""
+
+import os
+import json
+import time
+import platform
+import warnings
+import traceback
+import numpy as np
+
+from .synthetic import BENCH_DATE, TRUTH_NAME, build_synthetic_night
+from ..utils.timing import get_cputime, get_maxrss
+
+BENCH_VERSION = 2
+BENCH_SEED    = 1234 # random selections made by the stages (e.g. traces of get_ccd_jflexure)
+
+__all__ = ["run_benchmarks"]
+
+
+# ================== #
+#                    #
+#   Main Function    #
+#                    #
+# ================== #
+def run_benchmarks(rootdir, date=BENCH_DATE, stages=None, repeat=1, ncore=1,
+                   savefile=None, trace_memory=False, build_night=True,
+                   verbose=True, **kwargs):
+    """ Time the pipeline stages on the night `rootdir`/`date`.
+
+    Parameters
+    ----------
+    rootdir: [string]
+        redux directory. io.REDUXPATH is set to it during the benchmarks.
+
+    date: [string] -optional-
+        night to use.
+
+    stages: [list of string] -optional-
+        stages to run (see BENCHMARK_STAGES). All of them if None.
+        The products of the stages that are not ran must exist.
+
+    repeat: [int] -optional-
+        number of time each stage is timed.
+
+    ncore: [int] -optional-
+        number of processes given to the stages that accept it.
+
+    savefile: [string] -optional-
+        where the json report should be saved.
+
+    trace_memory: [bool] -optional-
+        shall the python/numpy memory peak of each stage be measured (tracemalloc) ?
+        This slows down the stages.
+
+    build_night: [bool] -optional-
+        shall the synthetic night be built if it does not exist ?
+        **kwargs goes to build_synthetic_night()
+
+    Returns
+    -------
+    dict (the report)
+    """
+    from .. import io
+    if stages is None:
+        stages = list(BENCHMARK_STAGES.keys())
+    unknown = [s_ for s_ in stages if s_ not in BENCHMARK_STAGES]
+    if len(unknown)>0:
+        raise ValueError("Unknown benchmark stage(s) %s. Available: %s"%(", ".join(unknown), ", ".join(BENCHMARK_STAGES.keys())))
+
+    if build_night:
+        build_synthetic_night(rootdir, date=date, **kwargs)
+
+    truthfile = os.path.join(rootdir, date, TRUTH_NAME%date)
+    state = {"date": date, "ncore": ncore,
+             "truth": json.load(open(truthfile)) if os.path.isfile(truthfile) else None}
+
+    report = {"version": BENCH_VERSION, "date": date, "rootdir": os.path.abspath(rootdir),
+              "repeat": repeat, "ncore": ncore, "environment": get_environment(),
+              "stages": {}}
+
+    reduxpath, io.REDUXPATH = io.REDUXPATH, os.path.abspath(rootdir)
+    try:
+        for stage in stages:
+            if verbose:
+                print("BENCHMARK: %s"%stage)
+            report["stages"][stage] = time_stage(BENCHMARK_STAGES[stage], state, repeat=repeat,
+                                                 trace_memory=trace_memory)
+            if verbose:
+                print(" -> %s"%_stage_summary_(report["stages"][stage]))
+    finally:
+        io.REDUXPATH = reduxpath
+
+    if savefile is not None:
+        with open(savefile, "w") as fout:
+            json.dump(report, fout, indent=2)
+
+    return report
+
+
+def time_stage(setup, state, repeat=1, trace_memory=False):
+    """ time `repeat` times the function returned by setup(state).
+
+    Returns
+    -------
+    dict: {"status": "ok" or "error", "wall": [s], "cpu": [s], "maxrss_mb": [MB],
+           "tracemalloc_peak_mb" (if trace_memory), "metrics": {...}, "error": str (if error)}
+    """
+    result = {"status": "ok", "wall": [], "cpu": [], "maxrss_mb": [], "metrics": {}}
+    if trace_memory:
+        result["tracemalloc_peak_mb"] = []
+    for i in range(repeat):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                run = setup(state)
+                if trace_memory:
+                    import tracemalloc
+                    tracemalloc.start()
+                wall, cpu = time.perf_counter(), get_cputime()
+                metrics = run()
+                wall, cpu = time.perf_counter()-wall, get_cputime()-cpu
+                if trace_memory:
+                    result["tracemalloc_peak_mb"].append(tracemalloc.get_traced_memory()[1]/1024**2)
+                    tracemalloc.stop()
+        except Exception as e:
+            if trace_memory:
+                import tracemalloc
+                tracemalloc.stop()
+            result["status"] = "error"
+            result["error"]  = "%s: %s"%(e.__class__.__name__, e)
+            result["traceback"] = traceback.format_exc()
+            break
+
+        result["wall"].append(wall)
+        result["cpu"].append(cpu)
+        result["maxrss_mb"].append(get_maxrss())
+        if metrics is not None:
+            result["metrics"] = metrics
+
+    if len(result["wall"])>0:
+        result["wall_min"] = float(np.min(result["wall"]))
+        result["wall_median"] = float(np.median(result["wall"]))
+    return result
+
+
+# ================== #
+#                    #
+#   Tools            #
+#                    #
+# ================== #
+def get_environment():
+    """ what is needed to compare reports from commit to commit """
+    import subprocess
+    from .. import __version__
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+    return {"pysedm": __version__, "git_commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def _stage_summary_(result):
+    """ """
+    if result["status"] != "ok":
+        return "ERROR %s"%result["error"]
+    return "wall %.2fs | cpu %.2fs | maxrss %.0fMB"%(result["wall_min"], np.min(result["cpu"]),
+                                                    np.max(result["maxrss_mb"]))
+
+def _get_science_ccdfile_(state):
+    """ first crr file of the night """
+    from .. import io
+    return io.get_night_files(state["date"], "ccd.crr")[0]
+
+def _get_truth_(state, ccdfile):
+    """ truth of the given synthetic science frame (None if unknown) """
+    from ..inventory import parse_fileid
+    if state["truth"] is None:
+        return None
+    fileinfo = parse_fileid(ccdfile)
+    fileid = "ifu%s_%s_%s"%(fileinfo["date"], fileinfo["id"], fileinfo["target"])
+    return state["truth"]["science"].get(fileid, None)
+
+
+# ================== #
+#                    #
+#   Stages           #
+#                    #
+# ================== #
+def _setup_build_tracematcher_(state):
+    """ """
+    from .. import io
+    from ..script.ccd_to_cube import build_tracematcher
+    def run():
+        build_tracematcher(state["date"], verbose=False, rebuild=True)
+        ntraces = len(io.load_nightly_tracematch(state["date"], use_bundle=False).trace_indexes)
+        return {"ntraces": ntraces,
+                "ntraces_expected": state["truth"]["ntraces"] if state["truth"] is not None else None}
+    return run
+
+def _setup_load_trace_masks_(state):
+    """ """
+    from .. import io
+    from ..sedm import INDEX_CCD_CONTOURS
+    from ..spectralmatching import load_trace_masks
+    tracematch = io.load_nightly_tracematch(state["date"], use_bundle=False)
+    indexes = tracematch.get_traces_within_polygon(INDEX_CCD_CONTOURS)
+    def run():
+        load_trace_masks(tracematch, indexes, ncore=state["ncore"])
+        # - needed by the next stages
+        tracematch.writeto(io.get_datapath(state["date"])+"%s_TraceMatch_WithMasks.pkl"%state["date"])
+        return {"nmasks": len(indexes)}
+    return run
+
+def _setup_build_hexagonalgrid_(state):
+    """ """
+    from ..script.ccd_to_cube import build_hexagonalgrid
+    def run():
+        build_hexagonalgrid(state["date"])
+    return run
+
+def _setup_build_wavesolution_(state):
+    """ """
+    from .. import io
+    from ..script.ccd_to_cube import build_wavesolution
+    def run():
+        build_wavesolution(state["date"], savefig=False, ncore=state["ncore"])
+        wsol = io.load_nightly_wavesolution(state["date"], use_bundle=False)
+        return {"nsolutions": len(wsol.wavesolutions),
+                "median_rms": float(np.nanmedian([wsol.get_spaxel_wavesolution(i).get_wavesolution_rms()
+                                                  for i in wsol.wavesolutions]))}
+    return run
+
+def _setup_build_backgrounds_(state):
+    """ """
+    from ..script.ccd_to_cube import build_backgrounds
+    def run():
+        build_backgrounds(state["date"], savefig=False, ncore=state["ncore"])
+    return run
+
+def _load_science_ccd_(state):
+    """ j-flexure corrected science ccd with its background and trace masks (as in build_cubes) """
+    from .. import io
+    from ..ccd import get_ccd
+    from ..sedm import INDEX_CCD_CONTOURS
+    from ..spectralmatching import load_trace_masks
+    ccdfile = _get_science_ccdfile_(state)
+    ccd = get_ccd(ccdfile, tracematch=io.load_nightly_tracematch(state["date"], withmask=False),
+                  background=0, correct_traceflexure=True)
+    load_trace_masks(ccd.tracematch, ccd.tracematch.get_traces_within_polygon(INDEX_CCD_CONTOURS),
+                     ncore=state["ncore"])
+    ccd.fetch_background(set_it=True, build_if_needed=True, ncore=state["ncore"])
+    if not ccd.has_var():
+        ccd.set_default_variance()
+    return ccd
+
+def _setup_extract_cube_(state):
+    """ """
+    from .. import io
+    from ..sedm import SEDM_LBDA
+    if "ccd" not in state:
+        state["ccd"] = _load_science_ccd_(state)
+    ccd = state["ccd"]
+    hexagrid = io.load_nightly_hexagonalgrid(state["date"])
+    wsol = io.load_nightly_wavesolution(state["date"])
+    wsol._load_full_solutions_()
+    traceindexes = [i_ for i_ in np.sort(list(wsol.wavesolutions.keys())) if i_ in hexagrid.ids_index.keys()]
+    state["wavesolution"], state["hexagrid"] = wsol, hexagrid
+    def run():
+        state["cube"] = ccd.extract_cube(wsol, SEDM_LBDA, hexagrid=hexagrid, traceindexes=traceindexes,
+                                         show_progress=False)
+        state["cube"].set_header(ccd.header)
+        return {"nspaxels": len(state["cube"].indexes)}
+    return run
+
+def _setup_flexure_(state):
+    """ j (trace) and i (sky lines) flexure of the science ccd.
+
+    The traces used for the j-flexure are randomly drawn (see get_ccd_jflexure): the draw 
+    is seeded (BENCH_SEED) such that the metric only changes with the code. 
+    The j-flexure is the minimum of the pseudo-magnitude scan on a grid of step 
+    `jflexure_resolution`. On the synthetic night, it scatters by ~0.1 pixel around 
+    `jflexure_expected` from one draw of the traces to another: only larger differences are meaningful.
+    """
+    from .. import io
+    from ..ccd import get_ccd
+    from ..flexure import get_ccd_jflexure
+    from ..mapping import Mapper
+    from ..wavesolution import Flexure
+    if "cube" not in state:
+        _setup_extract_cube_(state)()
+    ccd, cube = state["ccd"], state["cube"]
+    truth = _get_truth_(state, ccd.filename)
+    rawccd = get_ccd(ccd.filename, tracematch=io.load_nightly_tracematch(state["date"], withmask=False),
+                     background=0)
+    jscan = [-2.5, 2.5, 51]
+    def run():
+        np.random.seed(BENCH_SEED)
+        j_offset = get_ccd_jflexure(rawccd, ntraces=200, tracewidth=1, jscan=jscan,
+                                    savefile=None, get_object=False)
+        mapper = Mapper(tracematch=ccd.tracematch, wavesolution=state["wavesolution"],
+                        hexagrid=state["hexagrid"])
+        mapper.derive_spaxel_mapping(list(state["wavesolution"].wavesolutions.keys()))
+        flexure = Flexure(cube, mapper=mapper)
+        flexure.load_telluric_fit()
+        flexure.load_sodium_fit()
+        i_shift = flexure.get_i_flexure(["sodium", "telluric"])
+        return {"jflexure": float(j_offset), "iflexure": float(i_shift),
+                # estimate_jshift() grid
+                "jflexure_resolution": (jscan[1]-jscan[0])/99.,
+                "jflexure_expected": truth["jflexure"] if truth is not None else None,
+                "iflexure_expected": truth["iflexure"] if truth is not None else None}
+    return run
+
+def _setup_byecr_(state):
+    """ """
+    from ..byecr import SEDM_BYECR
+    if "cube" not in state:
+        _setup_extract_cube_(state)()
+    cube = state["cube"]
+    def run():
+        byecrclass = SEDM_BYECR(state["date"], cube)
+        cr_df = byecrclass.get_cr_spaxel_info()
+        return {"ncr_spaxels": len(cr_df)}
+    return run
+
+def _setup_extractstar_(state):
+    """ """
+    from ..sedm import SEDMExtractStar
+    if "cube" not in state:
+        _setup_extract_cube_(state)()
+    cube = state["cube"]
+    def run():
+        es = SEDMExtractStar(cube)
+        es.run(slice_width=1)
+    return run
+
+
+BENCHMARK_STAGES = {"build_tracematcher": _setup_build_tracematcher_,
+                    "load_trace_masks": _setup_load_trace_masks_,
+                    "build_hexagonalgrid": _setup_build_hexagonalgrid_,
+                    "build_wavesolution": _setup_build_wavesolution_,
+                    "build_backgrounds": _setup_build_backgrounds_,
+                    "extract_cube": _setup_extract_cube_,
+                    "flexure": _setup_flexure_,
+                    "byecr": _setup_byecr_,
+                    "extractstar": _setup_extractstar_}
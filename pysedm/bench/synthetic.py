@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Synthetic SEDM night.
+
+A complete and deterministic night is written in the redux directory layout
+(see io.get_datapath() and io.PRODSTRUCT_RE):
+- dome.fits: flat traces on the ccd, bright in their core such that sep finds them
+  as expected by DomeCCD.get_trace_position().
+- Hg.fits, Cd.fits, Xe.fits: arc lines of wavesolution.LINES, following a single
+  pixel<->wavelength relation derived from the LINES expected positions.
+- crr_b_ifu{date}_*.fits: science frames with a gaussian point source on the
+  hexagonal grid of spaxels, a sky continuum with the sodium skyline
+  (SODIUM_SKYLINE_LBDA), the telluric absorption (TELLURIC_REF_LBDA), a known
+  j (ccd-y) and i (ccd-x) flexure and cosmic rays.
+
+The input parameters ("truth") are stored in a json file in the night directory.
+"""
+
+import os
+import json
+import numpy as np
+
+from astropy.io import fits
+
+from ..sedm import SEDM_CCD_SIZE, TRACE_DISPERSION, SEDM_XRED_EXTENTION, SEDM_XBLUE_EXTENTION
+from ..wavesolution import LINES, SODIUM_SKYLINE_LBDA, TELLURIC_REF_LBDA
+
+BENCH_DATE     = "20000101"
+TRUTH_NAME     = "%s_SyntheticTruth.json"
+
+# - Trace layout (hexagonal grid of spaxels seen on the ccd)
+TRACE_SPACING  = 57    # ccd pixels between two neighboring spaxels
+TRACE_ROTATION = 25.29 # degree. Traces (~300 pixels long) are >8 pixels apart for spacing>=57
+TRACE_CENTER   = [950, 950]
+TRACE_RADIUS   = 900
+TRACE_BLUEGAP  = 25    # pixels between the bluest end of the traces and 3700AA
+TRACE_CORELENGTH = 40  # half length of the bright dome segment seen by sep.
+TRACE_TILT     = 0.01  # ccd-y slope of the traces. As on the real ccd, a trace then samples all
+                       # the sub-pixel phases, otherwise the j-flexure estimate is pixel-quantized.
+
+# - Flux levels [ADU]
+DOME_CORE_FLUX = 3e4
+DOME_FLUX      = 1.5e3
+ARC_LINE_FLUX  = 1e3 # per unit of LINES 'ampl'
+READOUT_NOISE  = 5.
+
+__all__ = ["build_synthetic_night"]
+
+
+# ================== #
+#                    #
+#   Main Function    #
+#                    #
+# ================== #
+def build_synthetic_night(rootdir, date=BENCH_DATE, targets=["synthstar"], seed=1234,
+                          spacing=TRACE_SPACING, radius=TRACE_RADIUS,
+                          jflexure=0.4, iflexure=0.6, ncosmics=500,
+                          psf_sigma=1.5, exptime=300, overwrite=False):
+    """ Write a synthetic night in `rootdir`/`date`/.
+
+    Parameters
+    ----------
+    rootdir: [string]
+        redux directory (the io.REDUXPATH to use to read the night back).
+
+    date: [string] -optional-
+        YYYYMMDD of the night.
+
+    targets: [list of string] -optional-
+        one science frame is made per target.
+
+    seed: [int] -optional-
+        random seed, the night is the same for a given set of parameters.
+
+    spacing, radius: [float] -optional-
+        distance between the spaxels and radius of the MLA in ccd pixels.
+        Use a larger spacing (or a smaller radius) to have less traces.
+
+    jflexure, iflexure: [float] -optional-
+        ccd-y and ccd-x shift (in pixels) of the science frames with respect to
+        the calibration frames.
+
+    ncosmics: [int] -optional-
+        number of cosmic rays per science frame.
+
+    psf_sigma: [float] -optional-
+        width of the gaussian point source in spaxel units.
+
+    overwrite: [bool] -optional-
+        shall existing files be rewritten ?
+
+    Returns
+    -------
+    dict (the truth, also saved as `date`_SyntheticTruth.json)
+    """
+    timedir = os.path.join(rootdir, date)+"/"
+    truthfile = timedir+TRUTH_NAME%date
+    if os.path.isfile(truthfile) and not overwrite:
+        return json.load(open(truthfile))
+
+    os.makedirs(timedir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    traces = get_trace_layout(spacing=spacing, radius=radius)
+
+    # - Calibrations
+    write_ccd(timedir+"dome.fits", get_dome_image(traces, rng), get_header("dome", date, 0, imgtype="dome"))
+    for i, lamp in enumerate(["Hg", "Cd", "Xe"]):
+        write_ccd(timedir+"%s.fits"%lamp, get_arc_image(traces, lamp, rng),
+                  get_header(lamp, date, i+1, imgtype="lamp"))
+
+    # - Science
+    truth = {"date": date, "seed": seed, "ntraces": len(traces["xc"]),
+             "spacing": spacing, "radius": radius, "tilt": TRACE_TILT, "science": {}}
+    for i, target in enumerate(targets):
+        xy_psf = rng.uniform(-2, 2, size=2)*spacing
+        image, cosmics = get_science_image(traces, rng, xy_psf=xy_psf, psf_sigma=psf_sigma*spacing,
+                                           jflexure=jflexure, iflexure=iflexure,
+                                           ncosmics=ncosmics, exptime=exptime)
+        fileid = "ifu%s_%02d_%02d_%02d_%s"%(date, 5+i, 10, 0, target)
+        header = get_header(target, date, 10+i, imgtype="science", exptime=exptime)
+        header["BNCHJFLX"] = (jflexure, "synthetic j (ccd-y) flexure [pixel]")
+        header["BNCHIFLX"] = (iflexure, "synthetic i (ccd-x) flexure [pixel]")
+        write_ccd(timedir+"crr_b_%s.fits"%fileid, image, header)
+        truth["science"][fileid] = {"target": target, "xy_psf": list(xy_psf),
+                                    "psf_sigma": psf_sigma*spacing,
+                                    "jflexure": jflexure, "iflexure": iflexure,
+                                    "cosmics": cosmics.tolist()}
+
+    with open(truthfile, "w") as fout:
+        json.dump(truth, fout)
+
+    return truth
+
+
+# ================== #
+#                    #
+#   Tools            #
+#                    #
+# ================== #
+def get_dispersion_relation(degree=3):
+    """ polynomial coefficients (numpy.polyval, lbda in 1e3 AA) of the pixel
+    position (reversed ccd-x, i.e. 'mu' in wavesolution.LINES) of a wavelength.
+    """
+    lbda, mu = np.asarray([[lbda_, v["mu"]] for lines in LINES.values()
+                               for lbda_, v in lines.items()]).T
+    return np.polyfit(lbda/1e3, mu, degree)
+
+def lbda_to_tracex(lbda, xblue, dispersion=None):
+    """ ccd-x position of the given wavelength for a trace whose bluest end is `xblue` """
+    if dispersion is None:
+        dispersion = get_dispersion_relation()
+    mu = np.polyval(dispersion, np.asarray(lbda)/1e3)
+    return xblue - TRACE_BLUEGAP - (mu - np.polyval(dispersion, 3.7))
+
+def tracex_to_lbda(x, xblue, dispersion=None):
+    """ wavelength of the given ccd-x for a trace whose bluest end is `xblue`
+    (NaN outside 3300-10000AA) """
+    lbdagrid = np.linspace(3300, 10000, 1000)
+    xgrid = lbda_to_tracex(lbdagrid, xblue, dispersion=dispersion)
+    return np.interp(x, xgrid[::-1], lbdagrid[::-1], left=np.NaN, right=np.NaN)
+
+def get_trace_layout(spacing=TRACE_SPACING, radius=TRACE_RADIUS,
+                     rotation=TRACE_ROTATION, center=TRACE_CENTER):
+    """ positions of the traces on the ccd.
+
+    Returns
+    -------
+    dict: {"xc","yc": trace center (sep centroid of the dome core),
+           "xmin","xmax": trace boundaries (as domexy_to_tracesize),
+           "dx","dy": position of the spaxel with respect to the MLA center [ccd pixels]}
+    The trace ccd-y at ccd-x is yc + TRACE_TILT*(x-xc).
+    """
+    n = int(radius/spacing)+2
+    q, r = [np.ravel(l_) for l_ in np.meshgrid(np.arange(-n, n+1), np.arange(-n, n+1))]
+    rot = np.deg2rad(rotation)
+    rotmatrix = np.asarray([[np.cos(rot), -np.sin(rot)], [np.sin(rot), np.cos(rot)]])
+    dx, dy = np.dot(rotmatrix, [q + 0.5*r, np.sqrt(3)/2.*r]) * spacing
+    flagin = np.sqrt(dx**2+dy**2) < radius
+    xc, yc = dx[flagin]+center[0], dy[flagin]+center[1]
+
+    xmin = xc - (xc*SEDM_XRED_EXTENTION[0] + SEDM_XRED_EXTENTION[1])
+    xmax = xc - (xc*SEDM_XBLUE_EXTENTION[0] + SEDM_XBLUE_EXTENTION[1])
+    yext = np.abs(TRACE_TILT)*np.maximum(xc-xmin, xmax-xc)
+    flagccd = (xmin>5) & (xmax<SEDM_CCD_SIZE[0]-5) & (yc-yext>5) & (yc+yext<SEDM_CCD_SIZE[1]-5)
+    return {"xc":xc[flagccd], "yc":yc[flagccd], "xmin":xmin[flagccd], "xmax":xmax[flagccd],
+            "dx":dx[flagin][flagccd], "dy":dy[flagin][flagccd]}
+
+def paint_traces(image, traces, fluxfunc, jshift=0, ishift=0, sigma=None):
+    """ add the traces on the image.
+
+    fluxfunc: [function]
+        fluxfunc(index, lbda) -> flux per ccd-x pixel of the trace `index`
+        at the given wavelengths.
+    """
+    from scipy.special import erf
+    if sigma is None:
+        sigma = TRACE_DISPERSION/2.
+    height, width = image.shape
+    dy = np.arange(-int(5*sigma)-1, int(5*sigma)+2)
+    dispersion = get_dispersion_relation()
+    for i, (xc, yc, xmin, xmax) in enumerate(zip(traces["xc"], traces["yc"], traces["xmin"], traces["xmax"])):
+        x = np.arange(int(np.floor(xmin)), int(np.ceil(xmax))+1)
+        x = x[(x>=0) & (x<width)]
+        lbda = tracex_to_lbda(x - ishift, xmax, dispersion=dispersion)
+        flux = np.nan_to_num(fluxfunc(i, lbda))
+        ycen = yc + TRACE_TILT*(x-xc) + jshift
+        rows = np.round(ycen).astype("int")[None,:] + dy[:,None]
+        # gaussian profile integrated over the pixels (rows x columns)
+        edges = (np.concatenate([rows-0.5, rows[-1:]+0.5]) - ycen)/(np.sqrt(2)*sigma)
+        profile = np.diff(erf(edges), axis=0)/2.
+        flagok = (rows>=0) & (rows<height)
+        image[rows[flagok], np.broadcast_to(x, rows.shape)[flagok]] += (profile * flux[None,:])[flagok]
+    return image
+
+def add_noise(image, rng, readout_noise=READOUT_NOISE):
+    """ poisson (gaussian approximation) and readout noises """
+    return image + rng.normal(size=image.shape)*np.sqrt(np.abs(image)+readout_noise**2)
+
+def get_dome_image(traces, rng):
+    """ """
+    xc = traces["xc"]
+    def fluxfunc(i, lbda):
+        x = lbda_to_tracex(lbda, traces["xmax"][i])
+        core = np.abs(x-xc[i]) < TRACE_CORELENGTH
+        return np.where(np.isfinite(lbda), DOME_FLUX + core*DOME_CORE_FLUX, 0)
+
+    image = paint_traces(np.zeros(SEDM_CCD_SIZE[::-1]), traces, fluxfunc)
+    return add_noise(image, rng)
+
+def get_arc_image(traces, lampname, rng, linesigma=1.5):
+    """ """
+    dispersion = get_dispersion_relation()
+    lines = LINES[lampname]
+    lbdas = np.asarray(list(lines.keys()))
+    ampls = np.asarray([lines[l]["ampl"] for l in lbdas])*ARC_LINE_FLUX
+    def fluxfunc(i, lbda):
+        x = lbda_to_tracex(lbda, traces["xmax"][i], dispersion=dispersion)
+        xlines = lbda_to_tracex(lbdas, traces["xmax"][i], dispersion=dispersion)
+        return 20 + np.sum(ampls[:,None]*np.exp(-0.5*((x[None,:]-xlines[:,None])/linesigma)**2), axis=0)
+
+    image = paint_traces(np.zeros(SEDM_CCD_SIZE[::-1]), traces, fluxfunc)
+    return add_noise(image, rng)
+
+def get_sky_spectrum(lbda):
+    """ sky continuum with the sodium skyline """
+    return 50 + 400*np.exp(-0.5*((lbda-SODIUM_SKYLINE_LBDA)/8.)**2)
+
+def get_star_spectrum(lbda):
+    """ smooth stellar continuum with the telluric absorption """
+    return 3e4*np.exp(-0.5*((lbda-6000)/2500.)**2)
+
+def get_telluric_transmission(lbda):
+    """ """
+    return 1 - 0.5*np.exp(-0.5*((lbda-TELLURIC_REF_LBDA)/20.)**2)
+
+def get_science_image(traces, rng, xy_psf=[0,0], psf_sigma=1.5*TRACE_SPACING,
+                      jflexure=0, iflexure=0, ncosmics=500, exptime=300):
+    """
+    Returns
+    -------
+    image, cosmics (array [[x, y, flux], ...])
+    """
+    psf = np.exp(-0.5*((traces["dx"]-xy_psf[0])**2 + (traces["dy"]-xy_psf[1])**2)/psf_sigma**2)
+    def fluxfunc(i, lbda):
+        return (get_sky_spectrum(lbda) + psf[i]*get_star_spectrum(lbda)) * get_telluric_transmission(lbda)*exptime/300.
+
+    image = paint_traces(np.zeros(SEDM_CCD_SIZE[::-1]), traces, fluxfunc,
+                         jshift=jflexure, ishift=iflexure)
+    image = add_noise(image, rng)
+    # - Cosmic rays
+    cosmics = np.asarray([rng.randint(0, SEDM_CCD_SIZE[0], ncosmics),
+                          rng.randint(0, SEDM_CCD_SIZE[1], ncosmics),
+                          rng.uniform(1e3, 3e4, ncosmics)]).T
+    for x, y, flux in cosmics:
+        image[int(y), int(x)] += flux
+        if flux > 1e4 and x+1 < SEDM_CCD_SIZE[0]:
+            image[int(y), int(x)+1] += flux/3.
+
+    return image, cosmics
+
+def get_header(name, date, index, imgtype="science", exptime=None):
+    """ minimal SEDM-like header """
+    from astropy.time import Time
+    mjd = Time("%s-%s-%sT05:00:00"%(date[:4], date[4:6], date[6:]), format="isot").mjd + index*600/86400.
+    time_ = Time(mjd, format="mjd")
+    header = fits.Header()
+    header["OBJECT"]   = name if imgtype!="science" else "%s [A]"%name
+    header["NAME"]     = name
+    header["IMGTYPE"]  = imgtype
+    header["CAM_NAME"] = "IFU"
+    header["EXPTIME"]  = exptime if exptime is not None else (180 if imgtype=="dome" else 60)
+    header["AIRMASS"]  = 1.1
+    header["MJD_OBS"]  = time_.mjd
+    header["JD"]       = time_.jd
+    header["OBSDATE"]  = time_.isot.split("T")[0]
+    header["OBSTIME"]  = time_.isot.split("T")[1]
+    header["RA"]       = "12:00:00.000"
+    header["DEC"]      = "+30:00:00.00"
+    header["OBJRA"]    = "12:00:00.000"
+    header["OBJDEC"]   = "+30:00:00.00"
+    header["TEL_PA"]   = 0.
+    header["QUALITY"]  = 0
+    header["SYNTHETC"] = (True, "pysedm.bench synthetic frame")
+    return header
+
+def write_ccd(filename, data, header):
+    """ """
+    fits.PrimaryHDU(np.asarray(data, dtype="float32"), header).writeto(filename, overwrite=True)
@@ -3,19 +3,24 @@
 
 """
 This module is to remove cosmic ray spaxels in the SEDM datacube.
+-v20261018: numpy arrays (neighbor table, running median, all wavelengths at once) instead of pandas loops.
 -v20220705: change 'pd.append' > 'pd.concat'. And 'is'> '=='.
 -v20201218-1221: add "show_cr_spaxels".
 -v20201110.
 """
 
+import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as mpl
-from shapely.geometry import Point
 
 from . import sedm
 from . import io
 
+CR_INFO_COLUMNS = ["cr_spaxel_index", "cr_spaxel_id", "cr_lbda", "cr_lbda_index", "cr_diff_norm_sigma",
+                   "test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
+                   "nei_norm_mean", "nei_norm_mean_err"]
+
 def get_cr_spaxels_from_byecr(date, targetid):
     """
     Parameters
@@ -32,6 +37,40 @@ def get_cr_spaxels_from_byecr(date, targetid):
 
     return SEDM_BYECR.from_sedmid(date, targetid)
 
+
+def get_running_median(data, halfwindow=10):
+    """
+    Median of `data` within [i-halfwindow, i+halfwindow] along the first axis.
+    The window is truncated at the edges.
+
+    Parameters
+    ----------
+    data: 2d-array
+        (nlbda, nspaxels) array, e.g. cube.data
+    halfwindow: int
+        half size of the running window (10 means 21 slices).
+
+    Return
+    ----------
+    array (same shape as data)
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    data = np.asarray(data)
+    nlbda = len(data)
+    width = 2*halfwindow + 1
+    median = np.empty(data.shape, dtype="float")
+    if nlbda >= width:
+        median[halfwindow:nlbda-halfwindow] = np.median(sliding_window_view(data, width, axis=0), axis=-1)
+        edges = list(range(halfwindow)) + list(range(nlbda-halfwindow, nlbda))
+    else:
+        edges = range(nlbda)
+
+    for i in edges:
+        median[i] = np.median(data[max(0, i-halfwindow):i+halfwindow+1], axis=0)
+
+    return median
+
 ####################
 #                  #
 #   CLASS          #
@@ -50,6 +89,7 @@ class SEDM_BYECR():
 
         self.set_hexagrid(date)
         self.set_normalized_cube()
+        self.set_spatial_neighbors()
 
         self.derived_df = self.get_spatial_neighbors_indexes().reset_index()
 
@@ -73,7 +113,7 @@ class SEDM_BYECR():
         """ NEED date_HexaGrid.pkl file. """
         self.hexagrid = io.load_nightly_hexagonalgrid(date)
 
-    def set_normalized_cube(self):
+    def set_normalized_cube(self, halfwindow=10):
         """
         Normalize every spaxel in a slice with same spaxels in -10 +10 slices.
 
@@ -82,33 +122,10 @@ class SEDM_BYECR():
         normalized cube data and error (not variance).
         """
 
-        #normalized_cube_data = np.empty( [self.cube.data.shape[0], self.cube.data.shape[1]])
-        #normalized_cube_err = np.empty( [self.cube.data.shape[0], self.cube.data.shape[1]])
-
-        cube_data_df = pd.DataFrame(self.cube.data, index=['lbda'+str(i) for i in range(0, self.cube.data.shape[0])]).T
-        cube_var_df = pd.DataFrame(self.cube.variance, index=['lbda'+str(i) for i in range(0, self.cube.data.shape[0])]).T
-        _lbda_num = len(self.cube.lbda)
-
-        norm_cube_data_df = cube_data_df.copy()
-        norm_cube_err_df = cube_var_df.copy()
-
-        for _lbda_index in range(0, _lbda_num):
-
-            if _lbda_index < 10:
-                _median = np.median(cube_data_df.iloc[:, 0:_lbda_index+11], axis=1)
-                norm_cube_data_df["lbda"+str(_lbda_index)] = cube_data_df.iloc[:, _lbda_index] / _median
-                norm_cube_err_df["lbda"+str(_lbda_index)] = np.sqrt(cube_var_df.iloc[:, _lbda_index]) / _median
-            elif 209 < _lbda_index:
-                _median = np.median(cube_data_df.iloc[:, _lbda_index-10:_lbda_num], axis=1)
-                norm_cube_data_df["lbda"+str(_lbda_index)] = cube_data_df.iloc[:, _lbda_index] / _median
-                norm_cube_err_df["lbda"+str(_lbda_index)] = np.sqrt(cube_var_df.iloc[:, _lbda_index]) / _median
-            else:
-                _median = np.median(cube_data_df.iloc[:, _lbda_index-10:_lbda_index+11], axis=1)
-                norm_cube_data_df["lbda"+str(_lbda_index)] = cube_data_df.iloc[:, _lbda_index] / _median
-                norm_cube_err_df["lbda"+str(_lbda_index)] = np.sqrt(cube_var_df.iloc[:, _lbda_index]) / _median
+        _median = get_running_median(self.cube.data, halfwindow=halfwindow)
 
-        self.norm_cube_data = norm_cube_data_df.T.values
-        self.norm_cube_err = norm_cube_err_df.T.values
+        self.norm_cube_data = self.cube.data / _median
+        self.norm_cube_err = np.sqrt(self.cube.variance) / _median
 
         from pyifu import spectroscopy
 
@@ -117,6 +134,18 @@ class SEDM_BYECR():
                                                spaxel_mapping=self.cube.spaxel_mapping,
                                                spaxel_vertices=self.cube.spaxel_vertices)
 
+    def set_spatial_neighbors(self):
+        """
+        Build the (n, 6) table of the spatial neighbors once.
+        Only consider a spaxel witch has 6 neighbors to remove a spaxel at the edge of SEDM datacube.
+        """
+
+        _neighbors = [self.hexagrid.get_idx_neighbors(_test_index) for _test_index in range(0, self.cube.nspaxels)]
+        _flag_full = np.asarray([len(_n) == 6 for _n in _neighbors], dtype="bool")
+
+        self.spaxel_indexes = np.arange(self.cube.nspaxels)[_flag_full]
+        self.neighbors = np.asarray([_n for _n, _f in zip(_neighbors, _flag_full) if _f], dtype="int").reshape(-1, 6)
+
 
     #
     # GETTER
@@ -125,96 +154,109 @@ class SEDM_BYECR():
     def get_spatial_neighbors_indexes(self):
         """ Only consider a spaxel witch has 6 neighbors to remove a spaxel at the edge of SEDM datacube."""
 
-        _p_list = []
+        return pd.DataFrame(self.neighbors, index=self.spaxel_indexes,
+                            columns=[f"nei{i+1}" for i in range(6)])
+
+    def get_spatial_sigma(self, lbda_index=None, wspectral=False):
+        """
+        Compare every spaxel having 6 neighbors with its neighbors, for all the given wavelengths at once.
+
+        Parameters
+        ----------
+        lbda_index: int, list or None.
+            wavelength index(es) to test. 'None' means all of them.
+        wspectral: bool.
+            also compare with the two spectral neighbors (see get_spectral_neighbors_info).
+
+        Return
+        ----------
+        dict of (nlbda_index, nspaxels_tested) arrays, named as the derived_df columns.
+        """
+        if lbda_index is None:
+            lbda_index = np.arange(len(self.cube.lbda))
+        lbda_index = np.atleast_1d(np.asarray(lbda_index, dtype="int"))
+
+        _flux = self.norm_cube_data[lbda_index]
+        _err = self.norm_cube_err[lbda_index]
+
+        _nei_flux = _flux[:, self.neighbors]
+        _nei_err = _err[:, self.neighbors]
+
+        out = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            # NaN are skipped, as pandas' mean/std were.
+            out["nei_norm_mean"] = np.nanmean(_nei_flux, axis=-1)
+            out["nei_norm_std"] = np.nanstd(_nei_flux, axis=-1)
+        out["nei_norm_mean_err"] = (1/6)*np.sqrt(np.sum(_nei_err**2, axis=-1))
 
-        for _test_index in range(0, self.cube.nspaxels):
+        out["test_spaxel_flux_norm"] = _flux[:, self.spaxel_indexes]
+        out["test_spaxel_flux_norm_err"] = _err[:, self.spaxel_indexes]
 
-            _neighbors_indexes = self.hexagrid.get_idx_neighbors(_test_index)
+        out["test_spaxel_norm_diff"] = out["test_spaxel_flux_norm"] - out["nei_norm_mean"]
+        out["test_spaxel_norm_diff_err"] = np.sqrt(out["test_spaxel_flux_norm_err"]**2 + out["nei_norm_mean_err"]**2)
+        out["test_spaxel_norm_diff_sigma"] = out["test_spaxel_norm_diff"] / out["test_spaxel_norm_diff_err"]
 
-            if len(_neighbors_indexes) == 6:
-                _neighbors_indexes_dict = {f"nei{i+1}": v for i, v in enumerate(_neighbors_indexes)}
-                #_p_list.append(pd.DataFrame({"test_spx":_test_index, **_neighbors_indexes_dict}, index=[_test_index] ))
-                _p_list.append(pd.DataFrame({**_neighbors_indexes_dict}, index=[_test_index] ))
+        if wspectral:
+            _nlbda = len(self.cube.lbda)
+            _spec1 = np.where(lbda_index == 0, 1, np.where(lbda_index == _nlbda-1, _nlbda-2, lbda_index-1))
+            _spec2 = np.where(lbda_index == 0, 2, np.where(lbda_index == _nlbda-1, _nlbda-3, lbda_index+1))
+
+            _spec_flux = np.stack([self.norm_cube_data[_spec1][:, self.spaxel_indexes],
+                                   self.norm_cube_data[_spec2][:, self.spaxel_indexes]], axis=-1)
+            _spec_err = np.stack([self.norm_cube_err[_spec1][:, self.spaxel_indexes],
+                                  self.norm_cube_err[_spec2][:, self.spaxel_indexes]], axis=-1)
+
+            for i in range(2):
+                out[f"spec_nei_flux{i+1}_norm"] = _spec_flux[..., i]
+                out[f"spec_nei_flux{i+1}_norm_err"] = _spec_err[..., i]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                out["spec_nei_mean"] = np.nanmean(_spec_flux, axis=-1)
+                out["spec_nei_std"] = np.nanstd(_spec_flux, axis=-1)
+            out["spec_nei_mean_err"] = (1/2)*np.sqrt(np.sum(_spec_err**2, axis=-1))
+
+            out["test_spaxel_spec_norm_diff"] = out["test_spaxel_flux_norm"] - out["spec_nei_mean"]
+            out["test_spaxel_spec_norm_diff_err"] = np.sqrt(out["test_spaxel_flux_norm_err"]**2 + out["spec_nei_mean_err"]**2)
+            out["test_spaxel_spec_norm_diff_sigma"] = out["test_spaxel_spec_norm_diff"] / out["test_spaxel_spec_norm_diff_err"]
 
-        return pd.concat(_p_list, sort=True)
+        return out
 
     def get_spatial_neighbors_info(self, lbda_index=0):
         """ """
-        #print("Run get_spatial_neighbors_info")
-
-        self.derived_df["flux1_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei1"]]
-        self.derived_df["flux1_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei1"]]
-        self.derived_df["flux2_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei2"]]
-        self.derived_df["flux2_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei2"]]
-        self.derived_df["flux3_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei3"]]
-        self.derived_df["flux3_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei3"]]
-        self.derived_df["flux4_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei4"]]
-        self.derived_df["flux4_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei4"]]
-        self.derived_df["flux5_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei5"]]
-        self.derived_df["flux5_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei5"]]
-        self.derived_df["flux6_norm"] = self.norm_cube_data[lbda_index][self.derived_df["nei6"]]
-        self.derived_df["flux6_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["nei6"]]
-
-        #self.derived_df["flux_norm_median"] = np.median(derived_df[["flux1_norm", "flux2_norm", "flux3_norm", "flux4_norm", "flux5_norm", "flux6_norm"]], axis=1)
-        #self.derived_df["flux_norm_mad"] = stats.median_absolute_deviation(derived_df[["flux1_norm", "flux2_norm", "flux3_norm", "flux4_norm", "flux5_norm", "flux6_norm"]], axis=1)
-
-        self.derived_df["nei_norm_mean"] = np.mean(self.derived_df[["flux1_norm", "flux2_norm", "flux3_norm", "flux4_norm", "flux5_norm", "flux6_norm"]], axis=1)
-        self.derived_df["nei_norm_std"] = np.std(self.derived_df[["flux1_norm", "flux2_norm", "flux3_norm", "flux4_norm", "flux5_norm", "flux6_norm"]], axis=1)
-        #self.derived_df["nei_norm_std_sqrtn"] = derived_df["nei_norm_std"] / np.sqrt(6) # number of neighbors = 6
-        self.derived_df["nei_norm_mean_err"] = (1/6)*np.sqrt(self.derived_df["flux1_norm_err"]**2 +
-                                                             self.derived_df["flux2_norm_err"]**2 +
-                                                             self.derived_df["flux3_norm_err"]**2 +
-                                                             self.derived_df["flux4_norm_err"]**2 +
-                                                             self.derived_df["flux5_norm_err"]**2 +
-                                                             self.derived_df["flux6_norm_err"]**2)
+        _sigma = self.get_spatial_sigma(lbda_index=lbda_index)
 
+        for i in range(6):
+            self.derived_df[f"flux{i+1}_norm"] = self.norm_cube_data[lbda_index][self.neighbors[:, i]]
+            self.derived_df[f"flux{i+1}_norm_err"] = self.norm_cube_err[lbda_index][self.neighbors[:, i]]
+
+        for key in ["nei_norm_mean", "nei_norm_std", "nei_norm_mean_err"]:
+            self.derived_df[key] = _sigma[key][0]
 
         return self.derived_df
 
     def get_spectral_neighbors_info(self, lbda_index=0):
         """ """
+        _sigma = self.get_spatial_sigma(lbda_index=lbda_index, wspectral=True)
 
-        #if lbda_index is 0:
-        if lbda_index == 0:
-            self.derived_df["spec_nei_flux1_norm"] = self.norm_cube_data[lbda_index+1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux1_norm_err"] = self.norm_cube_err[lbda_index+1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm"] = self.norm_cube_data[lbda_index+2][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm_err"] = self.norm_cube_err[lbda_index+2][self.derived_df["index"]]
-
-        #elif lbda_index is (len(self.cube.lbda)-1):
-        elif lbda_index == (len(self.cube.lbda)-1):
-            self.derived_df["spec_nei_flux1_norm"] = self.norm_cube_data[lbda_index-1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux1_norm_err"] = self.norm_cube_err[lbda_index-1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm"] = self.norm_cube_data[lbda_index-2][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm_err"] = self.norm_cube_err[lbda_index-2][self.derived_df["index"]]
-
-        else:
-            self.derived_df["spec_nei_flux1_norm"] = self.norm_cube_data[lbda_index-1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux1_norm_err"] = self.norm_cube_err[lbda_index-1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm"] = self.norm_cube_data[lbda_index+1][self.derived_df["index"]]
-            self.derived_df["spec_nei_flux2_norm_err"] = self.norm_cube_err[lbda_index+1][self.derived_df["index"]]
-
-        self.derived_df["spec_nei_mean"] = np.mean(self.derived_df[["spec_nei_flux1_norm", "spec_nei_flux2_norm"]], axis=1)
-        self.derived_df["spec_nei_std"] = np.std(self.derived_df[["spec_nei_flux1_norm", "spec_nei_flux2_norm"]], axis=1)
-        self.derived_df["spec_nei_mean_err"] = (1/2)*np.sqrt(self.derived_df["spec_nei_flux1_norm_err"]**2 +
-                                                             self.derived_df["spec_nei_flux2_norm_err"]**2)
+        for key in ["spec_nei_flux1_norm", "spec_nei_flux1_norm_err", "spec_nei_flux2_norm", "spec_nei_flux2_norm_err",
+                    "spec_nei_mean", "spec_nei_std", "spec_nei_mean_err"]:
+            self.derived_df[key] = _sigma[key][0]
 
         return self.derived_df
 
     def get_test_spaxel_info(self, lbda_index=0, wspectral=True):
         """ """
+        _sigma = self.get_spatial_sigma(lbda_index=lbda_index, wspectral=wspectral)
 
-        self.derived_df["test_spaxel_flux_norm"] = self.norm_cube_data[lbda_index][self.derived_df["index"]]#.byteswap().newbyteorder()
-        self.derived_df["test_spaxel_flux_norm_err"] = self.norm_cube_err[lbda_index][self.derived_df["index"]]#.byteswap().newbyteorder()
-
-        self.derived_df["test_spaxel_norm_diff"] = self.derived_df["test_spaxel_flux_norm"] - self.derived_df["nei_norm_mean"]
-        self.derived_df["test_spaxel_norm_diff_err"] = np.sqrt(self.derived_df["test_spaxel_flux_norm_err"]**2 + self.derived_df["nei_norm_mean_err"]**2)
-        self.derived_df["test_spaxel_norm_diff_sigma"] = self.derived_df["test_spaxel_norm_diff"] / self.derived_df["test_spaxel_norm_diff_err"]
-
+        _keys = ["test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
+                 "test_spaxel_norm_diff", "test_spaxel_norm_diff_err", "test_spaxel_norm_diff_sigma"]
         if wspectral:
-            self.derived_df["test_spaxel_spec_norm_diff"] = self.derived_df["test_spaxel_flux_norm"] - self.derived_df["spec_nei_mean"]
-            self.derived_df["test_spaxel_spec_norm_diff_err"] = np.sqrt(self.derived_df["test_spaxel_flux_norm_err"]**2 + self.derived_df["spec_nei_mean_err"]**2)
-            self.derived_df["test_spaxel_spec_norm_diff_sigma"] = self.derived_df["test_spaxel_spec_norm_diff"] / self.derived_df["test_spaxel_spec_norm_diff_err"]
+            _keys += ["test_spaxel_spec_norm_diff", "test_spaxel_spec_norm_diff_err", "test_spaxel_spec_norm_diff_sigma"]
+
+        for key in _keys:
+            self.derived_df[key] = _sigma[key][0]
 
         return self.derived_df
 
@@ -230,7 +272,7 @@ class SEDM_BYECR():
             'None' means run through whole lbda_index. Default.
         wspectral: bool.
             if you want to use a spectral filtering together with spatial one, put 'wspectral=True'.
-            But it is not yet validated.
+            But it is not yet validated (the selection remains the spatial one).
         cut_criteria: float.
             cut criteria values we want to use.
             Default is '5'.
@@ -242,93 +284,23 @@ class SEDM_BYECR():
 
         self.cut_criteria = cut_criteria
 
-        cr_info_df = pd.DataFrame(columns=["cr_spaxel_index", "cr_spaxel_id", "cr_lbda", "cr_lbda_index", "cr_diff_norm_sigma",
-                                           "test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
-                                           "nei_norm_mean", "nei_norm_mean_err"])
-
-        if lbda_index is not None: #for specific lbda_index to test
-
-            _lbda_index = lbda_index
-
-            self.get_spatial_neighbors_info(lbda_index=_lbda_index)
-            self.get_test_spaxel_info(lbda_index=_lbda_index, wspectral=False)
-
-            _cr_info_df = pd.DataFrame(columns=["cr_spaxel_index", "cr_lbda", "cr_lbda_index", "cr_diff_norm_sigma",
-                                                "test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
-                                                "nei_norm_mean", "nei_norm_mean_err"])
-
-            _cr_temp_df = self.derived_df[ abs(self.derived_df["test_spaxel_norm_diff_sigma"]) > self.cut_criteria ]
-
-            if len(_cr_temp_df) > 0:
-
-                _cr_info_df["cr_spaxel_index"] = _cr_temp_df["index"]
-                _cr_info_df["cr_spaxel_id"] = self.cube.indexes[_cr_info_df["cr_spaxel_index"]]
-                _cr_info_df["cr_lbda"] = self.cube.lbda[_lbda_index]
-                _cr_info_df["cr_lbda_index"] = _lbda_index
-                _cr_info_df["cr_diff_norm_sigma"] = _cr_temp_df["test_spaxel_norm_diff_sigma"]
-                _cr_info_df["test_spaxel_flux_norm"] = _cr_temp_df["test_spaxel_flux_norm"]
-                _cr_info_df["test_spaxel_flux_norm_err"] = _cr_temp_df["test_spaxel_flux_norm_err"]
-                _cr_info_df["nei_norm_mean"] = _cr_temp_df["nei_norm_mean"]
-                _cr_info_df["nei_norm_mean_err"] = _cr_temp_df["nei_norm_mean_err"]
-
-                #cr_info_df = cr_info_df.append( _cr_info_df, ignore_index=True)
-                cr_info_df = pd.concat([cr_info_df, _cr_info_df], ignore_index=True)
-
-        else: #run whole lbda_index
-            for _lbda_index in range(0, len(self.cube.lbda)):
-
-                if wspectral:
-                    self.get_spatial_neighbors_info(lbda_index=_lbda_index)
-                    self.get_spectral_neighbors_info(lbda_index=_lbda_index)
-                    self.get_test_spaxel_info(lbda_index=_lbda_index, wspectral=True)
-
-                    _cr_info_df = pd.DataFrame(columns=["cr_spaxel_index", "cr_spaxel_id", "cr_lbda", "cr_lbda_index", "cr_diff_norm_sigma",
-                                                        "test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
-                                                        "nei_norm_mean", "nei_norm_mean_err"])
-
-                    _cr_temp_df = self.derived_df[ abs(self.derived_df["test_spaxel_norm_diff_sigma"]) > self.cut_criteria ]
-
-                    if len(_cr_temp_df) > 0:
-
-                        _cr_info_df["cr_spaxel_index"] = _cr_temp_df["index"]
-                        _cr_info_df["cr_spaxel_id"] = self.cube.indexes[_cr_info_df["cr_spaxel_index"]]
-                        _cr_info_df["cr_lbda"] = self.cube.lbda[_lbda_index]
-                        _cr_info_df["cr_lbda_index"] = _lbda_index
-                        _cr_info_df["cr_diff_norm_sigma"] = _cr_temp_df["test_spaxel_norm_diff_sigma"]
-                        _cr_info_df["test_spaxel_flux_norm"] = _cr_temp_df["test_spaxel_flux_norm"]
-                        _cr_info_df["test_spaxel_flux_norm_err"] = _cr_temp_df["test_spaxel_flux_norm_err"]
-                        _cr_info_df["nei_norm_mean"] = _cr_temp_df["nei_norm_mean"]
-                        _cr_info_df["nei_norm_mean_err"] = _cr_temp_df["nei_norm_mean_err"]
-
-                        #cr_info_df = cr_info_df.append( _cr_info_df, ignore_index=True)
-                        cr_info_df = pd.concat([cr_info_df, _cr_info_df], ignore_index=True)
-
-                else: # wspectral=False, default
-                    self.get_spatial_neighbors_info(lbda_index=_lbda_index)
-                    self.get_test_spaxel_info(lbda_index=_lbda_index, wspectral=False)
-
-                    _cr_info_df = pd.DataFrame(columns=["cr_spaxel_index", "cr_spaxel_id", "cr_lbda", "cr_lbda_index", "cr_diff_norm_sigma",
-                                                        "test_spaxel_flux_norm", "test_spaxel_flux_norm_err",
-                                                        "nei_norm_mean", "nei_norm_mean_err"])
-
-                    _cr_temp_df = self.derived_df[ abs(self.derived_df["test_spaxel_norm_diff_sigma"]) > self.cut_criteria ]
-
-                    if len(_cr_temp_df) > 0:
-
-                        _cr_info_df["cr_spaxel_index"] = _cr_temp_df["index"]
-                        _cr_info_df["cr_spaxel_id"] = self.cube.indexes[_cr_info_df["cr_spaxel_index"]]
-                        _cr_info_df["cr_lbda"] = self.cube.lbda[_lbda_index]
-                        _cr_info_df["cr_lbda_index"] = _lbda_index
-                        _cr_info_df["cr_diff_norm_sigma"] = _cr_temp_df["test_spaxel_norm_diff_sigma"]
-                        _cr_info_df["test_spaxel_flux_norm"] = _cr_temp_df["test_spaxel_flux_norm"]
-                        _cr_info_df["test_spaxel_flux_norm_err"] = _cr_temp_df["test_spaxel_flux_norm_err"]
-                        _cr_info_df["nei_norm_mean"] = _cr_temp_df["nei_norm_mean"]
-                        _cr_info_df["nei_norm_mean_err"] = _cr_temp_df["nei_norm_mean_err"]
-
-                        #cr_info_df = cr_info_df.append( _cr_info_df, ignore_index=True)
-                        cr_info_df = pd.concat([cr_info_df, _cr_info_df], ignore_index=True)
+        _lbda_indexes = np.arange(len(self.cube.lbda)) if lbda_index is None else np.atleast_1d(int(lbda_index))
+        _sigma = self.get_spatial_sigma(lbda_index=_lbda_indexes, wspectral=wspectral and lbda_index is None)
 
+        with np.errstate(invalid="ignore"):
+            _ilbda, _ispaxel = np.where( np.abs(_sigma["test_spaxel_norm_diff_sigma"]) > self.cut_criteria )
 
+        cr_spaxel_index = self.spaxel_indexes[_ispaxel]
+        cr_info_df = pd.DataFrame({"cr_spaxel_index": cr_spaxel_index,
+                                   "cr_spaxel_id": np.asarray(self.cube.indexes)[cr_spaxel_index],
+                                   "cr_lbda": np.asarray(self.cube.lbda)[_lbda_indexes[_ilbda]],
+                                   "cr_lbda_index": _lbda_indexes[_ilbda],
+                                   "cr_diff_norm_sigma": _sigma["test_spaxel_norm_diff_sigma"][_ilbda, _ispaxel],
+                                   "test_spaxel_flux_norm": _sigma["test_spaxel_flux_norm"][_ilbda, _ispaxel],
+                                   "test_spaxel_flux_norm_err": _sigma["test_spaxel_flux_norm_err"][_ilbda, _ispaxel],
+                                   "nei_norm_mean": _sigma["nei_norm_mean"][_ilbda, _ispaxel],
+                                   "nei_norm_mean_err": _sigma["nei_norm_mean_err"][_ilbda, _ispaxel]},
+                                  columns=CR_INFO_COLUMNS)
 
         dtype_dict = {"cr_spaxel_index": int, "cr_lbda": float, "cr_lbda_index": int, "cr_diff_norm_sigma": float,
                       "test_spaxel_flux_norm": float, "test_spaxel_flux_norm_err": float,
@@ -337,6 +309,23 @@ class SEDM_BYECR():
 
         return cr_info_df.sort_values(["cr_spaxel_index", "cr_lbda"])
 
+    def get_cr_cube(self, cut_criteria=5, cr_df=None):
+        """
+        Return a copy of the cube with the cosmic ray affected (spaxel, wavelength) set to NaN.
+        The header has the "NCR" and "NCRSPX" keywords.
+        """
+        if cr_df is None:
+            cr_df = self.get_cr_spaxel_info(cut_criteria=cut_criteria)
+
+        newdata = self.cube.data.copy()
+        newdata[cr_df["cr_lbda_index"].values, cr_df["cr_spaxel_index"].values] = np.nan
+
+        newheader = self.cube.header.copy()
+        newheader.set("NCR", len(cr_df), "total number of detected cosmic-rays from byecr")
+        newheader.set("NCRSPX", len(np.unique(cr_df["cr_spaxel_index"])), "total number of cosmic-ray affected spaxels")
+
+        return self.cube.get_new(newdata=newdata, newheader=newheader)
+
     #
     # SHOW
     #
@@ -0,0 +1,476 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Night calibration bundle.
+
+The nightly calibration products (TraceMatch, TraceMaskCache, WaveSolution, HexaGrid)
+are stored as flat .npy arrays within a single directory plus a small json manifest.
+Contrary to the pkl files, the arrays can be memory-mapped: loading a night is then almost instantaneous
+and parallel workers share the same pages instead of each holding a private copy.
+
+Bundle layout:
+   YYYYMMDD_CalibBundle/
+       manifest.json
+       tracematch_xys.npy, tracematch_vertices.npy, ...
+"""
+
+import os
+import json
+import numpy as np
+
+from propobject import BaseObject
+
+BUNDLE_FORMAT  = "pysedm-calibbundle"
+BUNDLE_VERSION = 2
+BUNDLE_NAME    = "%s_CalibBundle"
+
+__all__ = ["get_calibration_bundle", "load_calibration_bundle"]
+
+
+def load_calibration_bundle(dirname, mmap_mode="r"):
+    """ Load the night calibration bundle stored in the given directory.
+
+    Parameters
+    ----------
+    dirname: [string]
+        Path to the bundle directory (containing the manifest.json)
+
+    mmap_mode: [string or None] -optional-
+        numpy.load mmap_mode. If None the arrays are read in memory.
+
+    Returns
+    -------
+    CalibrationBundle
+    """
+    bundle = CalibrationBundle()
+    bundle.load(dirname, mmap_mode=mmap_mode)
+    return bundle
+
+def get_calibration_bundle(date, tracematch=None, tracemaskcache=None,
+                               wavesolution=None, hexagrid=None):
+    """ Build the calibration bundle of the given night.
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    tracematch, tracemaskcache, wavesolution, hexagrid: [objects or None] -optional-
+        nightly calibration objects to store. If None, they are loaded from their
+        pkl files if these exist (io.load_nightly_*).
+        Missing calibrations are simply not stored.
+
+    Returns
+    -------
+    CalibrationBundle
+    """
+    from . import io
+    sources = {}
+    datapath = io.get_datapath(date)
+    if tracematch is None:
+        for suffix, withmask in [["TraceMatch_WithMasks", True], ["TraceMatch", False]]:
+            filename = datapath+"%s_%s.pkl"%(date, suffix)
+            if os.path.isfile(filename):
+                tracematch = io.load_nightly_tracematch(date, withmask=withmask, use_bundle=False)
+                sources["tracematch"] = filename
+                break
+
+    if tracemaskcache is None:
+        filename = datapath+"%s_TraceMaskCache.pkl"%date
+        if os.path.isfile(filename):
+            tracemaskcache = io.load_nightly_tracemaskcache(date, use_bundle=False)
+            sources["tracemaskcache"] = filename
+
+    if wavesolution is None:
+        filename = datapath+"%s_WaveSolution.pkl"%date
+        if os.path.isfile(filename):
+            wavesolution = io.load_nightly_wavesolution(date, use_bundle=False)
+            sources["wavesolution"] = filename
+
+    if hexagrid is None:
+        filename = datapath+"%s_HexaGrid.pkl"%date
+        if os.path.isfile(filename):
+            hexagrid = io.load_nightly_hexagonalgrid(date, download_it=False, use_bundle=False)
+            sources["hexagrid"] = filename
+
+    bundle = CalibrationBundle()
+    bundle.set_date(date)
+    if tracematch is not None:
+        bundle.set_tracematch(tracematch)
+    if tracemaskcache is not None:
+        bundle.set_tracemaskcache(tracemaskcache)
+    if wavesolution is not None:
+        bundle.set_wavesolution(wavesolution)
+    if hexagrid is not None:
+        bundle.set_hexagrid(hexagrid)
+
+    for k, filename in sources.items():
+        bundle.set_source(k, filename)
+
+    return bundle
+
+# ================== #
+#  Internal Tools    #
+# ================== #
+def _flatten_arrays_(arrays, dtype=None):
+    """ list of arrays -> concatenated array, offsets (len(arrays)+1) """
+    offsets = np.zeros(len(arrays)+1, dtype="int64")
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype), offsets
+    return np.concatenate([np.asarray(a) for a in arrays]).astype(dtype if dtype is not None else np.asarray(arrays[0]).dtype), offsets
+
+def _split_flatten_(flat, offsets):
+    """ inverse of _flatten_arrays_ (views on flat) """
+    return [flat[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)]
+
+
+class CalibrationBundle( BaseObject ):
+    """ Flat array storage of the nightly calibrations (see module docstring).
+
+    The arrays are stored in `arrays` (dict name->array) and the
+    scalar/metadata information in `manifest`.
+    """
+    PROPERTIES         = ["arrays", "manifest"]
+    SIDE_PROPERTIES    = ["dirname"]
+
+    # ================== #
+    #  Main Methods      #
+    # ================== #
+    # -------- #
+    #  I/O     #
+    # -------- #
+    def writeto(self, dirname):
+        """ Store the bundle in the given directory (created if needed).
+
+        The arrays are first written in a temporary directory which then replaces
+        the given one, so a reader never sees a partially written bundle.
+
+        Returns
+        -------
+        Void
+        """
+        import shutil
+        from datetime import datetime
+        from . import __version__
+
+        dirname = os.path.abspath(dirname)
+        tmpdir  = dirname+".tmp%d"%os.getpid()
+        os.makedirs(tmpdir, exist_ok=True)
+
+        manifest = dict(self.manifest)
+        manifest["format"]  = BUNDLE_FORMAT
+        manifest["version"] = BUNDLE_VERSION
+        manifest["pysedm"]  = __version__
+        manifest["created"] = datetime.utcnow().isoformat()
+        manifest["arrays"]  = {}
+        for name, array in self.arrays.items():
+            array = np.ascontiguousarray(array)
+            np.save(os.path.join(tmpdir, name+".npy"), array, allow_pickle=False)
+            manifest["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+
+        with open(os.path.join(tmpdir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        os.replace(tmpdir, dirname)
+        self._side_properties["dirname"] = dirname
+
+    def load(self, dirname, mmap_mode="r"):
+        """ Load a bundle created by writeto()
+
+        Parameters
+        ----------
+        dirname: [string]
+            bundle directory
+
+        mmap_mode: [string or None] -optional-
+            numpy.load mmap_mode. If None the arrays are read in memory.
+
+        Returns
+        -------
+        Void
+        """
+        with open(os.path.join(dirname, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        if manifest.get("format") != BUNDLE_FORMAT:
+            raise TypeError("%s is not a pysedm calibration bundle."%dirname)
+        if manifest.get("version", 0) > BUNDLE_VERSION:
+            raise TypeError("The bundle version (%s) is more recent than the one this pysedm can read (%s)"%(
+                manifest.get("version"), BUNDLE_VERSION))
+        if manifest.get("version", 0) < BUNDLE_VERSION:
+            raise TypeError("The bundle version (%s) is outdated (current %s), rebuild it (see build_calibration_bundle)"%(
+                manifest.get("version"), BUNDLE_VERSION))
+
+        self._properties["manifest"] = manifest
+        self._properties["arrays"]   = {name: np.load(os.path.join(dirname, name+".npy"), mmap_mode=mmap_mode,
+                                                          allow_pickle=False)
+                                        for name in manifest["arrays"].keys()}
+        self._side_properties["dirname"] = os.path.abspath(dirname)
+
+    # -------- #
+    #  SETTER  #
+    # -------- #
+    def set_date(self, date):
+        """ night of the calibrations (YYYYMMDD) """
+        self.manifest["date"] = date
+
+    def set_source(self, key, filename):
+        """ Records the file used to build the `key` calibration.
+        Its modification time is used to know if the bundle is outdated (see is_outdated())
+        """
+        if "sources" not in self.manifest:
+            self.manifest["sources"] = {}
+        self.manifest["sources"][key] = {"filename": os.path.basename(filename),
+                                         "mtime": os.path.getmtime(filename)}
+
+    def set_tracematch(self, tracematch):
+        """ Stores the trace lines, trace vertices and (if any) the trace masks of the given TraceMatch """
+        trace_indexes = np.asarray(tracematch.trace_indexes)
+        vertices, offsets = _flatten_arrays_([tracematch.trace_vertices[i_] for i_ in trace_indexes], dtype="float64")
+        self.arrays["tracematch_indexes"]          = trace_indexes
+        self.arrays["tracematch_xys"]              = np.asarray(tracematch._xys, dtype="float64")
+        self.arrays["tracematch_vertices"]         = vertices
+        self.arrays["tracematch_vertices_offsets"] = offsets
+        self.manifest["tracematch"] = {"width": float(tracematch.width)}
+
+        # - Masks
+        mask_indexes = np.asarray([i_ for i_ in trace_indexes if i_ in tracematch.trace_masks.keys()])
+        if len(mask_indexes) > 0:
+            from scipy import sparse
+            from .spectralmatching import TraceMaskCache
+            trace, j, i, weight = TraceMaskCache._masks_to_weights_([tracematch.trace_masks[i_] for i_ in mask_indexes])
+            trace, j, i   = [np.asarray(k_, dtype="int64") for k_ in [trace, j, i]]
+            height, width = tracematch.trace_masks[mask_indexes[0]].shape
+            ntraces = len(mask_indexes)
+            # The sparse matrices are stored in their final CSR form (and index dtype)
+            # such that get_tracematch() wraps the memory-mapped arrays without copy.
+            stacked = sparse.csr_matrix((weight, (trace*height+j, i)), shape=(ntraces*height, width))
+            stacked.sort_indices()
+            rowstart = stacked.indptr[:-1].reshape(ntraces, height)
+            self.arrays["tracemask_indexes"] = mask_indexes
+            self.arrays["tracemask_data"]    = stacked.data
+            self.arrays["tracemask_indices"] = stacked.indices
+            self.arrays["tracemask_offsets"] = stacked.indptr[::height]
+            self.arrays["tracemask_indptr"]  = np.concatenate([rowstart, stacked.indptr[height::height][:,None]],
+                                                              axis=1) - rowstart[:,:1]
+            operator = sparse.csr_matrix((weight, (trace*width+i, j*width+i)), shape=(ntraces*width, height*width))
+            operator.sort_indices()
+            self.arrays["extraction_data"]    = operator.data
+            self.arrays["extraction_indices"] = operator.indices
+            self.arrays["extraction_indptr"]  = operator.indptr
+            self.manifest["tracematch"]["shape"] = [height, width]
+
+    def set_tracemaskcache(self, tracemaskcache):
+        """ Stores the j-shift grid of trace weights of the given TraceMaskCache """
+        self.arrays["maskcache_indexes"] = np.asarray(tracemaskcache.trace_indexes)
+        self.arrays["maskcache_jshifts"] = np.asarray(tracemaskcache.jshifts, dtype="float64")
+        for k, name in enumerate(["trace", "j", "i", "weight"]):
+            flat, offsets = _flatten_arrays_([w_[k] for w_ in tracemaskcache.weights])
+            self.arrays["maskcache_%s"%name] = flat
+        self.arrays["maskcache_offsets"] = offsets
+        self.manifest["tracemaskcache"] = {"width": float(tracemaskcache.width),
+                                           "shape": list(tracemaskcache.shape)}
+
+    def set_wavesolution(self, wavesolution):
+        """ Stores the polynomial coefficients, inverse lookup table and fitted lines of the given WaveSolution """
+        traceindexes = np.sort(wavesolution.traceindexes)
+        polycoefs    = wavesolution._get_polycoefs_() # also builds the inverse table
+        table        = wavesolution._inversetable
+        self.arrays["wavesolution_indexes"]        = traceindexes
+        self.arrays["wavesolution_polycoefs"]      = polycoefs
+        self.arrays["wavesolution_inverse_lbda"]   = table["lbda"]
+        self.arrays["wavesolution_inverse_pixels"] = table["pixels"]
+        self.arrays["wavesolution_inverse_sign"]   = table["sign"]
+
+        # - Fitted lines (padded with NaN) for the residual statistics
+        datas  = [wavesolution.wavesolutions[i_] for i_ in traceindexes]
+        nlines = np.max([len(d_["usedlines"]) for d_ in datas])
+        for key in ["usedlines", "fit_linepos", "fit_linepos.err"]:
+            values = np.zeros((len(datas), nlines))*np.NaN
+            for k, d_ in enumerate(datas):
+                values[k,:len(d_[key])] = d_[key]
+            self.arrays["wavesolution_%s"%key.replace(".","_")] = values
+
+        self.arrays["wavesolution_databounds"] = np.asarray([d_.get("databounds", [np.NaN, np.NaN])
+                                                            if d_.get("databounds") is not None else [np.NaN, np.NaN]
+                                                            for d_ in datas], dtype="float64")
+        self.manifest["wavesolution"] = {"lampname": [str(l_) for l_ in datas[0]["lampname"]]}
+
+    def set_hexagrid(self, hexagrid):
+        """ Stores the ids, (Q,R) coordinates and neighbors of the given HexagoneProjection """
+        self.arrays["hexagrid_ids"] = np.asarray(hexagrid.index_ids)
+        self.arrays["hexagrid_qr"]  = np.asarray([qr_ if qr_ is not None else [np.NaN, np.NaN]
+                                                  for qr_ in hexagrid.hexgrid], dtype="float64")
+        neighbors, offsets = _flatten_arrays_(hexagrid.neighbors, dtype="int64")
+        self.arrays["hexagrid_neighbors"]         = neighbors
+        self.arrays["hexagrid_neighbors_offsets"] = offsets
+        self.manifest["hexagrid"] = {"qdistance": float(hexagrid.qdistance) if hexagrid.qdistance is not None else None,
+                                     "ref_idx": [int(i_) for i_ in hexagrid.ref_idx] if hexagrid.ref_idx is not None else None}
+
+    # -------- #
+    #  GETTER  #
+    # -------- #
+    def has(self, key):
+        """ Test if the bundle contains the given calibration
+        (tracematch, tracemask, tracemaskcache, wavesolution or hexagrid) """
+        return "%s_indexes"%key in self.arrays or "%s_ids"%key in self.arrays or \
+          (key=="tracemaskcache" and "maskcache_indexes" in self.arrays)
+
+    def is_outdated(self, datapath=None):
+        """ Test if any of the files used to build the bundle has been modified since.
+        Source files that do not exist (anymore) are ignored.
+
+        Parameters
+        ----------
+        datapath: [string] -optional-
+            directory of the source files. If None, the directory containing the bundle.
+        """
+        if datapath is None:
+            datapath = os.path.dirname(self.dirname)
+        for source in self.manifest.get("sources", {}).values():
+            filename = os.path.join(datapath, source["filename"])
+            if os.path.isfile(filename) and os.path.getmtime(filename) > source["mtime"]:
+                return True
+        return False
+
+    def get_tracematch(self, withmask=True):
+        """ TraceMatch built from the stored arrays (no Shapely buffering)
+
+        Parameters
+        ----------
+        withmask: [bool] -optional-
+            Shall the stored trace masks (and the associated extraction operator) be attached?
+
+        Returns
+        -------
+        TraceMatch
+        """
+        from .spectralmatching import TraceMatch
+        if not self.has("tracematch"):
+            raise AttributeError("No tracematch stored in this bundle.")
+
+        trace_indexes = self.arrays["tracematch_indexes"]
+        tmatch = TraceMatch()
+        tmatch.set_trace_geometry(self.arrays["tracematch_xys"],
+                                  _split_flatten_(self.arrays["tracematch_vertices"],
+                                                  self.arrays["tracematch_vertices_offsets"]),
+                                  width=self.manifest["tracematch"]["width"],
+                                  trace_indexes=trace_indexes)
+        if withmask and self.has("tracemask"):
+            from scipy import sparse
+            height, width = self.manifest["tracematch"]["shape"]
+            mask_indexes  = self.arrays["tracemask_indexes"]
+            data, indices, offsets, indptr = [self.arrays["tracemask_%s"%k] for k in ["data", "indices", "offsets", "indptr"]]
+            # views on the (memory-mapped) arrays: the masks are shared between processes.
+            masks = [sparse.csr_matrix((data[offsets[k]:offsets[k+1]], indices[offsets[k]:offsets[k+1]], indptr[k]),
+                                       shape=(height, width), copy=False)
+                     for k in range(len(mask_indexes))]
+            tmatch.set_trace_masks(masks, list(mask_indexes))
+            tmatch._derived_properties["extraction_operator"] = sparse.csr_matrix(
+                (self.arrays["extraction_data"], self.arrays["extraction_indices"], self.arrays["extraction_indptr"]),
+                shape=(len(mask_indexes)*width, height*width), copy=False)
+            tmatch._derived_properties["extraction_indexes"]  = mask_indexes
+
+        return tmatch
+
+    def get_tracemaskcache(self):
+        """ TraceMaskCache built from the stored arrays
+
+        Returns
+        -------
+        TraceMaskCache
+        """
+        from .spectralmatching import TraceMaskCache
+        if not self.has("tracemaskcache"):
+            raise AttributeError("No tracemaskcache stored in this bundle.")
+
+        offsets = self.arrays["maskcache_offsets"]
+        weights = list(zip(*[_split_flatten_(self.arrays["maskcache_%s"%k], offsets)
+                                 for k in ["trace", "j", "i", "weight"]]))
+        cache = TraceMaskCache()
+        cache._properties["trace_indexes"] = self.arrays["maskcache_indexes"]
+        cache._properties["jshifts"]       = self.arrays["maskcache_jshifts"]
+        cache._properties["width"]         = self.manifest["tracemaskcache"]["width"]
+        cache._properties["shape"]         = tuple(self.manifest["tracemaskcache"]["shape"])
+        cache._properties["weights"]       = weights
+        return cache
+
+    def get_wavesolution(self):
+        """ WaveSolution built from the stored arrays.
+        The per-trace line fit details (line_fitvalues) are not stored.
+
+        Returns
+        -------
+        WaveSolution
+        """
+        from .wavesolution import WaveSolution
+        if not self.has("wavesolution"):
+            raise AttributeError("No wavesolution stored in this bundle.")
+
+        traceindexes = self.arrays["wavesolution_indexes"]
+        polycoefs    = self.arrays["wavesolution_polycoefs"]
+        lampname     = self.manifest["wavesolution"]["lampname"]
+        wsol = WaveSolution()
+        for k, i_ in enumerate(traceindexes):
+            nlines = np.sum(np.isfinite(self.arrays["wavesolution_usedlines"][k]))
+            wsol.wavesolutions[int(i_)] = {"lampname": lampname,
+                                      "usedlines": self.arrays["wavesolution_usedlines"][k,:nlines],
+                                      "fit_linepos": self.arrays["wavesolution_fit_linepos"][k,:nlines],
+                                      "fit_linepos.err": self.arrays["wavesolution_fit_linepos_err"][k,:nlines],
+                                      "wavesolution": polycoefs[k],
+                                      "line_fitvalues": None,
+                                      "databounds": self.arrays["wavesolution_databounds"][k]}
+
+        wsol.set_polynomial_array(polycoefs, [int(i_) for i_ in traceindexes],
+                                  {"lbda": self.arrays["wavesolution_inverse_lbda"],
+                                   "pixels": self.arrays["wavesolution_inverse_pixels"],
+                                   "sign": self.arrays["wavesolution_inverse_sign"]})
+        return wsol
+
+    def get_hexagrid(self):
+        """ HexagoneProjection built from the stored arrays
+
+        Returns
+        -------
+        HexagoneProjection
+        """
+        from .utils.hexagrid import HexagoneProjection
+        if not self.has("hexagrid"):
+            raise AttributeError("No hexagrid stored in this bundle.")
+
+        hexagrid = HexagoneProjection(None, empty=True)
+        hexagrid.set_neighbors(_split_flatten_(self.arrays["hexagrid_neighbors"],
+                                               self.arrays["hexagrid_neighbors_offsets"]))
+        hexagrid.set_hexgrid(np.asarray([None if np.any(np.isnan(qr_)) else list(qr_.astype("int"))
+                                         for qr_ in np.asarray(self.arrays["hexagrid_qr"])] + [None], dtype=object)[:-1])
+        hexagrid.set_ids(self.arrays["hexagrid_ids"])
+        hexagrid.set_qdistance(self.manifest["hexagrid"]["qdistance"])
+        if self.manifest["hexagrid"]["ref_idx"] is not None:
+            # hexgrid already set, only the reference and grid angle are needed.
+            hexagrid.set_grid_reference(*self.manifest["hexagrid"]["ref_idx"])
+        return hexagrid
+
+    # ================== #
+    #  Properties        #
+    # ================== #
+    @property
+    def arrays(self):
+        """ dictionary containing the (possibly memory-mapped) arrays """
+        if self._properties["arrays"] is None:
+            self._properties["arrays"] = {}
+        return self._properties["arrays"]
+
+    @property
+    def manifest(self):
+        """ dictionary containing the bundle metadata """
+        if self._properties["manifest"] is None:
+            self._properties["manifest"] = {}
+        return self._properties["manifest"]
+
+    @property
+    def dirname(self):
+        """ directory of the bundle (if written or loaded) """
+        return self._side_properties["dirname"]
@@ -73,10 +73,12 @@ def get_ccd(lampfile, ccdspec_mask=None,
         if correct_traceflexure:
             from .flexure import get_ccd_jflexure
             from .sedm    import TRACE_DISPERSION
+            from .utils   import timing
             # Save the flexure plot
-            j_offset = get_ccd_jflexure(lamp, ntraces=200, tracewidth=1,
-                                        jscan=[-2.5, 2.5, 10] if jscan is None else jscan,
-                                savefile=savefile_traceflexure, get_object=False)
+            with timing.stage("traceflexure"):
+                j_offset = get_ccd_jflexure(lamp, ntraces=200, tracewidth=1,
+                                            jscan=[-2.5, 2.5, 51] if jscan is None else jscan,
+                                    savefile=savefile_traceflexure, get_object=False)
 
             new_tracematch = lamp.tracematch.get_shifted_tracematch(0, j_offset)
             new_tracematch.set_buffer( TRACE_DISPERSION)
@@ -435,6 +437,48 @@ class CCD( BaseCCD ):
         maskidx  = self.get_trace_mask(traceindex, finetune=finetune)
         return np.sum(eval("self.%s"%on)*maskidx, axis=0)
 
+    def get_spectra(self, traceindexes, on="data"):
+        """ Get the basic spectra of several traces at once.
+
+        This uses the sparse extraction operator of the TraceMatch
+        (see tracematch.get_extraction_operator()), such that the extraction of
+        all the traces is a single sparse matrix-vector product.
+        (finetuned traces are not available in this mode, see get_spectrum())
+
+        Parameters
+        ----------
+        traceindexes: [list of int]
+            indexes of the spectra to return
+
+        on: [str] -optional-
+            on which 2d image shall the spectra be extracted.
+            By Default 'data', but you can set e.g. rawdata, background
+            or anything accessible as 'self.%s'%on.
+
+        Returns
+        -------
+        2d-array (ntraces, ccd-width): flux as a function of pixels
+        """
+        if not self.has_tracematch():
+            raise AttributeError("The TraceMatch has not been set. see set_tracematch() ")
+
+        operator = self.tracematch.get_extraction_operator(traceindexes, shape=self.shape)
+        return operator.dot( np.ravel(eval("self.%s"%on)) ).reshape(len(traceindexes), self.shape[1])
+
+    def get_pixel_spectra(self, traceindexes):
+        """ flux and variance per pixels of the given traces (see get_spectra()).
+        This is the ccd information used by extract_cube(), so the returned 
+        dictionary could be given to extract_cube() to build several cubes 
+        (e.g. with different pixel_shift) without reading the ccd again. 
+
+        Returns
+        -------
+        dict {"data": {traceindex: flux}, "var": {traceindex: variance} (None if no variance)}
+        """
+        return {"data": {i_:f_ for i_,f_ in zip(traceindexes, self.get_spectra(traceindexes, on="data"))},
+                "var":  {i_:v_ for i_,v_ in zip(traceindexes, self.get_spectra(traceindexes, on="var"))} \
+                           if self.has_var() else None}
+
     def get_xslice(self, i, on="data"):
         """ build a `CCDSlice` based on the ith-column.
 
@@ -468,9 +512,10 @@ class CCD( BaseCCD ):
             self.set_background(self._background.background, force_it=True)
 
 
-    def fetch_background(self, set_it=True, build_if_needed=True, ncore=None, **kwargs):
+    def fetch_background(self, set_it=True, build_if_needed=True, ncore=None, dtype=None, **kwargs):
         """ 
         ncore is used only if build_background() is called.
+        dtype (e.g. 'float32') is the dtype of the evaluated background image (default float64).
         """
         from .background import load_background
         from .io import filename_to_background_name
@@ -488,10 +533,11 @@ class CCD( BaseCCD ):
 
         self._background = load_background( filename_to_background_name( self.filename ))
         if set_it:
-            self.set_background( self._background.background, force_it=True)
+            self.set_background( self._background.get_background(dtype=dtype), force_it=True)
 
     def extract_spectrum(self, traceindex, wavesolution, lbda=None, kind="cubic",
-                             get_spectrum=True, pixel_shift=0.):
+                             get_spectrum=True, pixel_shift=0.,
+                             flux=None, variance=None, lbdapixels=None):
         """ Build the `traceindex` spectrum based on the given wavelength solution.
         The returned object could be an pyifu's Spectrum or three arrays, lbda, flux, variance.
 
@@ -526,23 +572,32 @@ class CCD( BaseCCD ):
         get_spectrum: [bool] -optional-
             Which form the returned data should have?
 
-        finetune: [bool] -optional-
-            Should the trace masking come from finetunning of spectral trace?
-            (Remark: The spectral match loaded might already be a finetuned ones.)
+        flux, variance: [array/None] -optional-
+            flux (and variance) per pixels of the trace, if already extracted
+            (see get_spectra()). If None, this uses get_spectrum().
+
+        lbdapixels: [array/None] -optional-
+            pixels corresponding to the given `lbda` for this trace, if already
+            converted (see WaveSolution.get_lbda_to_pixels()). `pixel_shift` is not
+            applied to it. If None, this uses wavesolution.lbda_to_pixels().
 
         Returns
         -------
         Spectrum or
         array, array, array/None (lbda, flux, variance)
         """
-        f = self.get_spectrum(traceindex, finetune=False)
-        v = self.get_spectrum(traceindex, finetune=False, on="var") if self.has_var() else None
+        f = self.get_spectrum(traceindex, finetune=False) if flux is None else flux
+        if variance is not None:
+            v = variance
+        else:
+            v = self.get_spectrum(traceindex, finetune=False, on="var") if self.has_var() else None
         pixs = np.arange(len(f))[::-1]
         minpix, maxpix = self.tracematch.get_trace_xbounds(traceindex)
         mask = pixs[(pixs>minpix)* (pixs<maxpix)][::-1]
         if lbda is not None:
             from scipy.interpolate     import interp1d
-            pxl_wanted = wavesolution.lbda_to_pixels(lbda, traceindex) + pixel_shift
+            pxl_wanted = wavesolution.lbda_to_pixels(lbda, traceindex) + pixel_shift \
+              if lbdapixels is None else lbdapixels
             flux = interp1d(pixs[mask], f[mask], kind=kind)(pxl_wanted)
             var  = interp1d(pixs[mask], v[mask], kind=kind)(pxl_wanted) if v is not None else v
         else:
@@ -562,7 +617,7 @@ class CCD( BaseCCD ):
     # --------------- #
     def extract_cube(self, wavesolution, lbda,
                          hexagrid=None, traceindexes=None, show_progress=False,
-                         pixel_shift=0., rotation=None):
+                         pixel_shift=0., rotation=None, pixelspectra=None):
         """ Create a cube from the ccd.
 
         ------------------------------------
@@ -570,11 +625,11 @@ class CCD( BaseCCD ):
         ------------------------------------
 
         The method works as follow (see the extract_spectrum() method):
-        for each trace (loop object traceindexes)
-        1) Get the flux per pixels [using the get_spectrum() method]
+        1) Get the flux per pixels of every traces at once [using the get_spectra() method]
            (Get the variance the same way if any)
-        2) Convert the given lbda into pixels
-           [using the lbda_to_pixels() method from wavesolution]
+        2) Convert the given lbda into pixels for every traces at once
+           [using the get_lbda_to_pixels() method from wavesolution]
+        for each trace (loop object traceindexes)
         3) Interpolate the flux per pixels into flux per lbda
            (Interpolate the variance the same way)
            [using interp1d from scipy.interpolate]
@@ -608,6 +663,10 @@ class CCD( BaseCCD ):
             Should the progress within the loop over traceindexes should be
             shown (using astropy's ProgressBar)
 
+        pixelspectra: [dict] -optional-
+            flux and variance per pixels of the traces, as returned by get_pixel_spectra().
+            If None, this is measured from the ccd.
+
         Returns
         -------
         SEDMCube (child of pyifu's Cube)
@@ -632,14 +691,24 @@ class CCD( BaseCCD ):
         cubeflux_ = {}
         cubevar_  = {} if self.has_var() else None
 
-        # ------------ #
-        # MultiProcess #
-        # ------------ #
+        # ------------------ #
+        # Batch extraction   #
+        # ------------------ #
+        if pixelspectra is None:
+            pixelspectra = self.get_pixel_spectra(used_indexes)
+        pixelflux = pixelspectra["data"]
+        pixelvar  = pixelspectra["var"] if cubevar_ is not None else None
+        lbdapixels = {i_:pxl_ for i_,pxl_ in zip(used_indexes,
+                                       wavesolution.get_lbda_to_pixels(lbda, used_indexes) + pixel_shift)}
+
         def _build_ith_flux_(i_):
             try:
                 lbda_, flux_, variance_ = self.extract_spectrum(i_, wavesolution, lbda=lbda,
                                                                 get_spectrum=False,
-                                                                pixel_shift=pixel_shift)
+                                                                pixel_shift=pixel_shift,
+                                                                flux=pixelflux[i_],
+                                                                variance=pixelvar[i_] if pixelvar is not None else None,
+                                                                lbdapixels=lbdapixels[i_])
             except:
                 warnings.warn("FAILING EXTRACT_SPECTRUM for trace index %d: most likely wavesolution failed for this trace. *NaN Spectrum set*"%i_)
                 flux_ = np.ones(len(lbda) )*np.NaN
@@ -10,7 +10,6 @@ from .. import fluxcalibration
 from ..io import REDUXPATH
 import glob
 import os
-from astropy.io.fits import getval
 
 
 def fetch_hypergalfluxcal(date, range_night=2):
@@ -43,66 +42,136 @@ def fetch_pysedmfluxcal(date, range_night=0):
     return files
 
 
+# ------------------------- #
+#  Night Flux Calibrations  #
+# ------------------------- #
+# memoised per (worker) process: tasks only pass the fluxcal filenames around.
+_NIGHT_FLUXCALS = {}
+_FLUXCAL_SPECTRA = {}
+_TELLURIC = {}
+
+
+def get_telluric_template():
+    """ the telluric template (io.load_telluric_line), loaded once per process """
+    if "template" not in _TELLURIC:
+        _TELLURIC["template"] = io.load_telluric_line()
+    return _TELLURIC["template"]
+
+
+def load_fluxcal(fluxcalfile):
+    """ FluxCalSpectrum of the given file, loaded once per process (reloaded if the file changed).
+    All the spectra share the same telluric template (get_telluric_template()).
+    """
+    key = (fluxcalfile, os.path.getmtime(fluxcalfile))
+    if key not in _FLUXCAL_SPECTRA:
+        spec = fluxcalibration.load_fluxcal_spectrum(fluxcalfile)
+        spec._properties["tellspec"] = get_telluric_template()
+        _FLUXCAL_SPECTRA[key] = spec
+    return _FLUXCAL_SPECTRA[key]
+
+
+def get_night_fluxcal(date, hgfirst=False, download=True, update=False):
+    """ the NightFluxCal of the given night, resolved once per process.
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    hgfirst: [bool] -optional-
+        use the hypergal flux calibrations (of the surrounding nights) first.
+
+    download: [bool] -optional-
+        fetch the missing fluxcal files of the night with ztfquery (once).
+
+    update: [bool] -optional-
+        resolve the night again (e.g. if new fluxcal files have been made since)
+
+    Returns
+    -------
+    NightFluxCal
+    """
+    key = (date, hgfirst, download)
+    if update or key not in _NIGHT_FLUXCALS:
+        _NIGHT_FLUXCALS[key] = NightFluxCal(date, hgfirst=hgfirst, download=download)
+    return _NIGHT_FLUXCALS[key]
+
+
 def get_fluxcal_file(cube, hgfirst=False, update=False):
-    """ """
+    """ the valid fluxcal file the closest in time to the cube (see NightFluxCal) """
     date = cube.header["OBSDATE"].replace("-", "")
-    # - Make sure you have all the fluxcalibration files locally
-    if hgfirst:  # Use hypergal fluxcalibration file if available
-        filefluxcal = fetch_hypergalfluxcal(date)
-        for f_ in filefluxcal:
-            try:
-                spec = fluxcalibration.load_fluxcal_spectrum(f_)
-                if np.min(spec.data) < 0:
-                    filefluxcal.remove(f_)
-            except TypeError:
-                filefluxcal.remove(f_)
-        if len(filefluxcal) == 1:
-            return filefluxcal[0]
-        elif len(filefluxcal) > 1:
-            fluxcal_mjd_obs = [getval(f, "MJD_OBS") for f in filefluxcal]
-            mjd = cube.header.get("MJD_OBS")
-            target_mjd_obs = mjd
-            return filefluxcal[np.argmin(np.abs(target_mjd_obs - np.asarray(fluxcal_mjd_obs)))]
-    from ztfquery import sedm
-    squery = sedm.SEDMQuery()
-    # downloads what is missing.
-    try:
-        import json
-        _ = squery.get_night_fluxcal(date, nprocess=1, show_progress=False)
-    except (json.JSONDecodeError, OSError) as e:
-        warnings.warn(f"Corrupted file from whatdata at date {date}")
-    # - grab the nearest
-    try:
-        fluxcal = io.fetch_nearest_fluxcal(mjd=cube.header.get("MJD_OBS"))
-        
-    except:
-        print("enter inside the except.")
-        filefluxcal = fetch_pysedmfluxcal(date)
-        for f_ in filefluxcal:
+    return get_night_fluxcal(date, hgfirst=hgfirst, update=update
+                             ).get_fluxcal_file(cube.header.get("MJD_OBS"))
+
+
+class NightFluxCal(object):
+    """ Resolves the flux calibration candidates of a night once:
+    the fluxcal files are listed, loaded and validated (readable, no negative values)
+    and their MJD_OBS is read. The loaded spectra are kept (see load_fluxcal()).
+    """
+
+    def __init__(self, date, hgfirst=False, download=True, range_night=2):
+        """ """
+        self.date = date
+        self.hgfirst = hgfirst
+        if download:
+            self._download_()
+
+        self.hypergal = self._validate_(self._list_hypergal_(range_night)) if hgfirst else []
+        self.pysedm = self._validate_(io.get_night_files(date, "spec.fluxcal")
+                                      if os.path.isdir(io.get_datapath(date)) else [])
+        if len(self.pysedm) == 0:
+            warnings.warn(f"No fluxcal found for night {date}")
+
+    # =============== #
+    #   Methods       #
+    # =============== #
+    def get_fluxcal_file(self, mjd=None):
+        """ the candidate the closest to the given mjd (hypergal first if hgfirst).
+        If mjd is None, the last one. None if there is no candidate.
+        """
+        candidates = self.hypergal if len(self.hypergal) > 0 else self.pysedm
+        if len(candidates) == 0:
+            return None
+        if mjd is None or len(candidates) == 1:
+            return candidates[-1][0]
+        return candidates[np.argmin(np.abs(mjd - np.asarray([c[1] for c in candidates])))][0]
+
+    def get_fluxcal(self, mjd=None):
+        """ FluxCalSpectrum the closest to the given mjd (see get_fluxcal_file()) """
+        fluxcalfile = self.get_fluxcal_file(mjd)
+        return load_fluxcal(fluxcalfile) if fluxcalfile is not None else None
+
+    # - internal
+    def _download_(self):
+        """ """
+        from ztfquery import sedm
+        try:
+            import json
+            _ = sedm.SEDMQuery().get_night_fluxcal(self.date, nprocess=1, show_progress=False)
+        except (json.JSONDecodeError, OSError) as e:
+            warnings.warn(f"Corrupted file from whatdata at date {self.date}")
+
+    def _list_hypergal_(self, range_night):
+        """ """
+        from datetime import datetime, timedelta
+        d_ = datetime.strptime(self.date, '%Y%m%d')
+        dates = [(d_ + timedelta(n)).strftime('%Y%m%d') for n in range(-range_night, range_night+1)]
+        return [f for date_ in dates if os.path.isdir(io.get_datapath(date_))
+                    for f in io.get_night_files(date_, "re:^fluxcal_hypergal")]
+
+    @staticmethod
+    def _validate_(files):
+        """ [[file, mjd], ...] of the readable fluxcal with no negative values """
+        valid = []
+        for f_ in files:
             try:
-                spec = fluxcalibration.load_fluxcal_spectrum(f_)
-                if np.min(spec.data) < 0:
-                    filefluxcal.remove(f_)
-            except TypeError:
-                filefluxcal.remove(f_)
-            except FileNotFoundError:
-                filefluxcal.remove(f_)
-                warnings.warn(f"{f_} is a Corrupted file from whatdata at date {date}")
-
-        if len(filefluxcal) == 0:
-            raise ValueError("no filefluxcal found.")
-        
-        if len(filefluxcal) == 1:
-            return filefluxcal[0]
-        
-        elif len(filefluxcal) > 1:
-            fluxcal_mjd_obs = [getval(f, "MJD_OBS") for f in filefluxcal]
-            mjd = cube.header.get("MJD_OBS")
-            target_mjd_obs = mjd
-            fluxcal = filefluxcal[np.argmin(
-                np.abs(target_mjd_obs - np.asarray(fluxcal_mjd_obs)))]
-            
-    return fluxcal
+                if np.min(load_fluxcal(f_).data) < 0:
+                    continue
+                valid.append([f_, io.fetch_header_value(f_, "MJD_OBS")])
+            except (TypeError, OSError, KeyError, IndexError):
+                warnings.warn(f"{f_} is not a valid fluxcal file")
+        return valid
 
 
 def calibrate_cube(cube, fluxcalfile, airmass=None, backup_airmass=1.1, store_data=False):
@@ -110,7 +179,7 @@ def calibrate_cube(cube, fluxcalfile, airmass=None, backup_airmass=1.1, store_da
     if airmass is None:
         airmass = cube.header.get("AIRMASS", backup_airmass)
 
-    fluxcal = fluxcalibration.load_fluxcal_spectrum(fluxcalfile)
+    fluxcal = load_fluxcal(fluxcalfile)
     cube.scale_by(fluxcal.get_inversed_sensitivity(cube.header.get("AIRMASS", backup_airmass)),
                   onraw=False)
     cube.set_filename(cube.filename.replace("e3d", "cale3d"))
@@ -124,6 +193,43 @@ def calibrate_cube(cube, fluxcalfile, airmass=None, backup_airmass=1.1, store_da
     return cube
 
 
+def get_night_calibrations(date, traceflexure_corrected=True, flatfielded=True):
+    """ nightly calibrations needed to build the cubes of the night
+    (tracematch, tracemaskcache, wavesolution, hexagrid, flatfield and lbda).
+    see script.ccd_to_cube.load_cube_calibrations
+    """
+    from ..script.ccd_to_cube import load_cube_calibrations
+    calibrations = dict(tracematch=None, tracemaskcache=None, wavesolution=None,
+                        hexagrid=None, flatfield=None, lbda=None)
+    return load_cube_calibrations(date, calibrations,
+                                  dict(traceflexure_corrected=traceflexure_corrected,
+                                       flatfielded=flatfielded))
+
+
+def build_ccd_cube(ccdfile, date, calibrations, **kwargs):
+    """ reduce the given crr ccd into its e3d cube (trace flexure, background,
+    extraction, i-flexure, flat/atm corrections). The cube is written in the night directory.
+
+    Parameters
+    ----------
+    calibrations: [dict]
+        see get_night_calibrations()
+
+    **kwargs goes to script.ccd_to_cube.build_cubes()
+        (savefig is ignored: no figure is made, pyplot is not thread safe
+        and dask may run several frames in threads of the same process)
+
+    Returns
+    -------
+    string (filename of the e3d cube)
+    """
+    from ..script.ccd_to_cube import build_cubes
+    # - no nested pool within the dask workers
+    kwargs["ncore"] = 1
+    kwargs["savefig"] = False
+    return build_cubes([ccdfile], date, nprocess=1, **calibrations, **kwargs)[0]
+
+
 def _no_delayed_(func):
     return func
 
@@ -285,6 +391,84 @@ class DaskCCD(_SEDMFileHolder_):
 
         return files
 
+    # =============== #
+    #    Methods      #
+    # =============== #
+    # -------- #
+    #  GETTER  #
+    # -------- #
+    def get_ccdfiles(self, date=None, skip_calib=True):
+        """ crr files of the given night (all if None).
+
+        skip_calib: [bool] -optional-
+            discard the calibration exposures (Calib in the filename)
+        """
+        datafiles = self.datafiles
+        if date is not None:
+            datafiles = datafiles[datafiles["date"] == date]
+        if skip_calib:
+            datafiles = datafiles[~datafiles["basename"].str.contains("Calib")]
+        return list(datafiles["filepath"].values)
+
+    # -------- #
+    # Running  #
+    # -------- #
+    def compute(self, dates=None, skip_calib=True, get_delayed=False, **kwargs):
+        """ reduce the crr files into e3d cubes, night by night.
+
+        Parameters
+        ----------
+        dates: [string or list] -optional-
+            nights (YYYYMMDD) to reduce. If None, all the nights of the files.
+
+        skip_calib: [bool] -optional-
+            discard the calibration exposures.
+
+        get_delayed: [bool] -optional-
+            return the delayed graph (list of list of cube filenames per night)
+            instead of computing it.
+
+        **kwargs goes to night_build_cubes() (and then to script.ccd_to_cube.build_cubes())
+
+        Returns
+        -------
+        list of futures (list of delayed if get_delayed)
+        """
+        if dates is None:
+            dates = np.unique(self.datafiles["date"])
+
+        cubefiles = [self.night_build_cubes(date, self.get_ccdfiles(date, skip_calib=skip_calib),
+                                            **kwargs)
+                     for date in np.atleast_1d(dates)]
+        if get_delayed:
+            return cubefiles
+
+        if self.client is None:
+            return dask.compute(cubefiles)[0]
+        return self.client.compute(cubefiles)
+
+    # -------- #
+    # Static   #
+    # -------- #
+    @staticmethod
+    def night_build_cubes(date, ccdfiles, traceflexure_corrected=True, flatfielded=True,
+                          as_dask=True, **kwargs):
+        """ graph reducing the given ccd files of the night.
+        The night calibrations are loaded once and shared by all the frames.
+
+        Returns
+        -------
+        list (delayed e3d filenames if as_dask)
+        """
+        delayed = get_delayed_func(as_dask)
+        calibrations = delayed(get_night_calibrations)(date,
+                                                       traceflexure_corrected=traceflexure_corrected,
+                                                       flatfielded=flatfielded)
+        return [delayed(build_ccd_cube)(ccdfile, date, calibrations,
+                                        traceflexure_corrected=traceflexure_corrected,
+                                        flatfielded=flatfielded, **kwargs)
+                for ccdfile in ccdfiles]
+
 
 class DaskCube(_SEDMFileHolder_):
 
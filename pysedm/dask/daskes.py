@@ -3,12 +3,13 @@
 import os
 import numpy as np
 from dask import delayed
-from .base import DaskCube
+from .base import DaskCube, get_night_fluxcal, load_fluxcal
 
 
 from .. import get_sedmcube, fluxcalibration, io
 from ..sedm import SEDMExtractStar, flux_calibrate_sedm
 from astropy.io import fits
+from astropy.time import Time
 
 
 def get_extractstar(cube, step1range=[4500,7000], step1bins=6,
@@ -20,8 +21,10 @@ def get_extractstar(cube, step1range=[4500,7000], step1bins=6,
     return es
 
 def get_fluxcalfile(cubefile):
-    """ """
-    return io.fetch_nearest_fluxcal(mjd=fits.getval(cubefile,"MJD_OBS"))
+    """ fluxcal file of the night the closest in time to the cube (see base.NightFluxCal) """
+    mjd = io.fetch_header_value(cubefile,"MJD_OBS")
+    date = Time(mjd, format="mjd").datetime.isoformat().split("T")[0].replace("-","")
+    return get_night_fluxcal(date, download=False).get_fluxcal_file(mjd)
 
 def run_extractstar(es, spaxelbuffer = 10,
                     spaxels_to_use=None,
@@ -69,7 +72,7 @@ def calibrate_spec(spec, fluxcalfile, default_airmass=1.1,
     if fluxcalfile is None:
         fluxcal = None
     else:
-        fluxcal = fluxcalibration.load_fluxcal_spectrum(fluxcalfile)
+        fluxcal = load_fluxcal(fluxcalfile)
         
     if fluxcal is None:
         spec.header["FLUXCAL"] = (False,"has the spectra been flux calibrated")
@@ -19,9 +19,9 @@ j-offset is measured by maximizing the total flux within the randomly selected s
 #                      #
 ########################
 def get_ccd_jflexure(ccd, ntraces=100, tracewidth=1,
-                         jscan=[-2.5,2.5,10], savefile=None, get_object=False):
+                         jscan=[-2.5,2.5,51], savefile=None, get_object=False):
     """ give a ccd object (with tracematch loaded) ; this estimate the ccd-j trace flexure.
-    [takes about ~5s]
+    [takes a few ms]
 
     Parameters:
     -----------
@@ -50,9 +50,8 @@ def get_ccd_jflexure(ccd, ntraces=100, tracewidth=1,
     flaot (ccd-j shift to apply) [or TraceFlexureFit, see get_object option]
     """
     from .sedm import INDEX_CCD_CONTOURS
-    smap = ccd.tracematch.get_sub_tracematch( np.random.choice(ccd.tracematch.get_traces_within_polygon( INDEX_CCD_CONTOURS), ntraces) )
-    smap.set_buffer(tracewidth)
-    jflex = TraceFlexureFit(ccd, smap)
+    traceindexes = np.random.choice(ccd.tracematch.get_traces_within_polygon( INDEX_CCD_CONTOURS), ntraces)
+    jflex = TraceFlexureFit(ccd, ccd.tracematch, traceindexes=traceindexes, width=tracewidth)
     jflex.build_pseudomag_scan(*jscan)
     if savefile is not None:
         for savefile_ in np.atleast_1d(savefile):
@@ -62,38 +61,148 @@ def get_ccd_jflexure(ccd, ntraces=100, tracewidth=1,
 
 
 class TraceFlexureFit( BaseObject ):
-    """ """
+    """ Total flux within the traces as a function of a j-shift.
+
+    The traces are straight lines (TraceMatch._xys), so their centre position in every 
+    ccd column is analytic. The flux within centre+jshift +/- width of a column is 
+    the difference of the column cumulative flux (pixel centred on integer coordinates)
+    at the two edges, linearly interpolated at the subpixel positions.
+    Summed over the traces, this is a combination of prefix sums computed once,
+    so any set of j-shifts is scored at once without rendering the trace masks.
+    """
     PROPERTIES = ["ccd", "tracematch"]
-    DERIVED_PROPERTIES = ["pseudomag_scan"]
-    def __init__(self, ccd, tracematch):
-        """ """
+    SIDE_PROPERTIES = ["traceindexes", "width"]
+    DERIVED_PROPERTIES = ["pseudomag_scan", "tracecentres", "stacked_cumflux"]
+    def __init__(self, ccd, tracematch, traceindexes=None, width=None):
+        """ 
+        Parameters
+        ----------
+        ccd: [pysedm.CCD]
+           ccd object 
+
+        tracematch: [TraceMatch]
+            trace location.
+
+        traceindexes: [list of int] -optional-
+            traces used (may contain duplicates). If None, all the tracematch traces.
+
+        width: [float] -optional-
+            half size of the integration window around the trace centre.
+            If None, the tracematch width.
+        """
         self._properties["ccd"] = ccd
         self._properties["tracematch"] = tracematch
+        self._side_properties["traceindexes"] = traceindexes
+        self._side_properties["width"] = width
 
     # ===================== #
     #   Method              #
     # ===================== #
-    def get_total_pseudomag(self, jshift, subpixelization=2):
-        """ """
-        smap_current = self.tracematch.get_shifted_tracematch(0,jshift)
+    def load_trace_centres(self):
+        """ measures, once, the trace centres (ccd-j) within every ccd column they cross.
+        (stored as flat arrays, see tracecentres) """
+        height, width = np.shape(self.ccd.data)
+        rows  = np.argsort(self.tracematch.trace_indexes)[np.searchsorted(np.sort(self.tracematch.trace_indexes), self.traceindexes)]
+        xys   = np.asarray(self.tracematch._xys, dtype="float")[rows]
+        (xa, ya), (xb, yb) = xys[:,0].T, xys[:,1].T
+        xmin  = np.clip(np.ceil(np.minimum(xa, xb)), 0, width-1).astype("int")
+        xmax  = np.clip(np.floor(np.maximum(xa, xb)), 0, width-1).astype("int")
+        ncols = np.clip(xmax-xmin+1, 0, None)
+        trace = np.repeat(np.arange(len(xys)), ncols)
+        i     = xmin[trace] + np.arange(ncols.sum()) - np.repeat(np.cumsum(ncols)-ncols, ncols)
+        slope = (yb-ya)/np.where(xb!=xa, xb-xa, 1)
+        self._derived_properties["tracecentres"] = {"i":i, "j":ya[trace] + slope[trace]*(i-xa[trace])}
+        
+    def get_total_pseudomag(self, jshift):
+        """ -log10 of the total flux within the (j-shifted) traces.
+        
+        Parameters
+        ----------
+        jshift: [float or array]
+            ccd-j shift(s) of the traces.
+
+        Returns
+        -------
+        float or array (as jshift)
+        """
+        jshifts = np.atleast_1d(jshift).astype("float")
+        # both edges must use the same cumulative flux origin
+        nmin, nmax = int(np.floor(jshifts.min()-self.width)), int(np.floor(jshifts.max()+self.width))
+        stacked = self._derived_properties["stacked_cumflux"]
+        if stacked is None or nmin < stacked["nmin"] or nmax > stacked["nmax"]:
+            self.load_stacked_cumflux(nmin, nmax)
+            
+        flux    = self._get_stacked_cumflux_(jshifts+self.width) - self._get_stacked_cumflux_(jshifts-self.width)
+        pseudomag = -np.log10( flux )
+        return pseudomag if np.ndim(jshift)>0 else pseudomag[0]
+
+    def load_stacked_cumflux(self, nmin, nmax):
+        """ prefix sums (over the trace centres sorted by subpixel position) of the column 
+        cumulative fluxes at integer offsets nmin..nmax+2 from the trace centres.
+        This is what makes get_total_pseudomag() O(1) per j-shift (see _get_stacked_cumflux_). 
+        """
+        data   = np.asarray(self.ccd.data)
+        height, width = data.shape
+        # pixel k covers [k-0.5, k+0.5]: the cumulative flux below y=k-0.5 is the sum of pixels <k.
+        pos    = self.tracecentres["j"]+0.5
+        order  = np.argsort(pos%1)
+        base, subpix = np.divmod(pos[order], 1)
+        # the cumulative flux is counted from the pixel base+nmin (only differences matter)
+        rows   = base.astype("int")[:,None] + np.arange(nmin, nmax+2)[None,:]
+        flagin = (rows>=0) * (rows<height)
+        pixels = np.where(flagin, data.ravel().take(np.clip(rows, 0, height-1)*width + self.tracecentres["i"][order][:,None]), 0)
+        cumflux = np.zeros((len(pos), rows.shape[1]+1))
+        np.cumsum(np.nan_to_num(pixels), axis=1, out=cumflux[:,1:])
+        self._derived_properties["stacked_cumflux"] = {
+            "nmin":nmin, "nmax":nmax, "subpix":subpix,
+            "A": np.concatenate([np.zeros((1,cumflux.shape[1])), np.cumsum(cumflux, axis=0)]),
+            "B": np.concatenate([np.zeros((1,cumflux.shape[1])), np.cumsum(subpix[:,None]*cumflux, axis=0)])}
+        
+    def _get_stacked_cumflux_(self, t):
+        """ Sum, over the trace centres, of the ccd cumulative flux (along j) below centre+t. 
+
+        For a trace centre at cumulative position base+subpix (subpix in [0,1[)
+        the linear interpolation between the integer offsets n=floor(subpix+t) and n+1 
+        is either n=floor(t) (subpix < 1-frac(t)) or n=floor(t)+1, such that
+        the sum is a combination of 4 prefix sums (see load_stacked_cumflux, 
+        that must cover the floor(t) range)
+        """
+        n   = np.floor(t).astype("int")
+        tau = t - n
+        stacked = self._derived_properties["stacked_cumflux"]
+        A, B = stacked["A"], stacked["B"]
+        cut  = np.searchsorted(stacked["subpix"], 1-tau, side="left")
+        p    = n - stacked["nmin"]
+        # - subpix < 1-tau: between offsets n and n+1
+        lower = (1-tau)*A[cut,p] - B[cut,p] + tau*A[cut,p+1] + B[cut,p+1]
+        # - others: between offsets n+1 and n+2
+        A2 = lambda p_: A[-1,p_] - A[cut,p_]
+        B2 = lambda p_: B[-1,p_] - B[cut,p_]
+        upper = (2-tau)*A2(p+1) - B2(p+1) + (tau-1)*A2(p+2) + B2(p+2)
+        return lower + upper
+        
+    def get_raster_pseudomag(self, jshift, subpixelization=2):
+        """ Former (slow) estimation of get_total_pseudomag() based on the rendered trace masks """
+        smap_current = self.tracematch.get_sub_tracematch(self.traceindexes).get_shifted_tracematch(0,jshift)
+        smap_current.set_buffer(self.width)
         weightmap = smap_current.get_traceweight_mask(subpixelization)
         return -np.log10( np.nansum(self.ccd.data*weightmap) )
 
-        
-
     def fmin_jshift(self, guess):
+        """ """
+        from scipy.optimize import fmin
         return fmin(self.get_total_pseudomag, guess)
 
-    def build_pseudomag_scan(self, start=-3, end=3, step=10):
+    def build_pseudomag_scan(self, start=-3, end=3, step=51):
         """ """
         from scipy.interpolate import interp1d
         self.pseudomag_scan["js"] = np.linspace(start, end, step)
-        self.pseudomag_scan["pseudomag"] = [self.get_total_pseudomag(jshift_) for jshift_ in self.pseudomag_scan["js"]]
+        self.pseudomag_scan["pseudomag"] = self.get_total_pseudomag(self.pseudomag_scan["js"])
         self.pseudomag_scan["interpolation"] = interp1d(self.pseudomag_scan["js"], self.pseudomag_scan["pseudomag"],
                                                             kind="cubic")
     def estimate_jshift(self, nbins=100):
         """ """
-        xx = np.linspace(self.pseudomag_scan["js"].min(), self.pseudomag_scan["js"].max(), 100)
+        xx = np.linspace(self.pseudomag_scan["js"].min(), self.pseudomag_scan["js"].max(), nbins)
         return xx[np.argmin(self.pseudomag_scan["interpolation"](xx))]
 
     # ------------- #
@@ -142,6 +251,27 @@ class TraceFlexureFit( BaseObject ):
         """ """
         return self._properties["tracematch"]
 
+    @property
+    def traceindexes(self):
+        """ traces used to measure the flux """
+        if self._side_properties["traceindexes"] is None:
+            return np.asarray(self.tracematch.trace_indexes)
+        return np.asarray(self._side_properties["traceindexes"])
+
+    @property
+    def width(self):
+        """ half size of the integration window around the trace centres """
+        if self._side_properties["width"] is None:
+            return self.tracematch.width
+        return self._side_properties["width"]
+    
+    @property
+    def tracecentres(self):
+        """ {i: ccd column, j: trace centre} flat arrays (see load_trace_centres) """
+        if self._derived_properties['tracecentres'] is None:
+            self.load_trace_centres()
+        return self._derived_properties['tracecentres']
+
     @property
     def pseudomag_scan(self):
         """ """
@@ -190,13 +320,7 @@ class TraceFlexure( BaseObject ):
         # - Getting the expected J
         i_obs, j_obs = x, y
         if verbose: print("INFO: mesuring the expected j-coordinates")
-        js= []
-        for i_,j_ in zip(x, y):
-            try:
-                js.append( self.mapper.get_expected_j(i_,j_) )
-            except:
-                js.append(np.NaN)
-
+        js = self.mapper.get_expected_j(x, y, overlap="none")
         
         self._derived_properties['js']     = np.asarray(js)
         self._derived_properties['js_obs'] = np.asarray(j_obs)
@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Night inventory.
+
+The content of a night reduction directory is listed once and the filenames are parsed
+(kind, id, target). A few header keywords (INVENTORY_KEYWORDS) are read lazily, once per file,
+and kept in a small sidecar pkl file within the directory such that other processes do not
+have to open the fits files again.
+
+The file listing is refreshed when the directory mtime changes and the cached header
+values of a file are dropped when its own mtime changes.
+"""
+
+import os
+import re
+
+from propobject import BaseObject
+
+INVENTORY_NAME     = "%s_Inventory.pkl"
+INVENTORY_VERSION  = 1
+INVENTORY_KEYWORDS = ["MJD_OBS", "AIRMASS", "EXPTIME", "OBJECT", "Name", "JD"]
+
+FILEID_RE = re.compile(r"ifu(\d{8})_(\d{2})_(\d{2})_(\d{2})_?([^.]*)")
+
+_INVENTORIES = {}
+
+__all__ = ["get_night_inventory"]
+
+
+def get_night_inventory(dirname, use_sidecar=True):
+    """ Get the inventory of the given directory.
+    Inventories are kept in memory and refreshed if the directory changed.
+
+    Parameters
+    ----------
+    dirname: [string]
+        night reduction directory (see io.get_datapath())
+
+    use_sidecar: [bool] -optional-
+        Shall the header values stored in the sidecar file be used (and updated) ?
+
+    Returns
+    -------
+    NightInventory
+    """
+    dirname = os.path.abspath(os.path.expanduser(dirname))
+    if dirname not in _INVENTORIES:
+        inventory = NightInventory(dirname)
+        if use_sidecar:
+            inventory.load_sidecar()
+        _INVENTORIES[dirname] = inventory
+
+    inventory = _INVENTORIES[dirname]
+    inventory.update()
+    return inventory
+
+
+def parse_fileid(filename):
+    """ parse a sedm filename (e.g. crr_b_ifu20180101_06_10_45_ZTF18abc.fits)
+
+    Returns
+    -------
+    dict: {"date": YYYYMMDD, "id": HH_MM_SS, "target": name or None} (None values if not a sedm name)
+    """
+    match = FILEID_RE.search(os.path.basename(filename))
+    if match is None:
+        return {"date": None, "id": None, "target": None}
+    date, hh, mm, ss, target = match.groups()
+    return {"date": date, "id": "_".join([hh, mm, ss]), "target": target if len(target)>0 else None}
+
+
+def parse_filekind(filename):
+    """ list of the io.PRODSTRUCT_RE kinds ('type.subtype') matching the given filename """
+    from .io import PRODSTRUCT_RE
+    basename = os.path.basename(filename)
+    return [type_+"."+subtype_ for type_, subtypes in PRODSTRUCT_RE.items()
+                for subtype_, regex in subtypes.items() if re.search(r'%s'%regex, basename)]
+
+
+class NightInventory( BaseObject ):
+    """ Listing of a night directory with lazily cached header keywords """
+    PROPERTIES         = ["dirname", "filenames", "dir_mtime", "headers"]
+    SIDE_PROPERTIES    = ["modified"]
+    DERIVED_PROPERTIES = ["fileinfo"]
+
+    def __init__(self, dirname=None):
+        """ """
+        if dirname is not None:
+            self.set_dirname(dirname)
+
+    # ================ #
+    #  Main Methods    #
+    # ================ #
+    def update(self, force=False):
+        """ list the directory if this is new or if it changed since the last listing """
+        dir_mtime = os.path.getmtime(self.dirname)
+        if not force and self.filenames is not None and dir_mtime == self.dir_mtime:
+            return
+
+        sidecar = os.path.basename(self.get_sidecar_filename()).replace(".pkl", "")
+        self._properties["filenames"] = sorted([f for f in os.listdir(self.dirname) if not f.startswith(sidecar)])
+        self._properties["dir_mtime"] = dir_mtime
+        self._derived_properties["fileinfo"] = None
+        # - drop the headers of removed files
+        known = set(self.filenames)
+        for f in [f for f in self.headers if f not in known]:
+            self.headers.pop(f)
+
+    def get_files(self, regex, target=None, extention=None):
+        """ full path of the files matching the given regex, target and extention.
+        (see io.get_night_files)
+        """
+        dirname = self.dirname+"/"
+        return [dirname+f for f in self.filenames
+                   if re.search(r'%s'%regex, f) and
+                     (target is None or re.search(r'%s'%target, f)) and
+                     (extention is None or f.endswith(extention))]
+
+    def get_fileinfo(self, filename):
+        """ dict with the parsed 'date', 'id', 'target' and 'kinds' of the given file of the directory """
+        return self.fileinfo[os.path.basename(filename)]
+
+    def get_header_value(self, filename, key):
+        """ value of the given header keyword of the given file.
+        The INVENTORY_KEYWORDS (and the requested key) are read once and cached.
+
+        Raises
+        ------
+        KeyError if the keyword is not in the header (as fits.getval)
+        """
+        basename = os.path.basename(filename)
+        fullpath = os.path.join(self.dirname, basename)
+        mtime = os.path.getmtime(fullpath)
+        cache = self.headers.get(basename, None)
+        if cache is None or cache["mtime"] != mtime or \
+          (key not in cache["values"] and key not in cache["missing"]):
+            from astropy.io.fits import getheader
+            header = getheader(fullpath)
+            keys = sorted(set(INVENTORY_KEYWORDS+[key] +
+                                  ([] if cache is None or cache["mtime"] != mtime else list(cache["values"]))))
+            cache = {"mtime": mtime,
+                     "values": {k: header[k] for k in keys if k in header},
+                     "missing": [k for k in keys if k not in header]}
+            self.headers[basename] = cache
+            self._side_properties["modified"] = True
+
+        if key in cache["missing"]:
+            raise KeyError("Keyword '%s' not found."%key)
+        return cache["values"][key]
+
+    def get_header_values(self, filenames, key, save=True):
+        """ list of the header value of the given files (see get_header_value).
+
+        save: [bool] -optional-
+            store the new values in the sidecar file.
+        """
+        values = [self.get_header_value(f, key) for f in filenames]
+        if save and self.modified:
+            self.save_sidecar()
+        return values
+
+    # --------- #
+    #  I/O      #
+    # --------- #
+    def get_sidecar_filename(self):
+        """ """
+        return os.path.join(self.dirname, INVENTORY_NAME%os.path.basename(self.dirname))
+
+    def save_sidecar(self):
+        """ store the header cache in the sidecar file (silently skipped if the directory is not writable) """
+        from .utils.tools import dump_pkl
+        sidecar = self.get_sidecar_filename()
+        try:
+            # - atomic, other processes may read it meanwhile.
+            tmpfile = sidecar.replace(".pkl", ".%d.pkl"%os.getpid())
+            dump_pkl({"version": INVENTORY_VERSION, "headers": self.headers}, tmpfile)
+            os.replace(tmpfile, sidecar)
+        except (IOError, OSError):
+            return
+        self._side_properties["modified"] = False
+
+    def load_sidecar(self):
+        """ load the header cache from the sidecar file if any """
+        sidecar = self.get_sidecar_filename()
+        if not os.path.isfile(sidecar):
+            return
+        from .utils.tools import load_pkl
+        try:
+            data = load_pkl(sidecar)
+        except Exception:
+            return
+        if data.get("version", None) == INVENTORY_VERSION:
+            self._properties["headers"] = data["headers"]
+
+    # --------- #
+    #  SETTER   #
+    # --------- #
+    def set_dirname(self, dirname):
+        """ """
+        self._properties["dirname"] = os.path.abspath(os.path.expanduser(dirname))
+        self._properties["filenames"] = None
+        self._properties["headers"] = {}
+
+    # ================ #
+    #  Properties      #
+    # ================ #
+    @property
+    def dirname(self):
+        """ night directory """
+        return self._properties["dirname"]
+
+    @property
+    def filenames(self):
+        """ sorted list of the files of the directory """
+        return self._properties["filenames"]
+
+    @property
+    def dir_mtime(self):
+        """ mtime of the directory when it has been listed """
+        return self._properties["dir_mtime"]
+
+    @property
+    def headers(self):
+        """ cached header values {filename: {"mtime", "values", "missing"}} """
+        if self._properties["headers"] is None:
+            self._properties["headers"] = {}
+        return self._properties["headers"]
+
+    @property
+    def modified(self):
+        """ have header values been read since the last sidecar saving ? """
+        return self._side_properties["modified"] is True
+
+    @property
+    def fileinfo(self):
+        """ parsed filenames {filename: {"date", "id", "target", "kinds"}} """
+        if self._derived_properties["fileinfo"] is None:
+            fileinfo = {}
+            for f in self.filenames:
+                fileinfo[f] = {**parse_fileid(f), "kinds": parse_filekind(f)}
+            self._derived_properties["fileinfo"] = fileinfo
+        return self._derived_properties["fileinfo"]
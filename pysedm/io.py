@@ -51,8 +51,9 @@ PRODSTRUCT_RE = {"ccd":{"lamp":"^(dome|Hg|Cd|Xe)",
 
 __all__ = ["get_night_files",
                "load_nightly_mapper",
-               "load_nightly_tracematch","load_nightly_hexagonalgrid",
-               "load_nightly_wavesolution","load_nightly_flat"]
+               "load_nightly_tracematch","load_nightly_tracemaskcache","load_nightly_hexagonalgrid",
+               "load_nightly_wavesolution","load_nightly_flat",
+               "load_nightly_calibbundle"]
 
 ############################
 #                          #
@@ -116,17 +117,38 @@ def get_night_files(date, kind, target=None, extention=".fits"):
         else:
             raise TypeError("Enable to parse the given kind: %s"%kind)
 
-    path = get_datapath(date)
     if target in ["*"]:
         target = None
     if extention in ["*",".*"]:
         extention = None
 
-    # - Parsing the files
-    return [path+f for f in os.listdir(get_datapath(date))
-               if re.search(r'%s'%regex, f) and
-                 (target is None or re.search(r'%s'%target, f)) and
-                 (extention is None or f.endswith(extention))]
+    # - Parsing the files (the directory is only listed again if it changed)
+    return get_night_inventory(date).get_files(regex, target=target, extention=extention)
+
+def get_night_inventory(date):
+    """ NightInventory of the given night (see pysedm.inventory) """
+    from .inventory import get_night_inventory as get_inventory
+    return get_inventory(get_datapath(date))
+
+def fetch_header_values(filenames, key):
+    """ list of the `key` header values of the given files.
+    Values are cached by the inventory of the file directories (see pysedm.inventory).
+
+    Raises
+    ------
+    KeyError if a file does not have the keyword (as fits.getval)
+    """
+    from .inventory import get_night_inventory as get_inventory
+    values = {}
+    dirnames = [os.path.dirname(os.path.abspath(f)) for f in filenames]
+    for dirname in set(dirnames):
+        files_ = [f for f, d in zip(filenames, dirnames) if d == dirname]
+        values.update(zip(files_, get_inventory(dirname).get_header_values(files_, key)))
+    return [values[f] for f in filenames]
+
+def fetch_header_value(filename, key):
+    """ the `key` header value of the given file (see fetch_header_values) """
+    return fetch_header_values([filename], key)[0]
 
 def get_cleaned_sedmcube(filename):
     """ get sky and flux calibrated cube """
@@ -165,11 +187,11 @@ def fetch_header(date, target, kind="ccd.crr", getkey=None):
         return {d.split("/"):getheader(d) for d in datafile}
     # Or just a key value from it?
     else:
-        from astropy.io.fits import getval
+        values = fetch_header_values(datafile, getkey)
         if len(datafile)==1:
-            return getval(datafile[0],getkey)
+            return values[0]
 
-        return {d.split("/")[-1]:getval(d,getkey) for d in datafile}
+        return {d.split("/")[-1]:v for d,v in zip(datafile, values)}
 
 
 def fetch_nearest_fluxcal(date=None, file=None, mjd=None, kind="spec.fluxcal"):
@@ -196,17 +218,21 @@ def fetch_nearest_fluxcal(date=None, file=None, mjd=None, kind="spec.fluxcal"):
         target_mjd_obs = mjd
     else:
         try:
-            target_mjd_obs  = getval(file,"MJD_OBS")
+            target_mjd_obs  = fetch_header_value(file,"MJD_OBS")
         except KeyError:
             warnings.warn("No MJD_OBS keyword found, returning most recent file")
             return filefluxcal[-1]
         
-    fluxcal_mjd_obs = [getval(f,"MJD_OBS") for f in filefluxcal]
+    fluxcal_mjd_obs = fetch_header_values(filefluxcal,"MJD_OBS")
 
     return filefluxcal[ np.argmin( np.abs( target_mjd_obs - np.asarray(fluxcal_mjd_obs) ) ) ]
 
 def filename_to_id(filename):
-    """ """
+    """ HH_MM_SS id of the file, parsed from its name (the header JD is used for non-standard names) """
+    from .inventory import parse_fileid
+    fileid = parse_fileid(filename)["id"]
+    if fileid is not None:
+        return fileid
     return filename.split("/")[-1].split( header_to_date( getheader(filename) ))[-1][1:9]
 
 def header_to_date( header, sep=""):
@@ -305,6 +331,55 @@ def is_stdstars(header):
 #   NIGHT SOLUTION      #
 #                       #
 #########################
+_NIGHTLY_BUNDLES = {}
+
+# - Calibration Bundle
+def get_nightly_calibbundle_path(YYYYMMDD):
+    """ directory of the night calibration bundle (see calibbundle.py) """
+    from .calibbundle import BUNDLE_NAME
+    return os.path.join(get_datapath(YYYYMMDD), BUNDLE_NAME%YYYYMMDD)
+
+def load_nightly_calibbundle(YYYYMMDD, mmap_mode="r", warn_outdated=True):
+    """ Load the (memory-mapped) night calibration bundle if it exists and is 
+    not older than the pkl files it has been built from.
+    Bundles are kept in memory, so this is only read once per process.
+
+    Parameters
+    ----------
+    YYYYMMDD: [string]
+        night
+
+    mmap_mode: [string or None] -optional-
+        numpy.load mmap_mode. If None the arrays are read in memory.
+
+    warn_outdated: [bool] -optional-
+        warns if the bundle exists but is outdated.
+
+    Returns
+    -------
+    CalibrationBundle or None (if no valid bundle)
+    """
+    bundlepath = get_nightly_calibbundle_path(YYYYMMDD)
+    manifest   = os.path.join(bundlepath, "manifest.json")
+    if not os.path.isfile(manifest):
+        return None
+
+    key = (bundlepath, os.path.getmtime(manifest), mmap_mode)
+    if key not in _NIGHTLY_BUNDLES:
+        from .calibbundle import load_calibration_bundle
+        try:
+            _NIGHTLY_BUNDLES[key] = load_calibration_bundle(bundlepath, mmap_mode=mmap_mode)
+        except (TypeError, ValueError, IOError) as e:
+            warnings.warn("Cannot load the calibration bundle %s (%s), the pkl files are used."%(bundlepath, e))
+            return None
+
+    bundle = _NIGHTLY_BUNDLES[key]
+    if bundle.is_outdated():
+        if warn_outdated:
+            warnings.warn("The calibration bundle of %s is older than its source files, the pkl files are used. (rebuild it, see build_calibration_bundle)"%YYYYMMDD)
+        return None
+    return bundle
+
 # - Mapper
 def load_nightly_mapper(YYYYMMDD, within_ccd_contours=True):
     """ High level object to do i,j<->x,y,lbda """
@@ -324,11 +399,18 @@ def load_nightly_mapper(YYYYMMDD, within_ccd_contours=True):
     return mapper
 
 # - TraceMatch
-def load_nightly_tracematch(YYYYMMDD, withmask=False):
+def load_nightly_tracematch(YYYYMMDD, withmask=False, use_bundle=True):
     """ Load the spectral matcher.
     This object must have been created. 
+
+    use_bundle: [bool]
+        Use the night calibration bundle if any (see load_nightly_calibbundle)
     """
     from .spectralmatching import load_tracematcher
+    bundle = load_nightly_calibbundle(YYYYMMDD) if use_bundle else None
+    if bundle is not None and bundle.has("tracematch") and (not withmask or bundle.has("tracemask")):
+        return bundle.get_tracematch(withmask=withmask)
+    
     if not withmask:
         return load_tracematcher(get_datapath(YYYYMMDD)+"%s_TraceMatch.pkl"%(YYYYMMDD))
     else:
@@ -336,20 +418,40 @@ def load_nightly_tracematch(YYYYMMDD, withmask=False):
             return load_tracematcher(get_datapath(YYYYMMDD)+"%s_TraceMatch_WithMasks.pkl"%(YYYYMMDD))
         except:
             warnings.warn("No TraceMatch_WithMasks found. returns the usual TraceMatch")
-            return load_nightly_tracematch(YYYYMMDD, withmask=False)
+            return load_nightly_tracematch(YYYYMMDD, withmask=False, use_bundle=use_bundle)
+
+# - TraceMask Cache
+def load_nightly_tracemaskcache(YYYYMMDD, use_bundle=True):
+    """ Load the trace masks cache (masks for a grid of j-shifts).
+    This object must have been created (see build_tracematcher). 
+    """
+    from .spectralmatching import load_tracemask_cache
+    bundle = load_nightly_calibbundle(YYYYMMDD) if use_bundle else None
+    if bundle is not None and bundle.has("tracemaskcache"):
+        return bundle.get_tracemaskcache()
+    
+    cachefile = get_datapath(YYYYMMDD)+"%s_TraceMaskCache.pkl"%(YYYYMMDD)
+    if not os.path.isfile(cachefile):
+        raise IOError("No TraceMaskCache for the night %s"%YYYYMMDD)
+    return load_tracemask_cache(cachefile)
 
 # - HexaGrid
 def load_nightly_hexagonalgrid(YYYYMMDD, download_it=True,
-                                   nprocess_dl=1, **kwargs):
+                                   nprocess_dl=1, use_bundle=True, **kwargs):
     """ Load the Grid id <-> QR<->XY position
     This object must have been created. 
 
     nprocess_dl: [int]
         Number of // download. 1 means no // processing
 
-
+    use_bundle: [bool]
+        Use the night calibration bundle if any (see load_nightly_calibbundle)
     """
     from .utils.hexagrid import load_hexprojection
+    bundle = load_nightly_calibbundle(YYYYMMDD) if use_bundle else None
+    if bundle is not None and bundle.has("hexagrid"):
+        return bundle.get_hexagrid()
+    
     hexagrid_path = os.path.join(get_datapath(YYYYMMDD),"%s_HexaGrid.pkl"%(YYYYMMDD) )
     if os.path.isfile(hexagrid_path):
         return load_hexprojection( hexagrid_path )
@@ -369,12 +471,18 @@ def load_nightly_hexagonalgrid(YYYYMMDD, download_it=True,
     raise IOError(f"Cannot find an hexagrid for date {YYYYMMDD}, even after calling squery.download_night_calibrations()")
         
 # - WaveSolution
-def load_nightly_wavesolution(YYYYMMDD, subprocesses=False):
+def load_nightly_wavesolution(YYYYMMDD, subprocesses=False, use_bundle=True):
     """ Load the spectral matcher.
     This object must have been created. 
+
+    use_bundle: [bool]
+        Use the night calibration bundle if any (see load_nightly_calibbundle)
     """
     from .wavesolution import load_wavesolution
     if not subprocesses:
+        bundle = load_nightly_calibbundle(YYYYMMDD) if use_bundle else None
+        if bundle is not None and bundle.has("wavesolution"):
+            return bundle.get_wavesolution()
         return load_wavesolution(get_datapath(YYYYMMDD)+"%s_WaveSolution.pkl"%(YYYYMMDD))
     return [load_wavesolution(subwave) for subwave in glob(get_datapath(YYYYMMDD)+"%s_WaveSolution_range*.pkl"%(YYYYMMDD))]
 
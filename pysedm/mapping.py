@@ -7,7 +7,7 @@
 import numpy as np
 from propobject import BaseObject
 
-from shapely.geometry import Point, LineString
+from shapely.geometry import Point
 
 from .utils.tools import is_arraylike
 
@@ -26,7 +26,7 @@ INVERTED_LBDA_X = True
 class Mapper( BaseObject ):
     """ """
     PROPERTIES = ["tracematch","hexagrid", "wavesolution"]
-    DERIVED_PROPERTIES = ["spaxel_mapping","spaxelslice"]
+    DERIVED_PROPERTIES = ["spaxel_mapping","spaxelslice", "labelimage", "labeloverlap"]
     # ================= #
     #  Initialization   #
     # ================= #
@@ -51,6 +51,46 @@ class Mapper( BaseObject ):
           pyifu.get_slice( self.traceindexes, xy, spaxel_vertices= np.dot( self.hexagrid.grid_rotmatrix, SPAXEL_SHAPE.T ).T )
           
         self._derived_properties["spaxel_polygon"] = {i:p_ for i,p_ in zip(traceindexes,self.spaxel_slice.get_spaxel_polygon(remove_nan=True)) }
+        self._reset_label_image_()
+
+    def build_label_image(self):
+        """ Builds the (CCD shape) image of the traceindex containing each ccd pixel.
+        -1 means no trace. Pixels contained by 2 traces have the second one in 
+        the overlap image (-1 otherwise)
+
+        The traces are taken from the tracematch column index (see TraceMatch.build_columnindex),
+        a pixel (i,j) is within a trace if ylow < j < yhigh for the trace y-bounds of the column i.
+
+        Returns
+        -------
+        Void
+        """
+        width, height = CCD_SHAPE
+        colpos, traces, ybounds = self.tracematch.get_traces_crossing_columns(np.arange(width))
+        flagmapped = np.isin(traces, self.traceindexes)
+        colpos, traces, ybounds = colpos[flagmapped], traces[flagmapped], ybounds[flagmapped]
+        # - pixels strictly within the y-bounds
+        first  = np.clip(np.floor(ybounds[:,0]).astype("int")+1, 0, height)
+        nrows  = np.clip(np.ceil(ybounds[:,1]).astype("int"), 0, height) - first
+        nrows  = np.clip(nrows, 0, None)
+        entry  = np.repeat(np.arange(len(traces)), nrows)
+        j      = first[entry] + np.arange(nrows.sum()) - np.repeat(np.cumsum(nrows)-nrows, nrows)
+        pixel  = j*width + colpos[entry]
+        # - first trace of each pixel in the label image, the next in the overlap one.
+        order  = np.argsort(pixel, kind="stable")
+        pixel, trace = pixel[order], traces[entry][order]
+        isfirst = np.concatenate([[True], pixel[1:] != pixel[:-1]])
+        labels  = -np.ones(height*width, dtype="int32")
+        overlap = -np.ones(height*width, dtype="int32")
+        labels[pixel[isfirst]]   = trace[isfirst]
+        overlap[pixel[~isfirst]] = trace[~isfirst]
+        self._derived_properties["labelimage"]   = labels.reshape(height, width)
+        self._derived_properties["labeloverlap"] = overlap.reshape(height, width)
+
+    def _reset_label_image_(self):
+        """ """
+        self._derived_properties["labelimage"]   = None
+        self._derived_properties["labeloverlap"] = None
     # ================= #
     #  Methods          #
     # ================= #
@@ -58,27 +98,39 @@ class Mapper( BaseObject ):
     # ------------- #
     #   GETTER      #
     # ------------- #
-    def get_lbda_ij(self, lbda, traceindexes=None):
+    def get_lbda_ij(self, lbda, traceindexes=None, as_dict=True):
         """ returns all i,j coordinates for the given wavelength
 
         Parameters
         ----------
-        lbda: [float] 
+        lbda: [float or array] 
             wavelength in Angstrom
 
         traceindexes: [list/array] -optional-
             list of traces you want to use. 
             If None all the traces in self.traceindexes will be used.
 
+        as_dict: [bool] -optional-
+            format of the returned values.
+
         Returns
         -------
-        dictionary 
-        [{traceindex:[i,j] ... }
+        dictionary [{traceindex:[i,j] ... }] if as_dict
+        else i, j arrays (ntraces, or ntraces x nlbda if lbda is an array)
         """
         if traceindexes is None:
             traceindexes = self.traceindexes
 
-        return {traceindex:self.lbda_to_ij(lbda, traceindex) for traceindex in self.traceindexes}
+        # - All the traces at once
+        pixels = self.wavesolution.get_lbda_to_pixels(np.atleast_1d(lbda), traceindexes)
+        if not is_arraylike(lbda):
+            pixels = pixels[:,0]
+
+        i, j = self.traceindexi_to_j(traceindexes, pixels, inverted=INVERTED_LBDA_X)
+        if not as_dict:
+            return i, j
+        
+        return {traceindex:[i_,j_] for traceindex, i_, j_ in zip(traceindexes, i, j)}
     
     def get_ij(self, x, y, lbda):
         """ 
@@ -90,20 +142,38 @@ class Mapper( BaseObject ):
         traceindex = self.xy_to_traceindex(x,y)
         return self.lbda_to_ij(lbda, traceindex)
         
-    def get_xylbda(self, i, j):
+    def get_xylbda(self, i, j, overlap="raise"):
         """ 
         
         Reminder: i,j are the CCD coordinates
                   q,r are the MLA hexagonal coordiates
                   x,y are the MLA coordinate (in spaxels)
                   traceindex is the unique ID of a spaxel on the ccd
-        """
-        traceindex = self.ij_to_traceindex(i,j)
-        lbda       = self.ij_to_lbda(i, traceindex)
-        x,y        = self.traceindex_to_xy(traceindex)
-        return np.asarray([x,y,lbda])
 
-    def get_expected_j(self, i,j):
+        Parameters
+        ----------
+        i, j: [float or arrays]
+            ccd coordinates (see ij_to_traceindex)
+
+        overlap: [string] -optional-
+            pixels belonging to more than 1 trace (see ij_to_traceindex)
+
+        Returns
+        -------
+        array [x,y,lbda] (3 x N array if i,j are arrays) [NaN outside the traces]
+        """
+        if not is_arraylike(i):
+            return self.get_xylbda(np.atleast_1d(i), np.atleast_1d(j), overlap=overlap)[:,0]
+        
+        traceindex = self.ij_to_traceindex(i, j, overlap=overlap)
+        flagin     = traceindex >= 0
+        xylbda     = np.full((3, len(traceindex)), np.NaN)
+        i_eff      = (CCD_SHAPE[1]-1)-np.asarray(i, dtype="float") if INVERTED_LBDA_X else np.asarray(i, dtype="float")
+        xylbda[2, flagin] = self.wavesolution.get_pixels_to_lbda_pairs(i_eff[flagin], traceindex[flagin])
+        xylbda[:2, flagin] = self._get_spaxel_xy_(traceindex[flagin]).T
+        return xylbda
+
+    def get_expected_j(self, i,j, overlap="raise"):
         """ fetch the traceindex associated to the i,j coordinates
         and then returns where the j is supposed to be if the trace where perfectly 
         aligned. 
@@ -112,13 +182,28 @@ class Mapper( BaseObject ):
                   q,r are the MLA hexagonal coordiates
                   x,y are the MLA coordinate (in spaxels)
                   traceindex is the unique ID of a spaxel on the ccd
-            
+
+        Parameters
+        ----------
+        i, j: [float or arrays]
+            ccd coordinates (see ij_to_traceindex)
+
+        overlap: [string] -optional-
+            pixels belonging to more than 1 trace (see ij_to_traceindex)
+
+        Returns
+        -------
+        float or array (as i) [NaN outside the traces]
         """
-        traceindex = self.ij_to_traceindex(i,j)
-        if is_arraylike(traceindex):
-            return [self.traceindexi_to_j(t_,i) for t_ in traceindex]
+        if not is_arraylike(i):
+            return self.get_expected_j(np.atleast_1d(i), np.atleast_1d(j), overlap=overlap)[0]
         
-        return self.traceindexi_to_j(traceindex,i)[1]
+        traceindex = self.ij_to_traceindex(i,j, overlap=overlap)
+        flagin     = traceindex >= 0
+        expected_j = np.full(len(traceindex), np.NaN)
+        slope, intercept = self.tracematch.get_trace_line_coefs(traceindex[flagin])
+        expected_j[flagin] = intercept + slope*np.asarray(i, dtype="float")[flagin]
+        return expected_j
             
     # ------------- #
     #  CONVERSION   #
@@ -127,55 +212,113 @@ class Mapper( BaseObject ):
     #  lbda <-> i,j        #
     # .................... #
     def ij_to_lbda(self, i, traceindex):
-        """ converts the i-th ccd pixel to a wavelength for a given traceindex """
+        """ converts the i-th ccd pixel to a wavelength for a given traceindex
+        (if traceindex is a list, this returns a (ntraces x ni) array) """
         i_eff = (CCD_SHAPE[1]-1)-i if INVERTED_LBDA_X else i # -1 because starts at 0
         return self.wavesolution.pixels_to_lbda(i_eff, traceindex)
     
     def lbda_to_ij(self, lbda, traceindex):
         """ provide the central i,j coordinate for given traceindex at the given wavelength.
         Remark: j is the center of the trace for the column corresponding to the wavelength 
+
+        If traceindex is a list, this returns i and j arrays (see get_lbda_ij)
         """
+        if is_arraylike(traceindex):
+            return self.get_lbda_ij(lbda, traceindexes=traceindex, as_dict=False)
+        
         i =  self.wavesolution.lbda_to_pixels(lbda, traceindex)
         return self.traceindexi_to_j(traceindex, i, inverted=INVERTED_LBDA_X)
     
-    def traceindexi_to_j(self, traceindex, i, maxlines=1e4, inverted=False):
-        """ get thethe center of the trace `traceindex` for the column `i`"""
-        if is_arraylike(i):
-            return np.asarray([self.traceindexi_to_j(traceindex, i_) for _ in i])
+    def traceindexi_to_j(self, traceindex, i, inverted=False):
+        """ get the center of the trace `traceindex` for the column `i`
+
+        The trace centres are analytic (see TraceMatch.get_trace_line_coefs), 
+        j is NaN if the trace does not cover the column.
+
+        Parameters
+        ----------
+        traceindex: [int or list of int]
+            trace(s). If a list, `i` must have the same first dimension (one entry per trace).
         
+        i: [float or array]
+            ccd column(s) (or pixel along the trace if inverted)
+
+        inverted: [bool] -optional-
+            is i measured from the end of the ccd (i.e. (CCD_SHAPE[1]-1)-i) ?
+
+        Returns
+        -------
+        i_eff, j (same shape as i)
+        """
         if i is None: return np.asarray([None,None])
 
+        i     = np.asarray(i, dtype="float")
         i_eff = (CCD_SHAPE[1]-1)-i if inverted else i # -1 because starts at 0
-        try:
-            return i_eff, np.mean(self.tracematch.trace_polygons[traceindex].intersection(LineString([[i_eff,0],[i_eff, maxlines]])), axis=0)[1]
-        except:
-            return i_eff, np.NaN
+        slope, intercept = self.tracematch.get_trace_line_coefs(np.atleast_1d(traceindex))
+        xmin, xmax       = self.tracematch.get_trace_line_xbounds(np.atleast_1d(traceindex))
+        if is_arraylike(traceindex) and i_eff.ndim > 1:
+            slope, intercept, xmin, xmax = [v_[:,None] for v_ in [slope, intercept, xmin, xmax]]
+        elif not is_arraylike(traceindex):
+            slope, intercept, xmin, xmax = slope[0], intercept[0], xmin[0], xmax[0]
+            
+        j = np.where((i_eff>=xmin) * (i_eff<=xmax), intercept + slope*i_eff, np.NaN)
+        if i_eff.ndim == 0:
+            return float(i_eff), float(j)
+        if is_arraylike(traceindex):
+            return i_eff, j
+        return np.asarray([i_eff, j]).T
 
     # .................... #
     #  i,j <-> traceindex  #
     # .................... #
-    def ij_to_traceindex(self, i, j):
+    def ij_to_traceindex(self, i, j, overlap="raise"):
         """ provide the traceindex associated to the pixel i, j.
-        If the pixel is not in any spaxel, a None is set
+        If the pixel is not in any spaxel, a None is set (-1 for array inputs)
+
+        This reads the label image (see build_label_image), non-integer i,j 
+        are rounded to the closest pixel.
 
         Reminder: i,j are the CCD coordinates
                   q,r are the MLA hexagonal coordiates
                   x,y are the MLA coordinate (in spaxels)
                   traceindex is the unique ID of a spaxel on the ccd
 
+        Parameters
+        ----------
+        i, j: [float or arrays]
+            ccd coordinates
+
+        overlap: [string] -optional-
+            What to do for pixels belonging to more than 1 spaxel-trace:
+            - raise: raises a ValueError
+            - first: the first trace is returned
+            - none: considered as not in any spaxel.
+
         Returns
         -------
-        list
+        int or None (array of int if i,j are arrays)
         """
-        if is_arraylike(i):
-            return [self.ij_to_traceindex(i_,j_) for i_,j_ in zip(i,j)]
+        if not is_arraylike(i):
+            traceindex = self.ij_to_traceindex(np.atleast_1d(i), np.atleast_1d(j), overlap=overlap)[0]
+            return int(traceindex) if traceindex >= 0 else None
+
+        height, width = self.labelimage.shape
+        i_, j_ = np.rint(np.asarray(i, dtype="float")), np.rint(np.asarray(j, dtype="float"))
+        flagin = (i_>=0) * (i_<width) * (j_>=0) * (j_<height)
+        i_, j_ = np.where(flagin, i_, 0).astype("int"), np.where(flagin, j_, 0).astype("int")
+        traceindex = np.where(flagin, self.labelimage[j_, i_], -1)
         
-        pij = Point(i,j)
-        traceindex = [i_ for i_ in self.traceindexes if self.tracematch.trace_polygons[i_].contains(pij)]
-        if len(traceindex) > 1:
-            raise ValueError("the ccd-pixel coordinates %d,%d belongs to more than 1 spaxel-trace"%(i,j))
-
-        return traceindex[0] if len(traceindex)==1 else None
+        flagoverlap = flagin * (self._labeloverlap[j_, i_] >= 0)
+        if np.any(flagoverlap):
+            if overlap == "raise":
+                k = np.argwhere(flagoverlap)[0][0]
+                raise ValueError("the ccd-pixel coordinates %d,%d belongs to more than 1 spaxel-trace"%(i_[k],j_[k]))
+            if overlap == "none":
+                traceindex[flagoverlap] = -1
+            elif overlap != "first":
+                raise ValueError("unknown overlap option %s. Use raise, first or none"%overlap)
+            
+        return traceindex
 
     def traceindex_to_ij(self, traceindex):
         """ """
@@ -237,6 +380,13 @@ class Mapper( BaseObject ):
         if traceindex in self.spaxel_mapping.keys():
             return self.spaxel_mapping[traceindex]
         return None, None
+
+    def _get_spaxel_xy_(self, traceindexes):
+        """ (N x 2) x,y position of the given (known) traceindexes (array version of traceindex_to_xy) """
+        known = np.asarray(list(self.spaxel_mapping.keys()))
+        xy    = np.asarray(list(self.spaxel_mapping.values()), dtype="float")
+        order = np.argsort(known)
+        return xy[order][np.searchsorted(known[order], traceindexes)]
         
         
     # ------------- #
@@ -250,6 +400,7 @@ class Mapper( BaseObject ):
     def set_tracematch(self, tmap):
         """ """
         self._properties["tracematch"] = tmap
+        self._reset_label_image_()
         
     def set_wavesolution(self, wsol):
         """ """
@@ -300,6 +451,21 @@ class Mapper( BaseObject ):
             raise AttributeError("spaxel_mapping not defined. See `derive_spaxel_mapping()` method")
         return self._derived_properties["spaxel_mapping"]
     
+    @property
+    def labelimage(self):
+        """ (CCD shape) image of the traceindex containing each pixel (-1 if none) 
+        see build_label_image() """
+        if self._derived_properties["labelimage"] is None:
+            self.build_label_image()
+        return self._derived_properties["labelimage"]
+
+    @property
+    def _labeloverlap(self):
+        """ second traceindex of pixels belonging to 2 traces (-1 otherwise) """
+        if self._derived_properties["labeloverlap"] is None:
+            self.build_label_image()
+        return self._derived_properties["labeloverlap"]
+    
     @property
     def _spaxel_polygon(self):
         """ list of Shapely Polygon derived by the `derive_spaxel_mapping()` method """
@@ -6,12 +6,17 @@
 # This method is an a
 #
 import os
+import warnings
 import numpy as np
 from astropy import time
 from astropy.io import fits
 from . import io
 RAINBOW_DATA_SOURCE = "/scr2/sedm/raw/"
 SEDMPY_CODE_PATH = "/scr2/sedmdrp/sedmpy/"
+GUIDER_CATALOG_NAME = "%s_GuiderCatalog.pkl"
+GUIDER_CATALOG_COLUMNS = ["filename", "mtime", "is_guider", "jd_start", "jd_end",
+                          "exptime", "naxis1", "naxis2", "cam_name"]
+_GUIDER_CATALOGS = {}
 # READOUT_NOISE       = 4
 
 
@@ -68,7 +73,7 @@ def build_meta_ifu_guider(ifufile, outdir=None, solve_wcs=True, verbose=False):
 # ================== #
 #   Function         #
 # ================== #
-def build_stacked_guider(ifufile, outdir=None, overwrite=True):
+def build_stacked_guider(ifufile, outdir=None, overwrite=True, method="median", **kwargs):
     """ 
     This function:
     1) fetches the guider images from the rainbow camera raw directory
@@ -90,9 +95,13 @@ def build_stacked_guider(ifufile, outdir=None, overwrite=True):
     overwrite: [bool] -optional-
         Set to overwrite existing file
 
+    method: [string] -optional-
+        stacking method (median or clipmean), see stack_images()
+
+    **kwargs goes to stack_images() (e.g. memory_budget, nworkers)
     """
     guiders = get_ifu_guider_images(ifufile)
-    stacked_image, nstack, avscl = stack_images(guiders)
+    stacked_image, nstack, avscl = stack_images(guiders, method=method, **kwargs)
     # did we get any?
     if nstack < 1:
         print("ERROR - no guider images found")
@@ -107,8 +116,8 @@ def build_stacked_guider(ifufile, outdir=None, overwrite=True):
     hdulist = fits.HDUList([fits.PrimaryHDU(stacked_image,
                                             fits.getheader(guiders[0]))])
     hdulist[0].header['NSTACK'] = nstack
-    hdulist[0].header['STACKMTH'] = 'median'
-    hdulist[0].header['SCALEMTH'] = 'median'
+    hdulist[0].header['STACKMTH'] = method
+    hdulist[0].header['SCALEMTH'] = str(kwargs.get("scale", "median"))
     hdulist[0].header['STACKSCL'] = avscl
     hdulist.writeto(savefile, overwrite=overwrite)
     return savefile
@@ -156,8 +165,27 @@ def get_rainbow_datapath(ut_date):
     return os.path.join(source, ut_date) + "/"
 
 
-def get_ifu_guider_images(ifufile):
-    """ """    
+def get_ifu_guider_images(ifufile, use_catalog=True, overlap=False):
+    """ list of the rainbow camera guider images taken during the given ifu exposure.
+
+    Parameters
+    ----------
+    ifufile: [string]
+        Path of a ifu .fits (or derived .fits as long as they contain
+        the basic associated header keywords)
+
+    use_catalog: [bool] -optional-
+        Shall this query the night guider catalog (see get_guider_catalog) ?
+        If False, all the rainbow camera files are opened (slow).
+
+    overlap: [bool] -optional-
+        Guider images starting during the ifu exposure (False) or 
+        overlapping with it (True). [only with use_catalog]
+
+    Returns
+    -------
+    list of filenames
+    """    
     ifu_header = fits.getheader(ifufile)
     
     fileid = io.filename_to_id(ifufile)
@@ -167,7 +195,11 @@ def get_ifu_guider_images(ifufile):
     # - end
     jd_end = jd_ini + ifu_header['EXPTIME'] / (24.*3600)
     # - Where are the guider data  ?
-    rb_dir = get_rainbow_datapath(io.header_to_date(ifu_header))
+    ut_date = io.header_to_date(ifu_header)
+    if use_catalog:
+        return get_guider_files(get_guider_catalog(ut_date), jd_ini, jd_end, overlap=overlap)
+    
+    rb_dir = get_rainbow_datapath(ut_date)
     # - Return them
     flist = os.listdir(rb_dir)
     rb_list = []
@@ -196,29 +228,298 @@ def get_ifu_guider_images(ifufile):
     return rb_list
 
 
-def stack_images(rainbow_files, method="median", scale="median"):
-    """ return a 2D image corresponding of the stack of the given data """
+# ------------------ #
+#   Guider Catalog   #
+# ------------------ #
+def get_guider_catalog_path(ut_date):
+    """ where the night guider catalog is stored (the reduction directory of the night) """
+    return os.path.join(io.get_datapath(ut_date), GUIDER_CATALOG_NAME % ut_date)
+
+
+def get_guider_catalog(ut_date, nprocess=None, savefile=None, update=True):
+    """ get the catalog of the rainbow camera frames of the night.
+    
+    The catalog is built once (header-only scan, see build_guider_catalog) and 
+    stored in the night reduction directory. It is kept in memory and only 
+    re-scanned when the rainbow camera directory changed (mtime), in which case
+    only new or modified files are read.
+
+    Parameters
+    ----------
+    ut_date: [string]
+        YYYYMMDD
+
+    nprocess: [int or None] -optional-
+        number of processes used to read the headers.
+        (None means cpu_count-1, 1 means no multiprocessing)
+        Within a daemonic process (e.g. a Pool worker) the headers are read serially.
+
+    savefile: [string or None] -optional-
+        where the catalog is stored. If None, see get_guider_catalog_path()
+
+    update: [bool] -optional-
+        Shall the catalog be updated if the rainbow camera directory changed ?
+
+    Returns
+    -------
+    pandas.DataFrame (GUIDER_CATALOG_COLUMNS, sorted by jd_start)
+    """
+    rb_dir = get_rainbow_datapath(ut_date)
+    dir_mtime = os.path.getmtime(rb_dir)
+    if savefile is None:
+        savefile = get_guider_catalog_path(ut_date)
+
+    # - Memory
+    catalog = _GUIDER_CATALOGS.get(rb_dir, None)
+    # - Disk
+    if catalog is None and os.path.isfile(savefile):
+        from .utils.tools import load_pkl
+        try:
+            catalog = load_pkl(savefile)
+        except Exception as e:
+            warnings.warn("Cannot load the guider catalog %s (%s), it is rebuilt."%(savefile, e))
+            catalog = None
+            
+    if catalog is not None and (catalog["dir_mtime"] == dir_mtime or not update):
+        _GUIDER_CATALOGS[rb_dir] = catalog
+        return catalog["catalog"]
+
+    # - Build or update
+    catalog = {"dirname": rb_dir, "dir_mtime": dir_mtime,
+               "catalog": build_guider_catalog(ut_date, nprocess=nprocess,
+                                        previous=None if catalog is None else catalog["catalog"])}
+    _GUIDER_CATALOGS[rb_dir] = catalog
+    try:
+        from .utils.tools import dump_pkl
+        dump_pkl(catalog, savefile)
+    except (IOError, OSError) as e:
+        warnings.warn("Cannot store the guider catalog in %s (%s), it is only kept in memory."%(savefile, e))
+        
+    return catalog["catalog"]
+
+
+def build_guider_catalog(ut_date, nprocess=None, previous=None):
+    """ read the header of the rainbow camera frames of the night.
+
+    Parameters
+    ----------
+    ut_date: [string]
+        YYYYMMDD
+
+    nprocess: [int or None] -optional-
+        number of processes used to read the headers.
+        (None means cpu_count-1, 1 means no multiprocessing)
+        Within a daemonic process (e.g. a Pool worker) the headers are read serially.
+
+    previous: [pandas.DataFrame or None] -optional-
+        former version of the catalog. The files with unchanged mtime are not read again.
+
+    Returns
+    -------
+    pandas.DataFrame (GUIDER_CATALOG_COLUMNS, sorted by jd_start)
+    """
+    import pandas
+    rb_dir = get_rainbow_datapath(ut_date)
+    # Use only *.fit* files
+    files = [rb_dir+f for f in os.listdir(rb_dir) if 'fit' in f]
+    mtimes = [os.path.getmtime(f) for f in files]
+
+    known = {} if previous is None else \
+      {f_: row_ for f_, row_ in zip(previous["filename"], previous.to_dict("records"))}
+    rows = [known[f_] for f_, m_ in zip(files, mtimes) if f_ in known and known[f_]["mtime"] == m_]
+    toread = [f_ for f_, m_ in zip(files, mtimes) if f_ not in known or known[f_]["mtime"] != m_]
+    
+    import multiprocessing
+    if nprocess is None:
+        nprocess = np.max([multiprocessing.cpu_count() - 1, 1])
+    if multiprocessing.current_process().daemon:
+        # daemonic processes are not allowed to have children.
+        nprocess = 1
+    if nprocess > 1 and len(toread) > 50:
+        with multiprocessing.Pool(nprocess) as p:
+            newrows = p.map(read_guider_header, toread, chunksize=int(np.ceil(len(toread)/(4*nprocess))))
+    else:
+        newrows = [read_guider_header(f_) for f_ in toread]
+
+    rows += newrows
+    catalog = pandas.DataFrame(rows, columns=GUIDER_CATALOG_COLUMNS)
+    return catalog.sort_values("jd_start").reset_index(drop=True)
+
+
+def read_guider_header(filename):
+    """ header-only reading of a rainbow camera file.
+
+    Returns
+    -------
+    dict (GUIDER_CATALOG_COLUMNS)
+    `is_guider` is False for ifu images, corrupt files and frames without JD.
+    """
+    try:
+        header = fits.getheader(filename)
+    except OSError:
+        print("WARNING - corrupt fits file: %s" % filename)
+        header = None
+    
+    if header is None:
+        header, is_guider = fits.Header(), False
+    elif "CAM_NAME" in header:
+        # Skip IFU images
+        is_guider = "IFU" not in header['CAM_NAME']
+    else:
+        is_guider = 'ifu' not in filename.split('/')[-1]
+
+    if is_guider and "JD" not in header:
+        print("WARNING - no JD keyword in %s" % filename)
+        is_guider = False
+
+    jd_start = header.get("JD", np.NaN)
+    exptime = header.get("EXPTIME", 0)
+    return {"filename": filename, "mtime": os.path.getmtime(filename),
+            "is_guider": is_guider, "jd_start": jd_start,
+            "jd_end": jd_start + exptime / (24.*3600),
+            "exptime": exptime, "naxis1": header.get("NAXIS1", 0),
+            "naxis2": header.get("NAXIS2", 0), "cam_name": header.get("CAM_NAME", "")}
+
+
+def get_guider_files(catalog, jd_ini, jd_end, overlap=False):
+    """ interval query of the guider catalog.
+    
+    Parameters
+    ----------
+    catalog: [pandas.DataFrame]
+        guider catalog sorted by jd_start (see get_guider_catalog)
+
+    jd_ini, jd_end: [float]
+        time interval (e.g. the ifu exposure)
+
+    overlap: [bool] -optional-
+        Frames starting within [jd_ini, jd_end] (False, as the guiding images) or
+        any frame overlapping with it (True).
+
+    Returns
+    -------
+    list of filenames
+    """
+    guiders = catalog[catalog["is_guider"].values.astype(bool)]
+    jd_start = guiders["jd_start"].values
+    if not overlap:
+        imin = np.searchsorted(jd_start, jd_ini, side="left")
+        imax = np.searchsorted(jd_start, jd_end, side="right")
+        return list(guiders["filename"].values[imin:imax])
+    
+    imax = np.searchsorted(jd_start, jd_end, side="right")
+    flagin = guiders["jd_end"].values[:imax] >= jd_ini
+    return list(guiders["filename"].values[:imax][flagin])
+
+
+def stack_images(rainbow_files, method="median", scale="median", subsample=4,
+                 memory_budget=256, nworkers=1, sigma=3, maxiters=5):
+    """ return a 2D image corresponding of the stack of the given data 
+
+    The frames are memory-mapped and combined by chunks of rows, such that
+    the memory used remains bounded whatever the number of frames.
+
+    Parameters
+    ----------
+    rainbow_files: [list of string]
+        guider images to stack (same shape).
+
+    method: [string] -optional-
+        how to combine the frames:
+        - median: median of the scaled frames
+        - clipmean: sigma-clipped mean of the scaled frames (see sigma, maxiters)
+
+    scale: [string or None] -optional-
+        how to scale the frames before stacking:
+        - median: divided by their median
+        - None: no scaling
+
+    subsample: [int] -optional-
+        the median scale of a frame is measured on 1 pixel every `subsample` 
+        in both directions. (1 means the full frame)
+
+    memory_budget: [float] -optional-
+        approximate memory (in Mb) used to combine the frames.
+
+    nworkers: [int] -optional-
+        number of threads combining the chunks of rows (reading overlaps with stacking)
+
+    sigma, maxiters: [float, int] -optional-
+        sigma clipping parameters (only for method='clipmean')
+
+    Returns
+    -------
+    2d-array (None if no file), number of stacked frames, average scale
+    """
     # - 
-    if scale not in ['median']:
+    if scale not in ['median', None]:
         raise NotImplementedError("only median scaling implemented (not %s)"
                                   % scale)
     
-    if method not in ['median']:
+    if method not in ['median', 'clipmean']:
         raise NotImplementedError(
-            "only median stacking method implemented (not %s)" % method)
-    # Load the normalized data
-
-    datas = []
-    scales = []
-    scaling = 1.
-    avscale = 1.
-    for f_ in rainbow_files:
-        data_ = fits.getdata(f_)
-        # header_= fits.getheader(f_) all have the same gain and readout noise
-        if scale in ["median"]: 
-            scaling = np.median(data_)
-            scales.append(scaling)
-        datas.append(data_/scaling)
-        avscale = np.mean(scales)
-
-    return np.median(datas, axis=0)*avscale, len(datas), avscale
+            "only median or clipmean stacking methods implemented (not %s)" % method)
+
+    if len(rainbow_files) == 0:
+        return None, 0, 1.
+
+    # Memory-mapped data. Integer frames (e.g. uint16 as BZERO=32768) cannot be mapped
+    # once scaled: the raw values are mapped and scaled by chunk (see _get_rows_)
+    hduls = [fits.open(f_, memmap=True, do_not_scale_image_data=True) for f_ in rainbow_files]
+    try:
+        return _stack_mapped_images_(hduls, method=method, scale=scale, subsample=subsample,
+                                     memory_budget=memory_budget, nworkers=nworkers,
+                                     sigma=sigma, maxiters=maxiters)
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+def _get_rows_(hdu, rows):
+    """ the given rows of the hdu data in float, with BZERO/BSCALE applied and BLANK as NaN
+    (the hdu must be opened with do_not_scale_image_data=True) """
+    raw = hdu.data[rows]
+    data_ = raw * hdu.header.get("BSCALE", 1.) + hdu.header.get("BZERO", 0.)
+    if "BLANK" in hdu.header and np.issubdtype(raw.dtype, np.integer):
+        data_[raw == hdu.header["BLANK"]] = np.NaN
+    return data_
+
+def _stack_mapped_images_(hduls, method="median", scale="median", subsample=4,
+                          memory_budget=256, nworkers=1, sigma=3, maxiters=5):
+    """ see stack_images() """
+    hdus = [hdul[0] for hdul in hduls]
+    shape = hdus[0].data.shape
+    if np.any([h_.data.shape != shape for h_ in hdus]):
+        raise ValueError("the guider images do not have the same shape.")
+    # header_= fits.getheader(f_) all have the same gain and readout noise
+    if scale in ["median"]:
+        scales = np.asarray([np.nanmedian(_get_rows_(h_, slice(None, None, subsample))[:, ::subsample])
+                             for h_ in hdus])
+    else:
+        scales = np.ones(len(hdus))
+    avscale = np.mean(scales)
+
+    # - Chunks of rows: frames in float + a working copy
+    nrows = int(np.clip(memory_budget*1024**2 / (2*8*len(hdus)*np.prod(shape[1:])*nworkers),
+                        1, shape[0]))
+    chunks = [slice(r_, r_+nrows) for r_ in range(0, shape[0], nrows)]
+
+    def _stack_rows_(rows):
+        """ """
+        data_ = np.stack([_get_rows_(h_, rows)/s_ for h_, s_ in zip(hdus, scales)])
+        if method == "median":
+            return rows, np.median(data_, axis=0)
+        from astropy.stats import sigma_clip
+        return rows, sigma_clip(data_, sigma=sigma, maxiters=maxiters,
+                                axis=0, masked=True).mean(axis=0).filled(np.NaN)
+
+    stacked = np.empty(shape, dtype="float")
+    if nworkers > 1:
+        from multiprocessing.pool import ThreadPool
+        with ThreadPool(nworkers) as p:
+            for rows, stack_ in p.imap_unordered(_stack_rows_, chunks):
+                stacked[rows] = stack_
+    else:
+        for rows in chunks:
+            stacked[rows] = _stack_rows_(rows)[1]
+
+    return stacked*avscale, len(hdus), avscale
@@ -13,9 +13,10 @@ from astrobject.utils.tools import dump_pkl
 from astropy.io import fits
 
 from .. import io
+from ..utils import timing
 
 from ..ccd import get_ccd
-from ..spectralmatching import get_tracematcher, illustrate_traces, load_trace_masks
+from ..spectralmatching import get_tracematcher, illustrate_traces, load_trace_masks, build_tracemask_cache
 from ..wavesolution import get_wavesolution, Flexure
 
 from ..sedm import INDEX_CCD_CONTOURS, TRACE_DISPERSION, build_sedmcube, build_calibrated_sedmcube, SEDM_LBDA
@@ -26,7 +27,7 @@ from ..sedm import INDEX_CCD_CONTOURS, TRACE_DISPERSION, build_sedmcube, build_c
 #                          #
 ############################
 def build_tracematcher(date, verbose=True, width=None,
-                           save_masks=False,
+                           save_masks=False, save_maskcache=False,
                            rebuild=False,
                            ncore=None):
     
@@ -44,13 +45,18 @@ def build_tracematcher(date, verbose=True, width=None,
         
     save_masks: [bool] -optional-
         Shall this measures all the individual masks and save them?
-        This mask building is the most cpu expensive part of the pipeline, 
-        it takes about 30min/number_of_core. If this is saved (~150Mo) 
-        wavelength-solution and cube-building will be faster.
+        (see spectralmatching.load_trace_masks, this takes a few seconds)
+        If this is saved (~150Mo) wavelength-solution and cube-building will be faster.
+
+    save_maskcache: [bool] -optional-
+        Shall this also measure the masks for a grid of fractional j-shifts and save them?
+        This is used by build_cubes to get the trace flexure corrected masks 
+        without measuring them again for each ccd. (see spectralmatching.TraceMaskCache)
         
     Returns
     -------
-    Void.  (Creates the file TraceMatch.pkl and TraceMatch_WithMasks.pkl if save_masks)
+    Void.  (Creates the file TraceMatch.pkl and TraceMatch_WithMasks.pkl if save_masks
+            and TraceMaskCache.pkl if save_maskcache)
     """
     
     
@@ -78,9 +84,16 @@ def build_tracematcher(date, verbose=True, width=None,
     if save_masks:
         if not rebuild and len(glob(timedir+"%s_TraceMatch_WithMasks.pkl"%date))>0:
             warnings.warn("TraceMatch_WithMasks already exists for %s. rebuild is False, so nothing is happening"%date)
+        else:
+            load_trace_masks(smap, smap.get_traces_within_polygon(INDEX_CCD_CONTOURS), ncore=ncore)
+            smap.writeto(timedir+"%s_TraceMatch_WithMasks.pkl"%date)
+
+    if save_maskcache:
+        if not rebuild and len(glob(timedir+"%s_TraceMaskCache.pkl"%date))>0:
+            warnings.warn("TraceMaskCache already exists for %s. rebuild is False, so nothing is happening"%date)
             return
-        load_trace_masks(smap, smap.get_traces_within_polygon(INDEX_CCD_CONTOURS), ncore=ncore)
-        smap.writeto(timedir+"%s_TraceMatch_WithMasks.pkl"%date)
+        maskcache = build_tracemask_cache(smap, smap.get_traces_within_polygon(INDEX_CCD_CONTOURS), ncore=ncore)
+        maskcache.writeto(timedir+"%s_TraceMaskCache.pkl"%date)
     
 ############################
 #                          #
@@ -101,6 +114,21 @@ def build_hexagonalgrid(date, xybounds=None, theta=None):
     timedir = io.get_datapath(date)
     hgrid.writeto(timedir+"%s_HexaGrid.pkl"%date)
 
+############################
+#                          #
+#  Calibration Bundle      #
+#                          #
+############################
+def build_calibration_bundle(date):
+    """ Stores the night TraceMatch, TraceMaskCache, WaveSolution and HexaGrid
+    as a memory-mappable calibration bundle (see pysedm.calibbundle).
+    The io.load_nightly_* functions then use it instead of the pkl files.
+    """
+    from ..calibbundle import get_calibration_bundle
+    bundle = get_calibration_bundle(date)
+    bundle.writeto(io.get_nightly_calibbundle_path(date))
+    return bundle
+
 ############################
 #                          #
 # Spaxel Spacial Position  #
@@ -145,7 +173,8 @@ def build_flatfield(date, lbda_min=7000, lbda_max=9000,
     #  Actual FlatFielding   #
     # ---------------------- #
     reffile  = reffile  = io.get_night_files(date, kind="cube.basic", target=ref)[0]
-    refcube  = get_sedmcube(reffile)
+    # - lazy: only the [lbda_min, lbda_max] rows are read.
+    refcube  = get_sedmcube(reffile, lazy=True)
     sliceref = refcube.get_slice(lbda_min=lbda_min, lbda_max=lbda_max, usemean=True)
     # - How to normalize the Flat
     if kind in ["med", "median"]:
@@ -192,8 +221,8 @@ def build_backgrounds(date, smoothing=[0,5], start=2, jump=10,
     fileccds = []
     if not only_lamps:
         crrfiles  = io.get_night_files(date, "ccd.crr", target=target)
-        if skip_calib: fileccds = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
-        fileccds += crrfiles
+        fileccds  = [f for f,name in zip(crrfiles, io.fetch_header_values(crrfiles,"Name")) if "Calib" not in name] \
+          if skip_calib else crrfiles
 
     # - Building the background
     tmap = io.load_nightly_tracematch(date)
@@ -216,13 +245,22 @@ def build_wavesolution(date, verbose=False, ntest=None, idxrange=None,
                        use_fine_tuned_traces=False,
                        wavedegree=5, contdegree=3, show_progress=False,
                        lamps=["Hg","Cd","Xe"], savefig=True, saveindividuals=False,
-                       xybounds=None, rebuild=True):
+                       xybounds=None, rebuild=True, ncore=None, linefit_method="lsq"):
     """ Create the wavelength solution for the given night.
     The core of the solution fitting is made in pysedm.wavesolution.
 
     Parameters
     ----------
-    
+    ncore: [int] -optional-
+        Number of processes fitting the traces (see wavesolution.fit_wavesolution_parallel).
+        If None, all but one cpu. ncore=1 means no multiprocessing.
+
+    linefit_method: [string] -optional-
+        How the arc lines are fitted (see wavesolution.fit_spaxel_wavelesolution):
+        - lsq: least-squares with analytic Jacobian, with line positions seeded
+               by the already solved neighboring traces (if the night hexagrid exists)
+        - modefit: modefit fit with static guesses (slow, ~3s per trace)
+
     Returns
     -------
 
@@ -264,32 +302,53 @@ def build_wavesolution(date, verbose=False, ntest=None, idxrange=None,
         idxall = [l for l in idxall if l>=idxrange[0] and l<idxrange[1]]
     idx = idxall if ntest is None else np.random.choice(idxall,ntest, replace=False) 
 
-    # - Do The loop and map it thanks to astropy
-    def fitsolution(idx_):
-        if saveindividuals:
-            saveplot = timedir+"%s_wavesolution_trace%d.pdf"%(date,idx_)
-        else:
-            saveplot = None
-        csolution.fit_wavelesolution(traceindex=idx_, saveplot=None,
-                    contdegree=contdegree, wavedegree=wavedegree, plotprop={"show_guesses":True})
-        if saveplot is not None:
-            csolution._wsol.show(show_guesses=True, savefile=saveplot)
-            mpl.close("all")
-
-    if show_progress:
-        from astropy.utils.console import ProgressBar
-        from ..utils import tools
-        notebook = tools.is_running_from_notebook()
-        bar = ProgressBar( len(index_columnidx), ipython_widget=notebook)
+    # - Neighbors seeding
+    hexagrid = None
+    if linefit_method in ["lsq"]:
+        try:
+            hexagrid = io.load_nightly_hexagonalgrid(date)
+        except Exception:
+            warnings.warn("No hexagrid for %s, the line positions will not be seeded by neighboring traces."%date)
+
+    # - Multiprocessing: one pool sharing the lamp spectra, results streamed into csolution
+    if ncore is None or ncore > 1:
+        from ..wavesolution import fit_wavesolution_parallel
+        fit_wavesolution_parallel(lamps, idx, wavesolution=csolution, ncore=ncore,
+                                  contdegree=contdegree, wavedegree=wavedegree,
+                                  hexagrid=hexagrid, method=linefit_method,
+                                  saveplot=timedir+"%s_wavesolution_trace%%d.pdf"%date if saveindividuals else None,
+                                  show_progress=show_progress)
+    # - No multiprocessing
     else:
-        bar = None
-
-    for j,i_ in enumerate(idx):
-        fitsolution(i_)
+        def fitsolution(idx_):
+            if saveindividuals:
+                saveplot = timedir+"%s_wavesolution_trace%d.pdf"%(date,idx_)
+            else:
+                saveplot = None
+            csolution.fit_wavelesolution(traceindex=idx_, saveplot=None,
+                        contdegree=contdegree, wavedegree=wavedegree, plotprop={"show_guesses":True},
+                        hexagrid=hexagrid, method=linefit_method)
+            if saveplot is not None:
+                csolution._wsol.show(show_guesses=True, savefile=saveplot)
+                mpl.close("all")
+
+        if show_progress:
+            from astropy.utils.console import ProgressBar
+            from ..utils import tools
+            notebook = tools.is_running_from_notebook()
+            bar = ProgressBar( len(idx), ipython_widget=notebook)
+        else:
+            bar = None
+
+        if hexagrid is not None:
+            from ..wavesolution import sort_traces_by_neighbors
+            idx = sort_traces_by_neighbors(idx, hexagrid)
+        for j,i_ in enumerate(idx):
+            fitsolution(i_)
+            if bar is not None:
+                bar.update(j)
         if bar is not None:
-            bar.update(j)
-    if bar is not None:
-        bar.update(len(idx))
+            bar.update(len(idx))
         
     # - output - #
     outfile = "%s_WaveSolution"%date
@@ -329,7 +388,7 @@ def build_night_cubes(date, target=None, lamps=True, only_lamps=False,
         fileccds += io.get_night_files(date, "ccd.lamp", target=target)
     if not only_lamps:
         crrfiles  = io.get_night_files(date, "ccd.crr", target=target)
-        if skip_calib: crrfiles = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
+        if skip_calib: crrfiles = [f for f,name in zip(crrfiles, io.fetch_header_values(crrfiles,"Name")) if "Calib" not in name]
         fileccds += crrfiles
 
     print("fileccds:", fileccds)
@@ -341,6 +400,7 @@ def build_night_cubes(date, target=None, lamps=True, only_lamps=False,
 # ----------------- #
 def build_cubes(ccdfiles,  date, lbda=None,
                 tracematch=None, wavesolution=None, hexagrid=None,
+                tracemaskcache=None,
                 # Background:
                 nobackground = False,
                 # Flat Field
@@ -354,7 +414,7 @@ def build_cubes(ccdfiles,  date, lbda=None,
                 build_guider=True, solve_wcs=False,
                 fileindex=None, show_progress=False,
                 savefig=True, verbose=True, 
-                ncore=None):
+                ncore=None, nprocess=1, maxinflight=None):
     """ Build a cube from the an IFU ccd image. This image 
     should be bias corrected and cosmic ray corrected.
 
@@ -386,6 +446,12 @@ def build_cubes(ccdfiles,  date, lbda=None,
         The Hexagonal Grid tools containing the index<->qr<->xy conversions.
         If None, this will be loaded using `date`.
 
+    tracemaskcache: [TraceMaskCache] -optional-
+        The nightly trace masks for a grid of j-shifts used to get the 
+        trace flexure corrected masks (only if traceflexure_corrected).
+        If None, this will be loaded using `date` if it exists, 
+        otherwise the masks are measured for each ccd.
+
     flatfield: [Slice] -optional-
         Object containing the relative transmission of the IFU spaxels.
         If None, this will be loaded using `date`.
@@ -400,6 +466,7 @@ def build_cubes(ccdfiles,  date, lbda=None,
         - Remark, this means the cube will be built twice: 
             - 1 time to estimated the flexure
             - 1 time with flexure correction applied.
+          (the trace fluxes are extracted from the ccd only once)
 
     flatfielded: [bool] -optional-
         Shall the cube be flatfielded?
@@ -420,84 +487,299 @@ def build_cubes(ccdfiles,  date, lbda=None,
         If None, this will load the latest fluxcal object of the night.
         If Nothing found, no flux calibrated cube will be created. 
 
+    // Execution //
+
+    ncore: [int] -optional-
+        number of cores used within the frame steps (trace masks, background).
+
+    nprocess: [int] -optional-
+        number of frames built concurrently (see build_cubes_parallel()).
+        1 means frame after frame in this process, None means all but one cpu.
+        In any case the ccds are loaded one at the time and released once 
+        their cube is written.
+
+    maxinflight: [int] -optional-
+        maximum number of frames being processed at once (if nprocess>1).
+        If None, nprocess.
+
     Returns
     -------
-    Void
+    list of the cube filenames, one per ccd file (whatever nprocess).
+    If nprocess>1, the frames whose cube failed to build are None 
+    (a warning is issued); if nprocess=1 the error is raised.
     """
-    if traceflexure_corrected:
-        from ..flexure import get_ccd_jflexure
-    # ------------------ #
-    # Loading the Inputs #
-    # ------------------ #
-    if tracematch is None:
-        tracematch   = io.load_nightly_tracematch(date, withmask=False if traceflexure_corrected else True) 
-        
-    if hexagrid is None:
-        hexagrid     = io.load_nightly_hexagonalgrid(date)
-    
-    if wavesolution is None:
-        wavesolution = io.load_nightly_wavesolution(date)
-        wavesolution._load_full_solutions_()
-    
     if lbda is None:
         lbda = SEDM_LBDA
 
-    if flatfielded and flatfield is None:
-        flatfield = io.load_nightly_flat(date)
-        
     # ---------------- #
-    # Loading the CCDS #
+    # Build the Cubes  #
     # ---------------- #
-    ccds = []
-    for ccdfile in ccdfiles:
-        flexuresavefile = None if not savefig else [ccdfile.replace("crr","flexuretrace_crr").replace(".fits",".pdf"),
-                                                    ccdfile.replace("crr","flexuretrace_crr").replace(".fits",".png")]
+    # Frames are streamed: each ccd is loaded, corrected, extracted, 
+    # written and released before the next one (see _build_frame_cube_)
+    calibrations = dict(tracematch=tracematch, tracemaskcache=tracemaskcache,
+                        wavesolution=wavesolution, hexagrid=hexagrid,
+                        flatfield=flatfield, lbda=lbda)
+    options = dict(traceflexure_corrected=traceflexure_corrected, nobackground=nobackground,
+                   build_guider=build_guider, solve_wcs=solve_wcs, ncore=ncore,
+                   # build_sedmcube
+                   flexure_corrected=flexure_corrected,
+                   flatfielded=flatfielded, atmcorrected=atmcorrected, 
+                   build_calibrated_cube=build_calibrated_cube,
+                   calibration_ref=calibration_ref,
+                   fileindex=fileindex, savefig=savefig)
+
+    ccdfiles = list(ccdfiles)
+    if nprocess is None:
+        import multiprocessing
+        nprocess = np.max([multiprocessing.cpu_count() - 1, 1])
+    nprocess = int(np.min([nprocess, len(ccdfiles)]))
+
+    if nprocess <= 1:
+        calibrations = load_cube_calibrations(date, calibrations, options)
+        built = [_build_frame_cube_(ccdfile, date, calibrations, options) for ccdfile in ccdfiles]
+    else:
+        built = build_cubes_parallel(ccdfiles, date, calibrations, options,
+                                    nprocess=nprocess, maxinflight=maxinflight)
+
+    # - per-night timing report (only if the instrumentation is enabled)
+    timing.write_report(io.get_datapath(date)+"%s_Timing"%date)
+    return built
+
+
+# - Multi-frame Pool
+_CUBE_BUILDER = {}
+
+def load_cube_calibrations(date, calibrations, options, warn=True):
+    """ load the nightly calibrations needed to build the cubes that are not given.
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    calibrations: [dict]
+        tracematch, tracemaskcache, wavesolution, hexagrid, flatfield and lbda.
+        None values are loaded (see io.load_nightly_*)
+
+    options: [dict]
+        build options (traceflexure_corrected and flatfielded are used)
+
+    warn: [bool] -optional-
+        warns if no TraceMaskCache exists for this night.
+
+    Returns
+    -------
+    dict (copy of calibrations)
+    """
+    calibrations = calibrations.copy()
+    if calibrations["tracematch"] is None:
+        calibrations["tracematch"] = io.load_nightly_tracematch(date, withmask=False if options["traceflexure_corrected"] else True)
+        
+    if calibrations["hexagrid"] is None:
+        calibrations["hexagrid"] = io.load_nightly_hexagonalgrid(date)
+    
+    if calibrations["wavesolution"] is None:
+        calibrations["wavesolution"] = io.load_nightly_wavesolution(date)
+        calibrations["wavesolution"]._load_full_solutions_()
+
+    if options["traceflexure_corrected"] and calibrations["tracemaskcache"] is None:
+        try:
+            calibrations["tracemaskcache"] = io.load_nightly_tracemaskcache(date)
+        except IOError:
+            if warn:
+                warnings.warn("No TraceMaskCache for %s, trace masks will be measured for each ccd."%date)
+    
+    if calibrations["lbda"] is None:
+        calibrations["lbda"] = SEDM_LBDA
+
+    if options["flatfielded"] and calibrations["flatfield"] is None:
+        calibrations["flatfield"] = io.load_nightly_flat(date)
+
+    return calibrations
+
+def _init_cube_builder_(date, calibrations, options, timinghooks=None):
+    """ Pool initializer: only harmless setup here (a raising initializer makes the pool
+    respawn its workers forever). The calibrations are loaded by the parent process
+    and inherited by the workers. """
+    import matplotlib
+    matplotlib.use("Agg")
+    # - a fresh timer per worker, its records are sent back with each frame.
+    timing.disable()
+    if timinghooks is not None:
+        timing.enable(hooks=timinghooks)
+    _CUBE_BUILDER["date"] = date
+    _CUBE_BUILDER["calibrations"] = calibrations
+    # no nested pools within the workers.
+    _CUBE_BUILDER["options"] = {**options, "ncore":1}
+
+def _build_shared_frame_cube_(ccdfile):
+    """ Pool task: build the cube of the given ccd file.
+    Returns [ccdfile, cube filename (None if failed), timing records] """
+    try:
+        built = _build_frame_cube_(ccdfile, _CUBE_BUILDER["date"],
+                                   _CUBE_BUILDER["calibrations"], _CUBE_BUILDER["options"])
+        mpl.close("all")
+    except Exception as e:
+        warnings.warn("cube building failed for %s: %s"%(ccdfile, e))
+        built = None
+
+    timer = timing.get_timer()
+    records = timer.get_records(frame=ccdfile) if timer is not None else []
+    if timer is not None:
+        timer.records.clear()
+    return [ccdfile, built, records]
+
+def build_cubes_parallel(ccdfiles, date, calibrations, options,
+                             nprocess=None, maxinflight=None):
+    """ Build the cubes of the given ccd files within a multiprocessing Pool.
+
+    Each worker runs the whole chain of a frame (load -> trace flexure -> background
+    -> extract -> flexure -> flat/atm -> write, see _build_frame_cube_), such that 
+    the frames flow through the stages concurrently. The read-only nightly calibrations
+    are loaded once, by this process, and shared with the workers. At most `maxinflight` frames are sent to the pool at once,
+    a new one being sent each time one is done: the memory is bounded whatever the number of frames.
+
+    Parameters
+    ----------
+    ccdfiles: [list of string]
+        ccd files (crr_b_ifu*.fits) to build the cubes from.
+
+    date: [string]
+        YYYYMMDD
+
+    calibrations: [dict]
+        tracematch, tracemaskcache, wavesolution, hexagrid, flatfield and lbda.
+        None values are loaded here for the given date, before the pool starts
+        (so missing calibrations raise right away).
+    
+    options: [dict]
+        build options (see build_cubes())
+
+    nprocess: [int] -optional-
+        number of processes. If None, all but one cpu.
+
+    maxinflight: [int] -optional-
+        maximum number of frames being processed at once. If None, nprocess.
+
+    Returns
+    -------
+    list of the cube filenames (None if the cube failed to build)
+    """
+    import multiprocessing
+    import queue
+    if nprocess is None:
+        nprocess = np.max([multiprocessing.cpu_count() - 1, 1])
+    if maxinflight is None:
+        maxinflight = nprocess
+
+    if options.get("build_guider", False):
+        # - the night guider catalog is built once here, not by each worker.
+        from .. import rainbowcam
+        try:
+            rainbowcam.get_guider_catalog(date)
+        except (IOError, OSError):
+            pass
+
+    # - fails fast (e.g. no TraceMatch for this night), workers inherit the loaded objects.
+    calibrations = load_cube_calibrations(date, calibrations, options)
+
+    done = queue.Queue()
+    status = {}
+    timer = timing.get_timer()
+    with multiprocessing.Pool(nprocess, initializer=_init_cube_builder_,
+                              initargs=(date, calibrations, options,
+                                        timer.hooks if timer is not None else None)) as p:
+        # - bounded: a new frame is sent each time one is done.
+        for ccdfile in ccdfiles[:maxinflight]:
+            p.apply_async(_build_shared_frame_cube_, (ccdfile,), callback=done.put,
+                          error_callback=done.put)
+        nsent = np.min([maxinflight, len(ccdfiles)])
+        for j in range(len(ccdfiles)):
+            result = done.get()
+            if isinstance(result, Exception):
+                raise result
+            status[result[0]] = result[1]
+            if timer is not None:
+                timer.add_records(result[2])
+            print("%d/%d cubes done (%s)"%(j+1, len(ccdfiles), result[0].split("/")[-1]))
+            if nsent < len(ccdfiles):
+                p.apply_async(_build_shared_frame_cube_, (ccdfiles[nsent],), callback=done.put,
+                              error_callback=done.put)
+                nsent += 1
+
+    return [status[f] for f in ccdfiles]
+
+def _build_frame_cube_(ccdfile, date, calibrations, options):
+    """ load, correct and extract the cube of one ccd file.
+    The ccd is released once the cube is written.
+    The stages are timed if the instrumentation is enabled (see utils.timing).
+
+    Parameters
+    ----------
+    calibrations, options: [dict]
+        see build_cubes_parallel()
+
+    Returns
+    -------
+    string (filename of the cube)
+    """
+    with timing.frame(ccdfile):
+        return _build_frame_cube_stages_(ccdfile, date, calibrations, options)
+
+def _build_frame_cube_stages_(ccdfile, date, calibrations, options):
+    """ see _build_frame_cube_ """
+    tracematch, tracemaskcache = calibrations["tracematch"], calibrations["tracemaskcache"]
+    traceflexure_corrected = options["traceflexure_corrected"]
+    ncore = options["ncore"]
+    
+    # - Load and trace flexure
+    flexuresavefile = None if not options["savefig"] else [ccdfile.replace("crr","flexuretrace_crr").replace(".fits",".pdf"),
+                                                           ccdfile.replace("crr","flexuretrace_crr").replace(".fits",".png")]
+    with timing.stage("load_ccd"):
         ccd_    = get_ccd(ccdfile, tracematch = tracematch, background = 0,
                               correct_traceflexure = traceflexure_corrected,
                               savefile_traceflexure=flexuresavefile)
-        if traceflexure_corrected:
-            load_trace_masks(ccd_.tracematch,
+    if traceflexure_corrected:
+        with timing.stage("trace_masks"):
+            if tracemaskcache is not None and tracemaskcache.width == ccd_.tracematch.width:
+                tracemaskcache.set_shifted_masks(ccd_.tracematch, ccd_.header["CCDJFLX"])
+            else:
+                load_trace_masks(ccd_.tracematch,
                                 ccd_.tracematch.get_traces_within_polygon(INDEX_CCD_CONTOURS),
                                 ncore=ncore)
-            
-        if not nobackground:
+    # - Background
+    if not options["nobackground"]:
+        with timing.stage("background"):
             ccd_.fetch_background(set_it=True, build_if_needed=True, ncore=ncore)
-            ccd_.header["CCDBKGD"] = (True, "is the ccd been background subtracted?")
-        else:
-            ccd_.header["CCDBKGD"] = (False, "is the ccd been background subtracted?")
-            
-        # - Variance
-        if not ccd_.has_var():
-            ccd_.set_default_variance()
-        ccds.append(ccd_)
-            
-    # ---------------- #
-    # Build the Cubes  #
-    # ---------------- #
-    # internal routine 
-    def _build_cubes_(ccdin):
-        print(ccdin.filename)
-        prop = dict(lbda=lbda, wavesolution=wavesolution, hexagrid=hexagrid,
-                    flexure_corrected=flexure_corrected,
-                    flatfielded=flatfielded, flatfield=flatfield,
-                    atmcorrected=atmcorrected, 
-                    build_calibrated_cube=build_calibrated_cube,
-                    calibration_ref=calibration_ref,
-                    fileindex=fileindex,
-                    savefig=savefig)
-        if build_guider:
-            from pysedm import rainbowcam
+        ccd_.header["CCDBKGD"] = (True, "is the ccd been background subtracted?")
+    else:
+        ccd_.header["CCDBKGD"] = (False, "is the ccd been background subtracted?")
+        
+    # - Variance
+    if not ccd_.has_var():
+        ccd_.set_default_variance()
+
+    # - Guider
+    print(ccd_.filename)
+    if options["build_guider"]:
+        from pysedm import rainbowcam
+        with timing.stage("guider"):
             try:
                 print("INFO: building the guider image")
-                rainbowcam.build_meta_ifu_guider(ccdin.filename, solve_wcs=solve_wcs)
+                rainbowcam.build_meta_ifu_guider(ccd_.filename, solve_wcs=options["solve_wcs"])
             except:
                 print("WARNING: rainbowcam cannot build the guider image")
 
-        build_sedmcube(ccdin, date,  **prop)
-            
-            
-    # The actual build
-    return [_build_cubes_(ccd_) for ccd_ in ccds]
+    # - Extract, flexure, flat/atm and write
+    return build_sedmcube(ccd_, date, lbda=calibrations["lbda"],
+                   wavesolution=calibrations["wavesolution"], hexagrid=calibrations["hexagrid"],
+                   flexure_corrected=options["flexure_corrected"],
+                   flatfielded=options["flatfielded"], flatfield=calibrations["flatfield"],
+                   atmcorrected=options["atmcorrected"], 
+                   build_calibrated_cube=options["build_calibrated_cube"],
+                   calibration_ref=options["calibration_ref"],
+                   fileindex=options["fileindex"],
+                   savefig=options["savefig"])
         
 
 # ---------------- #
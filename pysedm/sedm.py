@@ -12,6 +12,7 @@ from propobject           import BaseObject
 # pyifu
 from pyifu.spectroscopy   import Cube, Spectrum, get_spectrum, load_spectrum
 from .utils import tools
+from .utils import timing
 
 from . import io
 
@@ -229,7 +230,7 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
                    fileindex="",
                    # Flexure
                    flexure_corrected=True,
-                   pixel_shift=0,
+                   pixel_shift=0, pixelspectra=None,
                    # Flat and Atm
                    flatfielded=True, atmcorrected=True,
                    # Flux Calibration
@@ -282,6 +283,11 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
     pixel_shift: [float] -optional-
         number of i-ccd pixel shift (usually a fraction of pixel) caused by flexure.
 
+    pixelspectra: [dict] -optional-
+        flux and variance per pixels of the traces (see ccd.get_pixel_spectra()).
+        If None, this is extracted from the ccd. 
+        The flexure corrected cube re-uses the one of the first extraction.
+
     // Action Selection //
 
     flatfielded: [bool] -optional-
@@ -305,7 +311,7 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
 
     Returns
     -------
-    Void (or Cube if return_cube set to True)
+    filename of the written cube (or Cube if return_cube set to True)
     """
     from . import io
     # - IO information
@@ -336,8 +342,16 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
         flatfield = io.load_nightly_flat(date)
 
     # - Build the Cube
-    cube = ccd.extract_cube(wavesolution, lbda, hexagrid=hexagrid, show_progress=False,
-                            pixel_shift=pixel_shift)
+    traceindexes = [i_ for i_ in np.sort(list(wavesolution.wavesolutions.keys()))
+                        if i_ in hexagrid.ids_index.keys()]
+    if pixelspectra is None:
+        with timing.stage("pixel_spectra"):
+            pixelspectra = ccd.get_pixel_spectra(traceindexes)
+
+    with timing.stage("extract_cube"):
+        cube = ccd.extract_cube(wavesolution, lbda, hexagrid=hexagrid, show_progress=False,
+                                traceindexes=traceindexes,
+                                pixel_shift=pixel_shift, pixelspectra=pixelspectra)
 
     # - passing the header inforation
     for k,v in ccd.header.items():
@@ -375,12 +389,15 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
         print("Flexure Correction ongoing ")
         from .wavesolution import Flexure
         from .mapping      import Mapper
-        mapper = Mapper(tracematch= ccd.tracematch, wavesolution = wavesolution, hexagrid=hexagrid)
-        mapper.derive_spaxel_mapping( list(wavesolution.wavesolutions.keys()) )
+        with timing.stage("flexure_mapping"):
+            mapper = Mapper(tracematch= ccd.tracematch, wavesolution = wavesolution, hexagrid=hexagrid)
+            mapper.derive_spaxel_mapping( list(wavesolution.wavesolutions.keys()) )
 
         flexure = Flexure(cube, mapper=mapper)
-        flexure.load_telluric_fit()
-        flexure.load_sodium_fit()
+        with timing.stage("flexure_telluric_fit"):
+            flexure.load_telluric_fit()
+        with timing.stage("flexure_sodium_fit"):
+            flexure.load_sodium_fit()
 
         if savefig:
             cube._side_properties["filename"] = fileout
@@ -392,16 +409,17 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
         i_shift = flexure.get_i_flexure(FLEXURE_REF)
 
         print("Getting the flexure corrected cube. ")
-        cube = build_sedmcube(ccd, date, lbda=lbda, flatfield=flatfield,
-                                  wavesolution=wavesolution, hexagrid=hexagrid,
-                                  flatfielded=flatfielded, atmcorrected=atmcorrected,
-                                  calibration_ref=calibration_ref,
-                                  build_calibrated_cube=build_calibrated_cube,
-                                  savefig=savefig,
-                                  # Flexure Change
-                                  flexure_corrected=False,
-                                  pixel_shift= i_shift,
-                                  return_cube=True)
+        with timing.stage("flexure_extraction"):
+            cube = build_sedmcube(ccd, date, lbda=lbda, flatfield=flatfield,
+                                      wavesolution=wavesolution, hexagrid=hexagrid,
+                                      flatfielded=flatfielded, atmcorrected=atmcorrected,
+                                      calibration_ref=calibration_ref,
+                                      build_calibrated_cube=build_calibrated_cube,
+                                      savefig=savefig,
+                                      # Flexure Change
+                                      flexure_corrected=False,
+                                      pixel_shift= i_shift, pixelspectra=pixelspectra,
+                                      return_cube=True)
 
         cube.header['IFLXCORR']  = (True, "Has the Flexure been corrected?")
         cube.header['IFLXREF']   = (",".join(np.atleast_1d(FLEXURE_REF)), "Which line has been used to correct flexure?")
@@ -416,12 +434,16 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
     if return_cube:
         return cube
 
+    # - stage timings (no-op unless utils.timing is enabled)
+    timing.set_header_keywords(cube.header)
     cube.writeto(fileout)
 
     # - Build Also a flux calibrated cube?
     if build_calibrated_cube:
         build_calibrated_sedmcube(fileout, date=date, calibration_ref=calibration_ref)
 
+    return fileout
+
 def build_calibrated_sedmcube(cubefile, date=None, calibration_ref=None, kindout=None):
     """ """
 
@@ -498,24 +520,34 @@ def get_sedm_flatcube(domecube, s=0.8, loc=4300):
 # ------------------ #
 #  Main Functions    #
 # ------------------ #
-def load_sedmcube(filename, apply_byecr=False, **kwargs):
+def load_sedmcube(filename, apply_byecr=False, lazy=False, **kwargs):
     """Load a Cube from the given filename
 
     Returns
     -------
-    Cube
+    Cube (LazySEDMCube if lazy)
     """
     # To be split between load and get
-    return get_sedmcube(filename, apply_byecr=apply_byecr, **kwargs)
+    return get_sedmcube(filename, apply_byecr=apply_byecr, lazy=lazy, **kwargs)
 
 
-def get_sedmcube(filename, apply_byecr=False, **kwargs):
+def get_sedmcube(filename, apply_byecr=False, lazy=False, **kwargs):
     """ Load a Cube from the given filename
 
+    lazy: [bool] -optional-
+        return a LazySEDMCube: only the header is read, the data are memory-mapped
+        and only the requested slice/spaxels are read (see LazySEDMCube).
+        Not compatible with apply_byecr.
+
     Returns
     -------
-    Cube
+    Cube (LazySEDMCube if lazy)
     """
+    if lazy:
+        if apply_byecr:
+            raise ValueError("apply_byecr requires the full cube, it cannot be used with lazy=True")
+        return LazySEDMCube(filename)
+
     cube = SEDMCube(filename, **kwargs)
     if apply_byecr:
         try:
@@ -1812,20 +1844,11 @@ class SEDMCube( Cube ):
         
         # Get the affected spaxels
         byecrcl = byecr.SEDM_BYECR(night, self)
-        cr_df = byecrcl.get_cr_spaxel_info(cut_criteria=cut_criteria)
         
-        # and NaN their flux.
-        newdata = self.data.copy()
-        newdata[cr_df["cr_lbda_index"], cr_df["cr_spaxel_index"]] = np.nan
-        # Update the header...
-        newheader = self.header.copy()
-        newheader.set("NCR", len(cr_df), "total number of detected cosmic-rays from byecr")
-        newheader.set("NCRSPX", len(np.unique(cr_df["cr_spaxel_index"])), "total number of cosmic-ray affected spaxels")
+        # NaN their flux and update the header...
+        newcube = byecrcl.get_cr_cube(cut_criteria=cut_criteria)
         # ..and the filename
-        newfilename = self.filename.replace("e3d_crr","e3d_byecr")
-
-        newcube = self.get_new(newdata=newdata, newheader=newheader)
-        newcube.set_filename(newfilename)
+        newcube.set_filename(self.filename.replace("e3d_crr","e3d_byecr"))
         return newcube
 
     
@@ -2087,6 +2110,259 @@ class SEDMCube( Cube ):
             return iplot
 
 
+class LazySEDMCube( BaseObject ):
+    """ e3d cube whose data are only read when needed.
+
+    The header is read alone and the data/variance are memory-mapped:
+    get_slice() only reads the wavelength rows of the requested range and
+    get_spectrum() only the requested spaxels. get_cube() loads the full SEDMCube.
+    """
+    PROPERTIES         = ["filename"]
+    SIDE_PROPERTIES    = ["hdulist"]
+    DERIVED_PROPERTIES = ["header", "lbda", "indexes", "mapping", "spaxel_vertices"]
+
+    def __init__(self, filename=None):
+        """ """
+        if filename is not None:
+            self._properties["filename"] = filename
+
+    # ================ #
+    #  Main Methods    #
+    # ================ #
+    def get_cube(self, **kwargs):
+        """ the full SEDMCube (see get_sedmcube()) """
+        return get_sedmcube(self.filename, **kwargs)
+
+    def close(self):
+        """ close the memory-mapped file (re-opened if data are needed again) """
+        if self._side_properties["hdulist"] is not None:
+            self._side_properties["hdulist"].close()
+            self._side_properties["hdulist"] = None
+
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def get_lbda_range(self, lbda_min=None, lbda_max=None):
+        """ first and last+1 row of the wavelength range (inclusive boundaries, None means no limit) """
+        if lbda_min is None: lbda_min = self.lbda[0]
+        if lbda_max is None: lbda_max = self.lbda[-1]
+        if lbda_min > lbda_max: lbda_min, lbda_max = lbda_max, lbda_min
+        rows = np.argwhere((self.lbda >= lbda_min) & (self.lbda <= lbda_max)).ravel()
+        if len(rows) == 0:
+            raise ValueError("no wavelength within [%s, %s]"%(lbda_min, lbda_max))
+        return rows[0], rows[-1]+1
+
+    def get_slice(self, lbda_trans=None, lbda_min=None, lbda_max=None, index=None,
+                      usemean=True, data="data", slice_object=False):
+        """ [weighted] average of the spaxels within the given wavelength range
+        (same signature as Cube.get_slice), reading only the rows needed.
+
+        Parameters
+        ----------
+        lbda_trans: [None or [array, array]] -optional-
+            wavelength and transmission of the filter to apply to the data
+            i.e: lbda_trans = [lbda_filter, trans_filter]
+            Only the rows covered by the filter are read.
+
+        lbda_min, lbda_max: [float/None] -optional-
+            boundaries (in Angstrom) of the slice. None means no limit.
+            *Ignored if lbda_trans or index provided*
+
+        index: [int] -optional-
+            row of the cube slice you want. *Ignored if lbda_trans provided*
+
+        usemean: [bool] -optional-
+            simple mean (nanmean) if True, inverse-variance weighted mean otherwise
+            (if the cube has a variance).
+
+        data: [string] -optional-
+            "data" or "variance". The simple mean is used for the variance.
+
+        slice_object: [bool] -optional-
+            Shall this returns a pyifu Slice (with the cube header) or just the data?
+
+        Returns
+        -------
+        array (or Slice)
+        """
+        if data not in ["data", "variance"]:
+            raise ValueError("data must be 'data' or 'variance' for a LazySEDMCube (%s given)"%data)
+        values = self.data if data == "data" else self.variance
+        hasvariance = data == "data" and self.has_variance()
+        
+        if lbda_trans is not None:
+            from pyifu.spectroscopy import synthesize_photometry3d
+            try:
+                lbda_f, trans_f = [np.asarray(l_) for l_ in lbda_trans]
+            except:
+                raise ValueError("lbda_trans must be a 2D array if not None; lbda_f, trans_f = lbda_trans")
+            order = np.argsort(lbda_f)
+            lbda_f, trans_f = lbda_f[order], trans_f[order]
+            # the transmission is extended beyond the filter (np.interp): only a 0 edge bounds the rows.
+            start = 0 if trans_f[0] != 0 else \
+              int(np.clip(np.searchsorted(self.lbda, lbda_f[0])-1, 0, None))
+            end = len(self.lbda) if trans_f[-1] != 0 else \
+              int(np.clip(np.searchsorted(self.lbda, lbda_f[-1], side="right")+1, None, len(self.lbda)))
+            slice_data = synthesize_photometry3d(self.lbda[start:end], values[start:end], lbda_f, trans_f)
+            slice_var  = synthesize_photometry3d(self.lbda[start:end], self.variance[start:end], lbda_f, trans_f) \
+              if hasvariance else None
+            lbda = np.average(lbda_f, weights=trans_f)
+            
+        elif index is not None:
+            slice_data = np.asarray(values[index])
+            slice_var  = np.asarray(self.variance[index]) if hasvariance else None
+            lbda = self.lbda[index]
+            
+        else:
+            start, end = self.get_lbda_range(lbda_min, lbda_max)
+            rows = values[start:end]
+            variance = self.variance[start:end] if hasvariance else None
+            if usemean or variance is None:
+                slice_data = np.nanmean(rows, axis=0)
+            else:
+                slice_data = np.sum(rows/variance, axis=0) / np.sum(1./variance, axis=0)
+            slice_var = np.nanmean(variance, axis=0) if variance is not None else None
+            lbda = np.mean(self.lbda[start:end])
+
+        if not slice_object:
+            return slice_data
+
+        from pyifu.spectroscopy import get_slice
+        slice_ = get_slice(slice_data, self.index_to_xy(self.indexes), spaxel_vertices=self.spaxel_vertices,
+                           variance=slice_var, indexes=self.indexes, lbda=lbda)
+        slice_.set_header(self.header.copy())
+        return slice_
+
+    def get_spectrum(self, index, usemean=False, spaxelindexes=False):
+        """ Spectrum of the given index, mean spectrum if several (as Cube.get_spectrum),
+        reading only these spaxels.
+
+        Parameters
+        ----------
+        index: [int, list of]
+            entries of self.indexes (or spaxel indexes if spaxelindexes)
+
+        usemean: [bool] -optional-
+            combine several spectra with a simple mean rather than the inverse-variance weighted one.
+
+        spaxelindexes: [bool] -optional-
+            index are the spaxel indexes (as in self.indexes) and not entries of self.indexes.
+
+        Returns
+        -------
+        Spectrum
+        """
+        columns = index if not spaxelindexes else np.arange(len(self.indexes))[np.isin(self.indexes, index)]
+        data = self.data[:, columns]
+        variance = self.variance[:, columns] if self.has_variance() else None
+        if np.ndim(data) == 2:
+            if not usemean and variance is not None and not np.isnan(variance).any():
+                data = np.average(data, weights=1./variance, axis=1)
+            else:
+                data = np.nanmean(data, axis=1)
+            if variance is not None:
+                variance = np.nanmean(variance, axis=1) / np.shape(columns)[0]
+
+        spec = Spectrum(None)
+        spec.create(data=np.asarray(data), variance=np.asarray(variance) if variance is not None else None,
+                    header=None, lbda=self.lbda)
+        return spec
+
+    def get_faintest_spaxels(self, nspaxels, lbda_range=None, avoid_indexes=None, **kwargs):
+        """ entries of self.indexes of the `nspaxels` faintest spaxels within the wavelength range
+        (see Cube.get_faintest_spaxels). **kwargs goes to get_slice() """
+        lbda_min, lbda_max = [None, None] if lbda_range is None else lbda_range
+        avoid_indexes = [] if avoid_indexes is None else list(avoid_indexes)
+        sorted_ = np.argsort(self.get_slice(lbda_min=lbda_min, lbda_max=lbda_max, **kwargs))
+        return [i for i in sorted_ if i not in avoid_indexes][:nspaxels]
+
+    def index_to_xy(self, indexes):
+        """ x,y position of the given spaxel indexes """
+        mapping = dict(zip(self.indexes, self.mapping))
+        return np.asarray([mapping[i] for i in np.atleast_1d(indexes)])
+
+    def has_variance(self):
+        """ """
+        return "VARIANCE" in self.hdulist
+
+    # ================ #
+    #  Properties      #
+    # ================ #
+    @property
+    def filename(self):
+        """ e3d filename """
+        return self._properties["filename"]
+
+    @property
+    def hdulist(self):
+        """ memory-mapped fits HDUList (opened at first need) """
+        if self._side_properties["hdulist"] is None:
+            from astropy.io import fits
+            self._side_properties["hdulist"] = fits.open(self.filename, memmap=True)
+        return self._side_properties["hdulist"]
+
+    @property
+    def header(self):
+        """ primary header (read alone, the file is not mapped for it) """
+        if self._derived_properties["header"] is None:
+            from astropy.io import fits
+            self._derived_properties["header"] = fits.getheader(self.filename)
+        return self._derived_properties["header"]
+
+    @property
+    def data(self):
+        """ memory-mapped flux [nlbda, nspaxels] """
+        return self.hdulist["PRIMARY"].data
+
+    @property
+    def variance(self):
+        """ memory-mapped variance [nlbda, nspaxels] (None if no variance) """
+        return self.hdulist["VARIANCE"].data if self.has_variance() else None
+
+    @property
+    def lbda(self):
+        """ wavelength array (from the header as pyifu e3d cubes, or the LBDA extension) """
+        if self._derived_properties["lbda"] is None:
+            header = self.header
+            if header.get("CDELT2", None) not in [None, ""] and header.get("CRVAL2", None) not in [None, ""]:
+                lbda = np.arange(header["NAXIS2"])*header["CDELT2"] + header["CRVAL2"]
+                logwave = header.get("logwave", None)
+                if logwave is None: logwave = header["CRVAL2"] < 50
+                self._derived_properties["lbda"] = np.exp(lbda) if logwave else lbda
+            else:
+                lbda = [f.data for f in self.hdulist if f.name.upper() in ["LBDA","LAMBDA", "WAVE", "WAVELENGTH","WAVELENGTHS"]]
+                if len(lbda) == 0:
+                    raise AttributeError("No wavelength information in %s"%self.filename)
+                self._derived_properties["lbda"] = np.asarray(lbda[0])
+        return self._derived_properties["lbda"]
+
+    @property
+    def indexes(self):
+        """ spaxel indexes """
+        if self._derived_properties["indexes"] is None:
+            self._derived_properties["indexes"] = np.asarray(self.hdulist["SPAX_ID"].data)
+        return self._derived_properties["indexes"]
+
+    @property
+    def mapping(self):
+        """ x,y position of the spaxels (same order as indexes) """
+        if self._derived_properties["mapping"] is None:
+            self._derived_properties["mapping"] = np.asarray(self.hdulist["MAPPING"].data)
+        return self._derived_properties["mapping"]
+
+    @property
+    def spaxel_vertices(self):
+        """ """
+        if self._derived_properties["spaxel_vertices"] is None and "SPAX_VERT" in self.hdulist:
+            self._derived_properties["spaxel_vertices"] = np.asarray(self.hdulist["SPAX_VERT"].data)
+        return self._derived_properties["spaxel_vertices"]
+
+    @property
+    def nspaxels(self):
+        """ """
+        return len(self.indexes)
+
+
 class ApertureSpectrum( Spectrum ):
     """ Spectrum created with apperture spectroscopy """
     PROPERTIES         = ["apweight", "background"]
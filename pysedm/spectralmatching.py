@@ -42,7 +42,7 @@ BACKCOLOR    = (0,0,0,0)
 ZOOMING      = 5 if _HAS_SKIMAGE else 1
 _BASEPIX     = np.asarray([[0,0],[0,1],[1,1],[1,0]])
 
-__all__ = ["load_tracematcher","get_tracematcher"]
+__all__ = ["load_tracematcher","get_tracematcher", "load_tracemask_cache"]
 
 
 def load_tracematcher(tracematchfile):
@@ -203,23 +203,192 @@ def get_boxing_polygone(x, y, rangex, width,
     
     return  geometry.Polygon(vertices)
 
+# ------------------------- # 
+#   Trace Column Bounds     #
+# ------------------------- #
+def get_trace_column_ybounds(xys, width, x):
+    """ Analytic y-bounds, at the ccd-x coordinate(s) `x`, of the traces.
+
+    The traces are the central segments buffered by `width` (round caps, 
+    as the Shapely buffer of TraceMatch.trace_linestring). Their vertical section is
+    the union of the caps (discs of radius width) and of the band between the two 
+    offset segments (y = center(x) +/- width/cos(theta)).
+
+    Parameters
+    ----------
+    xys: [(ntraces x 2 x 2) array]
+        the 2 points [[xa,ya],[xb,yb]] of the trace central lines
+
+    width: [float]
+        buffer around the central lines.
+
+    x: [float or array]
+        ccd-x coordinate(s). Must broadcast with ntraces.
+
+    Returns
+    -------
+    ylow, yhigh (arrays) [NaN where the trace does not cross x]
+    """
+    xys = np.asarray(xys, dtype="float")
+    # - such that xa <= xb
+    swap = xys[:,0,0] > xys[:,1,0]
+    (xa, ya), (xb, yb) = np.where(swap[:,None], xys[:,1], xys[:,0]).T, np.where(swap[:,None], xys[:,0], xys[:,1]).T
+    x = np.asarray(x, dtype="float")
+
+    yhigh = np.full(np.broadcast(x, xa).shape, -np.inf)
+    ylow  = np.full(np.broadcast(x, xa).shape,  np.inf)
+    # - Caps
+    for xc, yc in [[xa, ya], [xb, yb]]:
+        incap = np.abs(x-xc) <= width
+        h     = np.sqrt(np.clip(width**2-(x-xc)**2, 0, None))
+        yhigh = np.where(incap, np.maximum(yhigh, yc+h), yhigh)
+        ylow  = np.where(incap, np.minimum(ylow,  yc-h), ylow)
+
+    # - Band
+    length = np.hypot(xb-xa, yb-ya)
+    cos, sin = (xb-xa)/np.where(length>0, length, 1), (yb-ya)/np.where(length>0, length, 1)
+    flagband = cos > 1e-10 # vertical segments are covered by their caps.
+    slope  = (yb-ya)/np.where(flagband, xb-xa, 1)
+    center = ya + slope*(x-xa)
+    halfh  = width/np.where(flagband, cos, 1)
+    inup   = flagband * (x >= xa - width*sin) * (x <= xb - width*sin)
+    indown = flagband * (x >= xa + width*sin) * (x <= xb + width*sin)
+    yhigh  = np.where(inup,   np.maximum(yhigh, center+halfh), yhigh)
+    ylow   = np.where(indown, np.minimum(ylow,  center-halfh), ylow)
+
+    crossing = yhigh > ylow
+    return np.where(crossing, ylow, np.NaN), np.where(crossing, yhigh, np.NaN)
+
+# ------------------------- # 
+#   Polygon Rasterizer      #
+# ------------------------- #
+def _integrate_clamped_(u_left, u_right, dx):
+    """ integral over an interval of length dx of clamp(u, 0, 1), 
+    u varying linearly from u_left to u_right """
+    def _primitive_(u):
+        return np.where(u<0, 0, np.where(u>1, u-0.5, 0.5*u**2))
+    
+    du = u_right-u_left
+    flat = np.abs(du)<1e-10
+    return np.where(flat, np.clip(0.5*(u_left+u_right), 0, 1)*dx,
+                    dx*(_primitive_(u_right)-_primitive_(u_left))/np.where(flat, 1, du))
+
+def polygons_to_weights(vertices, shape=SEDM_CCD_SIZE, batchsize=200):
+    """ Exact fraction of each ccd pixel covered by the given polygons.
+    
+    This is the numpy (vectorized) version of the shapely based `verts_to_mask`.
+    The area of the polygon within a pixel is the (signed) sum, over the polygon 
+    edges, of the integral of the edge height above the bottom of the pixel 
+    (clamped between 0 and 1) within the pixel column.
+    The polygons are treated by batches of similar heights.
+
+    Parameters
+    ----------
+    vertices: [list of 2d-array]
+        vertices [(x,y), ...] of the polygons (one per trace).
+        Pixel centers are at integer coordinates.
+
+    shape: [int, int] -optional-
+        shape of the ccd (height, width) ; pixels outside are dropped.
+
+    batchsize: [int] -optional-
+        number of polygons vectorized at once. The edge/row arrays of a batch
+        are padded to the tallest polygon of that batch only.
+    
+    Returns
+    -------
+    4 arrays: polygon position, j (ccd-y), i (ccd-x), weight 
+    [only pixels with a non-zero weight are returned]
+    """
+    verts  = [np.asarray(v, dtype="float")+0.5 for v in vertices]
+    verts  = [v if np.all(v[0]==v[-1]) else np.concatenate([v,v[:1]]) for v in verts]
+    # - Batches of polygons with similar number of pixel rows
+    nrows  = np.asarray([np.ceil(v[:,1].max())-np.floor(v[:,1].min()) for v in verts])
+    order  = np.argsort(nrows, kind="stable")
+    output = []
+    for batch in np.array_split(order, max(1, int(np.ceil(len(order)/batchsize)))):
+        if len(batch) == 0:
+            continue
+        polygons, j, i, weights = _polygons_to_weights_([verts[k] for k in batch], shape)
+        output.append([batch[polygons], j, i, weights])
+        
+    if len(output) == 0:
+        return [np.asarray([], dtype="int") for _ in range(3)] + [np.asarray([], dtype="float")]
+    
+    polygons, j, i, weights = [np.concatenate(v_) for v_ in zip(*output)]
+    # back to the (polygon, j, i) order of a single batch
+    sorting = np.lexsort([i, j, polygons])
+    return polygons[sorting], j[sorting], i[sorting], weights[sorting]
+
+def _polygons_to_weights_(verts, shape):
+    """ polygons_to_weights() for closed and +0.5 shifted vertices, all at once. """
+    height, width = shape
+    # - Edges (polygon id, start and end points)
+    polyid = np.concatenate([np.ones(len(v)-1, dtype="int")*k for k,v in enumerate(verts)])
+    xa, ya = np.concatenate([v[:-1] for v in verts]).T
+    xb, yb = np.concatenate([v[1:]  for v in verts]).T
+    # orientation of the polygon (shoelace), such that the area is always positive
+    orientation = np.sign(np.bincount(polyid, weights=xa*yb-xb*ya, minlength=len(verts)))
+    
+    # - Edge / pixel-column pairs (vertical edges do not contribute)
+    xmin, xmax = np.minimum(xa,xb), np.maximum(xa,xb)
+    col_start  = np.floor(xmin).astype("int")
+    ncols      = np.where(xmax>xmin, np.ceil(xmax).astype("int")-col_start, 0)
+    edge       = np.repeat(np.arange(len(xa)), ncols)
+    column     = col_start[edge] + np.arange(ncols.sum()) - np.repeat(np.cumsum(ncols)-ncols, ncols)
+    
+    x_left     = np.maximum(xmin[edge], column)
+    x_right    = np.minimum(xmax[edge], column+1)
+    slope      = (yb-ya)[edge]/(xb-xa)[edge]
+    y_left     = ya[edge] + slope*(x_left -xa[edge])
+    y_right    = ya[edge] + slope*(x_right-xa[edge])
+    # CCW: edges going toward -x are above the polygon area.
+    sign       = -np.sign((xb-xa)[edge]) * orientation[polyid[edge]]
+    
+    # - Pixel rows covered by the polygon
+    ymin_poly = np.asarray([np.floor(v[:,1].min()) for v in verts], dtype="int")
+    nrows     = np.asarray([np.ceil(v[:,1].max()) for v in verts], dtype="int") - ymin_poly
+    rows      = ymin_poly[polyid[edge]][:,None] + np.arange(nrows.max())[None,:]
+    validrows = np.arange(nrows.max())[None,:] < nrows[polyid[edge]][:,None]
+    
+    area = sign[:,None] * _integrate_clamped_(y_left[:,None]-rows, y_right[:,None]-rows,
+                                              (x_right-x_left)[:,None])
+    
+    # - Sum the contributions of each pixel
+    polygons = np.broadcast_to(polyid[edge][:,None], rows.shape)[validrows]
+    columns  = np.broadcast_to(column[:,None], rows.shape)[validrows]
+    rows, area = rows[validrows], area[validrows]
+    key = (polygons.astype("int64")*height + rows)*width + columns
+    ukey, index = np.unique(key, return_inverse=True)
+    weights = np.clip(np.bincount(index.ravel(), weights=area), 0, 1)
+    
+    polygons, rest = np.divmod(ukey, height*width)
+    j, i = np.divmod(rest, width)
+    flagin = (weights>1e-10) * (j>=0) * (j<height) * (i>=0) * (i<width)
+    return polygons[flagin], j[flagin], i[flagin], weights[flagin]
+
 # ------------------------- # 
 #   MultiProcessing Tracing #
 # ------------------------- #
-def verts_to_mask(verts):
+def verts_to_mask(verts, use_shapely=False):
     """ Based on the given vertices (and using the CCD size from semd.SEDM_CCD_SIZE)
     this create a weighted mask:
     - pixels outise of the vertices have 0
     - pixels fully included within the vertices have 1
     - pixels on the edge only have a fraction of 1 
     
-
-    = Based on Shapely = 
+    = Based on polygons_to_weights (or Shapely if use_shapely) = 
     
     Returns
     -------
     [NxM] array (size of semd.SEDM_CCD_SIZE)
     """
+    if not use_shapely:
+        _, j, i, weights = polygons_to_weights([verts], shape=SEDM_CCD_SIZE)
+        maskfull = np.zeros(SEDM_CCD_SIZE[::-1])
+        maskfull[j,i] = weights
+        return maskfull
+    
     from shapely.vectorized import contains
     verts = verts+np.asarray([0.5,0.5])
     
@@ -240,12 +409,26 @@ def verts_to_mask(verts):
     
 
 def load_trace_masks(tmatch, trace_indexes=None, multiprocess=True,
-                         ncore=None, show_progress=False):
-    """ """
+                         ncore=None, show_progress=False, use_shapely=False):
+    """ measures and attaches to the tracematch the weight masks of the given traces.
+
+    By default, all the masks are measured at once using polygons_to_weights().
+    If use_shapely is set, this uses the (slower) shapely based verts_to_mask 
+    in a multiprocessing pool.
+    """
     if trace_indexes is None:
         trace_indexes = tmatch.trace_indexes
-    
-    if multiprocess:
+
+    if not use_shapely:
+        height, width = SEDM_CCD_SIZE[::-1]
+        polygons, j, i, weights = polygons_to_weights([tmatch.trace_vertices[i_] for i_ in trace_indexes],
+                                                      shape=(height, width))
+        stacked = sparse.csr_matrix((weights, (polygons*height+j, i)),
+                                    shape=(len(trace_indexes)*height, width))
+        tmatch.set_trace_masks([stacked[k*height:(k+1)*height] for k in range(len(trace_indexes))],
+                                   list(trace_indexes))
+        
+    elif multiprocess:
         import multiprocessing
         if show_progress:
             notebook = tools.is_running_from_notebook()
@@ -256,8 +439,9 @@ def load_trace_masks(tmatch, trace_indexes=None, multiprocess=True,
         if ncore is None:
             ncore = np.max([multiprocessing.cpu_count() - 1, 1])
         
+        from functools import partial
         p = multiprocessing.Pool(ncore)
-        for j, mask in enumerate( p.imap(verts_to_mask, [tmatch.trace_vertices[i_]
+        for j, mask in enumerate( p.imap(partial(verts_to_mask, use_shapely=True), [tmatch.trace_vertices[i_]
                                                              for i_ in trace_indexes])):
             tmatch.set_trace_masks(sparse.csr_matrix(mask), trace_indexes[j])
             if bar is not None:
@@ -268,6 +452,217 @@ def load_trace_masks(tmatch, trace_indexes=None, multiprocess=True,
     else:
         raise NotImplementedError("Use multiprocess = True (load_trace_masks)")
 
+# ------------------------- # 
+#   Shifted Masks Cache     #
+# ------------------------- #
+def build_tracemask_cache(tmatch, trace_indexes=None, jstep=0.2,
+                              ncore=None, show_progress=False):
+    """ Build the TraceMaskCache of the given (nightly) tracematch.
+    
+    The trace masks are measured for j-shifts in [0, 1[ (every `jstep`) 
+    such that the masks of any j-offset could later be derived without
+    measuring again the polygon-pixel intersections.
+    (see TraceMaskCache.get_trace_masks())
+
+    Parameters
+    ----------
+    tmatch: [TraceMatch]
+        The tracematch (usually the nightly one) from which the masks are derived.
+
+    trace_indexes: [list of int] -optional-
+        indexes of the traces to store. If None, tmatch.trace_indexes.
+
+    jstep: [float] -optional-
+        step of the j-shift grid (in pixels). Should be a fraction of 1.
+
+    ncore, show_progress: 
+        goes to load_trace_masks()
+
+    Returns
+    -------
+    TraceMaskCache
+    """
+    cache = TraceMaskCache()
+    cache.build(tmatch, trace_indexes=trace_indexes, jstep=jstep,
+                    ncore=ncore, show_progress=show_progress)
+    return cache
+
+def load_tracemask_cache(filename):
+    """ Load a TraceMaskCache from the given .pkl file (see TraceMaskCache.writeto()) 
+    
+    Returns
+    -------
+    TraceMaskCache
+    """
+    cache = TraceMaskCache()
+    cache.load(filename)
+    return cache
+
+class TraceMaskCache( BaseObject ):
+    """ Trace weight masks of a TraceMatch stored for a grid of fractional j-shifts.
+    
+    The masks of any j_offset are obtained by moving the masks by the integer part
+    of the offset and linearly interpolating the stored weights of the two
+    closest grid j-shifts for the fractional part. 
+    This is how the trace flexure corrected masks are obtained without
+    re-running the polygon-to-pixel intersections.
+    """
+    PROPERTIES         = ["trace_indexes", "jshifts", "width", "shape", "weights"]
+    
+    # ===================== #
+    #   Main Methods        #
+    # ===================== #
+    def build(self, tmatch, trace_indexes=None, jstep=0.2, ncore=None, show_progress=False,
+                  shape=SEDM_CCD_SIZE):
+        """ measures the masks of `tmatch` traces for every j-shifts of the grid.
+        (see build_tracemask_cache())
+        """
+        if trace_indexes is None:
+            trace_indexes = tmatch.trace_indexes
+        trace_indexes = np.asarray(trace_indexes)
+        
+        self._properties["trace_indexes"] = trace_indexes
+        self._properties["jshifts"]       = np.arange(0, 1, jstep)
+        self._properties["width"]         = tmatch.width
+        self._properties["shape"]         = tuple(shape)
+        
+        weights = []
+        for jshift in self.jshifts:
+            if jshift == 0 and np.all(np.isin(trace_indexes, list(tmatch.trace_masks.keys()))):
+                tmatch_ = tmatch
+            else:
+                tmatch_ = tmatch.get_shifted_tracematch(0, jshift)
+                load_trace_masks(tmatch_, trace_indexes, ncore=ncore, show_progress=show_progress)
+                
+            weights.append( self._masks_to_weights_([tmatch_.trace_masks[i] for i in trace_indexes]) )
+            
+        self._properties["weights"] = weights
+
+    def writeto(self, savefile):
+        """ dump the current object inside the given file (pkl format) """
+        from .utils.tools import dump_pkl
+        dump_pkl({"trace_indexes": self.trace_indexes,
+                  "jshifts": self.jshifts,
+                  "width": self.width,
+                  "shape": self.shape,
+                  "weights": self.weights}, savefile)
+
+    def load(self, filename):
+        """ load a file created by writeto() """
+        from .utils.tools import load_pkl
+        data = load_pkl(filename)
+        for k in self.PROPERTIES:
+            self._properties[k] = data[k]
+            
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def get_shifted_weights(self, j_offset):
+        """ (trace position, j, i, weight) arrays of the masks for the given j_offset
+        
+        Returns
+        -------
+        4 arrays
+        """
+        jfloor = int(np.floor(j_offset))
+        jfrac  = j_offset - jfloor
+        kgrid  = np.searchsorted(self.jshifts, jfrac, side="right")-1
+        # - lower grid point
+        t0, j0, i0, w0 = self.weights[kgrid]
+        # - upper grid point (the shift=1 point is the shift=0 point moved by 1 pixel)
+        if kgrid+1 < len(self.jshifts):
+            t1, j1, i1, w1 = self.weights[kgrid+1]
+            j1shift, next_shift = jfloor, self.jshifts[kgrid+1]
+        else:
+            t1, j1, i1, w1 = self.weights[0]
+            j1shift, next_shift = jfloor+1, 1.
+            
+        wnext  = np.clip((jfrac - self.jshifts[kgrid])/(next_shift-self.jshifts[kgrid]), 0, 1)
+            
+        trace  = np.concatenate([t0, t1])
+        j      = np.concatenate([j0.astype("int")+jfloor, j1.astype("int")+j1shift])
+        i      = np.concatenate([i0, i1]).astype("int")
+        weight = np.concatenate([w0*(1-wnext), w1*wnext])
+        flagin = (j>=0) * (j<self.shape[0]) * (weight>0)
+        return trace[flagin], j[flagin], i[flagin], weight[flagin]
+
+    def get_trace_masks(self, j_offset):
+        """ dictionary of the trace masks (sparse matrices) for the given j_offset 
+        
+        Returns
+        -------
+        dict {traceindex: csr_matrix}
+        """
+        height, width = self.shape
+        trace, j, i, weight = self.get_shifted_weights(j_offset)
+        stacked = sparse.csr_matrix((weight, (trace*height+j, i)),
+                                    shape=(len(self.trace_indexes)*height, width))
+        return {idx: stacked[k*height:(k+1)*height] for k, idx in enumerate(self.trace_indexes)}
+
+    def get_extraction_operator(self, j_offset):
+        """ Sparse extraction operator (see TraceMatch.get_extraction_operator()) 
+        for the given j_offset.
+        
+        Returns
+        -------
+        csr_matrix
+        """
+        height, width = self.shape
+        trace, j, i, weight = self.get_shifted_weights(j_offset)
+        return sparse.csr_matrix((weight, (trace*width+i, j*width+i)),
+                                    shape=(len(self.trace_indexes)*width, height*width))
+
+    def set_shifted_masks(self, tmatch, j_offset):
+        """ attach to the given tracematch (expected to be the cached one shifted by j_offset)
+        the trace masks and the extraction operator corresponding to j_offset. 
+        """
+        if tmatch.width != self.width:
+            raise ValueError("The given tracematch width (%s) does not match the cached one (%s)"%(tmatch.width, self.width))
+        
+        tmatch.set_trace_masks(list(self.get_trace_masks(j_offset).values()), list(self.trace_indexes))
+        tmatch._derived_properties["extraction_operator"] = self.get_extraction_operator(j_offset)
+        tmatch._derived_properties["extraction_indexes"]  = self.trace_indexes
+        
+    # ================== #
+    #  Internal Tools    #
+    # ================== #
+    @staticmethod
+    def _masks_to_weights_(masks):
+        """ list of sparse masks -> (trace position, j, i, weight) arrays """
+        coos = [sparse.coo_matrix(m) for m in masks]
+        return (np.concatenate([np.ones(c.nnz, dtype="int32")*k for k,c in enumerate(coos)]),
+                np.concatenate([c.row for c in coos]).astype("int16"),
+                np.concatenate([c.col for c in coos]).astype("int16"),
+                np.concatenate([c.data for c in coos]).astype("float32"))
+
+    # ===================== #
+    #   Properties          #
+    # ===================== #
+    @property
+    def trace_indexes(self):
+        """ ID of the cached traces (spaxels) """
+        return self._properties["trace_indexes"]
+
+    @property
+    def jshifts(self):
+        """ fractional j-shifts for which the masks are stored """
+        return self._properties["jshifts"]
+
+    @property
+    def width(self):
+        """ buffer width of the tracematch used to build the cache """
+        return self._properties["width"]
+
+    @property
+    def shape(self):
+        """ shape of the ccd (height, width) """
+        return self._properties["shape"]
+
+    @property
+    def weights(self):
+        """ list (one per jshifts) of (trace position, j, i, weight) arrays """
+        return self._properties["weights"]
+
 #####################################
 #                                   #
 #  Spectral Matching Class          #
@@ -284,7 +679,8 @@ class TraceMatch( BaseObject ):
     SIDE_PROPERTIES    = ["trace_masks","ij_offset", ]
     DERIVED_PROPERTIES = ["tracecolor", "facecolor", "maskimage",
                           "rmap", "gmap", "bmap",
-                          "trace_polygons"]
+                          "trace_polygons", "columnindex",
+                          "extraction_operator", "extraction_indexes"]
 
     # ===================== #
     #   Main Methods        #
@@ -348,6 +744,7 @@ class TraceMatch( BaseObject ):
         
         if "trace_masks" in data.keys():
             self._side_properties['trace_masks'] = data["trace_masks"]
+            self._reset_extraction_operator_()
             
 
     def add_trace_offset(self, i_offset, j_offset):
@@ -357,6 +754,7 @@ class TraceMatch( BaseObject ):
         self._side_properties['ij_offset'] = np.asarray([i_offset, j_offset])
         self.set_trace_vertices(new_verts)
         self._side_properties['trace_masks'] = None
+        self._reset_extraction_operator_()
         
     # --------- #
     #  SETTER   #
@@ -375,6 +773,42 @@ class TraceMatch( BaseObject ):
             
         self.set_buffer(width, build_tracemask=build_tracemask)
 
+    def set_trace_geometry(self, xys, vertices, width, trace_indexes):
+        """ Set the traces from their already buffered geometry.
+
+        This is how a TraceMatch is loaded from a night calibration bundle
+        (see calibbundle.py): the central lines (`xys`) and the buffered polygon 
+        vertices are given, so the Shapely buffering is skipped. 
+        Linestrings and polygons are only built if requested (trace_linestring, trace_polygons)
+
+        Parameters
+        ----------
+        xys: [(ntraces x 2 x 2) array]
+            two points of the central line of every traces.
+
+        vertices: [list of (nvertices x 2) arrays]
+            polygon vertices of every traces (same order as trace_indexes)
+
+        width: [float]
+            size of the buffer around the trace lines used to get `vertices`.
+
+        trace_indexes: [array]
+            ID of the traces (spaxels)
+
+        Returns
+        -------
+        Void
+        """
+        self._xys = xys
+        self.set_trace_indexes(trace_indexes)
+        self._properties["width"]            = width
+        self._properties["trace_linestring"] = None
+        self._properties["trace_vertices"]   = {i:v for i,v in zip(trace_indexes, vertices)}
+        self._derived_properties["trace_polygons"] = None
+        self._derived_properties["columnindex"] = None
+        self._side_properties['trace_masks'] = None
+        self._reset_extraction_operator_()
+        
     def set_trace_indexes(self, trace_indexes):
         """ ID of the traces (spaxels) """
         self._properties["trace_indexes"] = trace_indexes
@@ -389,7 +823,9 @@ class TraceMatch( BaseObject ):
         """ """
         self._derived_properties["trace_polygons"] = {i:p.buffer(self.width) for i, p in self.trace_linestring.items()}
         self._properties["trace_vertices"] = {i:np.asarray(p.exterior.coords.xy).T for i, p in self.trace_polygons.items()}
+        self._derived_properties["columnindex"] = None
         self._side_properties['trace_masks'] = None
+        self._reset_extraction_operator_()
         if build_tracemask:
             self.build_tracemask(**kwargs)
 
@@ -403,6 +839,7 @@ class TraceMatch( BaseObject ):
                 self.trace_masks[i] = v
         else:
             self.trace_masks[trace_indexes] = masks
+        self._reset_extraction_operator_()
 
 
     # --------- #
@@ -436,26 +873,103 @@ class TraceMatch( BaseObject ):
     # Trace crossing 
     def get_traces_crossing_x(self, xpixel, ymin=-1, ymax=1e5):
         """ traceindexes of the traces crossing the 'xpixel' vertical line
-        
+        (see get_traces_crossing_x_ybounds)
+
         Returns
         -------
         list of indexes
         """
-        return self.get_traces_crossing_line([xpixel,ymin],[xpixel,ymax])
+        return list(self._get_column_traces_(xpixel, ymin=ymin, ymax=ymax)[0])
 
     def get_traces_crossing_x_ybounds(self, xpixel, ymin=-1, ymax=1e5):
-        """ traceindexes of the traces crossing the 'xpixel' vertical line
-        
+        """ y-boundaries of the traces crossing the 'xpixel' vertical line 
+        (same order as get_traces_crossing_x). 
+
+        Integer xpixel are read from the column index (see columnindex), 
+        other are analytically computed.
+
         Returns
         -------
-        list of indexes
+        (ntraces x 2) array [[ylow, yhigh], ...]
+        """
+        return np.clip(self._get_column_traces_(xpixel, ymin=ymin, ymax=ymax)[1], ymin, ymax)
+
+    def get_traces_crossing_columns(self, columns, ymin=-1, ymax=1e5):
+        """ traces crossing any of the given ccd columns, for all the columns at once.
+
+        Parameters
+        ----------
+        columns: [array of int]
+            ccd columns
+
+        ymin, ymax: [float] -optional-
+            only traces overlapping [ymin, ymax] are returned. Bounds are clipped to it.
+
+        Returns
+        -------
+        3 flat arrays: position in columns, traceindexes, ybounds (N x 2)
         """
-        line = geometry.LineString([[xpixel,ymin],[xpixel,ymax]])
-        mpoly = geometry.MultiPolygon([self.trace_polygons[i_]
-                            for i_ in self.get_traces_crossing_x(xpixel, ymin=ymin, ymax=ymax) ])
+        columns = np.asarray(columns, dtype="int")
+        index   = self.columnindex
+        pos     = np.clip(columns - index["xstart"], -1, len(index["offsets"])-1)
+        flagin  = (pos>=0) * (pos<len(index["offsets"])-1)
+        start   = np.where(flagin, index["offsets"][np.clip(pos, 0, len(index["offsets"])-2)], 0)
+        nentries= np.where(flagin, index["offsets"][np.clip(pos+1, 0, len(index["offsets"])-1)]-start, 0)
+        colpos  = np.repeat(np.arange(len(columns)), nentries)
+        entries = np.repeat(start, nentries) + np.arange(nentries.sum()) - np.repeat(np.cumsum(nentries)-nentries, nentries)
+        ybounds = index["ybounds"][entries]
+        flagy   = (ybounds[:,1]>ymin) * (ybounds[:,0]<ymax)
+        return colpos[flagy], index["traceindexes"][entries][flagy], np.clip(ybounds[flagy], ymin, ymax)
         
-        return np.asarray([m.intersection(line).xy[1]for m in mpoly])
+    def _get_column_traces_(self, xpixel, ymin=-1, ymax=1e5):
+        """ traceindexes and ybounds of the traces crossing xpixel and overlapping [ymin, ymax] """
+        index = self.columnindex
+        pos   = xpixel - index["xstart"]
+        if float(xpixel).is_integer():
+            if pos < 0 or pos >= len(index["offsets"])-1:
+                return np.asarray([], dtype=index["traceindexes"].dtype), np.zeros((0,2))
+            traces  = index["traceindexes"][index["offsets"][int(pos)]:index["offsets"][int(pos)+1]]
+            ybounds = index["ybounds"][index["offsets"][int(pos)]:index["offsets"][int(pos)+1]]
+        else:
+            order   = np.argsort(self.trace_indexes)
+            ylow, yhigh = get_trace_column_ybounds(np.asarray(self._xys)[order], self.width, xpixel)
+            flagin  = np.isfinite(ylow)
+            traces  = np.asarray(self.trace_indexes)[order][flagin]
+            ybounds = np.asarray([ylow[flagin], yhigh[flagin]]).T
             
+        flagy = (ybounds[:,1]>ymin) * (ybounds[:,0]<ymax)
+        return traces[flagy], ybounds[flagy]
+
+    def build_columnindex(self):
+        """ For every ccd column crossed by traces, stores the (sorted) traceindexes of the 
+        crossing traces and their y-bounds (see get_trace_column_ybounds).
+
+        Column crossing requests then are array lookups. This is automatically called
+        when needed (see columnindex)
+        
+        Returns
+        -------
+        Void
+        """
+        traceindexes = np.sort(np.asarray(self.trace_indexes))
+        xys    = np.asarray(self._xys, dtype="float")[np.argsort(self.trace_indexes)]
+        xstart = int(np.floor(np.min(xys[:,:,0])-self.width))
+        xend   = int(np.ceil(np.max(xys[:,:,0])+self.width))
+        # - columns covered by each trace
+        first  = np.ceil(np.min(xys[:,:,0], axis=1)-self.width).astype("int")
+        ncols  = np.floor(np.max(xys[:,:,0], axis=1)+self.width).astype("int") - first + 1
+        trace  = np.repeat(np.arange(len(xys)), ncols)
+        column = first[trace] + np.arange(ncols.sum()) - np.repeat(np.cumsum(ncols)-ncols, ncols)
+        ylow, yhigh = get_trace_column_ybounds(xys[trace], self.width, column)
+        flagin = np.isfinite(ylow)
+        # traces are already sorted, the (stable) sort by column keeps that order within columns
+        order  = np.argsort(column[flagin], kind="stable")
+        column, trace = column[flagin][order], trace[flagin][order]
+        offsets = np.zeros(xend-xstart+2, dtype="int")
+        offsets[1:] = np.cumsum(np.bincount(column-xstart, minlength=xend-xstart+1))
+        self._derived_properties["columnindex"] = {"xstart": xstart, "offsets": offsets,
+                                                   "traceindexes": traceindexes[trace],
+                                                   "ybounds": np.asarray([ylow[flagin][order], yhigh[flagin][order]]).T}
         
     def get_traces_crossing_y(self, ypixel, xmin=-1, xmax=1e5):
         """ traceindexes of the traces crossing the 'ypixel' horizonthal line
@@ -481,6 +995,45 @@ class TraceMatch( BaseObject ):
         return [idx for idx in self.trace_indexes if self.trace_polygons[idx].crosses(line)]
 
         
+    def get_trace_line_coefs(self, traceindexes=None):
+        """ slope and intercept of the trace central lines: j = intercept + slope*i
+        
+        Parameters
+        ----------
+        traceindexes: [list of int] -optional-
+            traces for which the coefficients are returned. If None all (sorted).
+
+        Returns
+        -------
+        slope, intercept (arrays)
+        """
+        order = np.argsort(self.trace_indexes)
+        sorted_indexes = np.asarray(self.trace_indexes)[order]
+        if traceindexes is None:
+            traceindexes = sorted_indexes
+        rows = order[np.clip(np.searchsorted(sorted_indexes, traceindexes), 0, len(order)-1)]
+        if np.any(np.asarray(self.trace_indexes)[rows] != traceindexes):
+            raise ValueError("Some of the given traceindexes are not known by this tracematch")
+        
+        (xa, ya), (xb, yb) = np.asarray(self._xys, dtype="float")[rows].transpose(1,2,0)
+        slope = (yb-ya)/np.where(xb!=xa, xb-xa, np.NaN)
+        return slope, ya - slope*xa
+
+    def get_trace_line_xbounds(self, traceindexes=None):
+        """ ccd-x range covered by the traces (central lines buffered by width) 
+
+        Returns
+        -------
+        xmin, xmax (arrays)
+        """
+        order = np.argsort(self.trace_indexes)
+        sorted_indexes = np.asarray(self.trace_indexes)[order]
+        if traceindexes is None:
+            traceindexes = sorted_indexes
+        rows = order[np.clip(np.searchsorted(sorted_indexes, traceindexes), 0, len(order)-1)]
+        x = np.asarray(self._xys, dtype="float")[rows][:,:,0]
+        return x.min(axis=1)-self.width, x.max(axis=1)+self.width
+        
     # Boundaries
     def get_trace_xbounds(self, traceindex):
         """ get the extremal x-ccd coordinates covered by the trace """
@@ -591,6 +1144,67 @@ class TraceMatch( BaseObject ):
             
         return mask
 
+    def get_extraction_operator(self, trace_indexes=None, shape=SEDM_CCD_SIZE):
+        """ Sparse operator stacking the weight masks of the given traces.
+
+        The operator has a shape (ntraces*width, height*width) such that,
+        for a given 2D ccd image `data`:
+        ```
+        op.dot(np.ravel(data)).reshape(ntraces, width)
+        ```
+        returns, for each trace, the flux per ccd column (i.e. what
+        `np.sum(data*self.get_trace_mask(traceindex), axis=0)` does for 1 trace).
+        Its memory footprint scales with the number of non-zero mask weights.
+
+        The operator is built from `trace_masks` (missing masks are built on the fly
+        using get_trace_mask()) and is stored for later calls with the same indexes.
+
+        Parameters
+        ----------
+        trace_indexes: [list of int] -optional-
+            which traces should be stacked (in that order). If None, all trace_indexes.
+
+        shape: [int, int] -optional-
+            shape of the ccd images (height, width)
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+        """
+        if trace_indexes is None:
+            trace_indexes = self.trace_indexes
+        trace_indexes = np.asarray(trace_indexes)
+        
+        if self._derived_properties["extraction_operator"] is not None and \
+          np.array_equal(self._derived_properties["extraction_indexes"], trace_indexes) and \
+          self._derived_properties["extraction_operator"].shape == (len(trace_indexes)*shape[1], shape[0]*shape[1]):
+            return self._derived_properties["extraction_operator"]
+
+        height, width = shape
+        rows, cols, weights = [], [], []
+        for k, traceindex in enumerate(trace_indexes):
+            if traceindex not in self.trace_masks:
+                self.get_trace_mask(traceindex, update=True)
+            mask_ = sparse.coo_matrix(self.trace_masks[traceindex])
+            # mask_.row = j (ccd-y) ; mask_.col = i (ccd-x)
+            rows.append(k*width + mask_.col)
+            cols.append(mask_.row*width + mask_.col)
+            weights.append(mask_.data)
+
+        operator = sparse.csr_matrix((np.concatenate(weights) if len(weights)>0 else [],
+                                          (np.concatenate(rows) if len(rows)>0 else [],
+                                           np.concatenate(cols) if len(cols)>0 else [])),
+                                          shape=(len(trace_indexes)*width, height*width))
+        
+        self._derived_properties["extraction_operator"] = operator
+        self._derived_properties["extraction_indexes"]  = trace_indexes
+        return operator
+        
+    def _reset_extraction_operator_(self):
+        """ removes the stored extraction operator (to be called when masks change) """
+        self._derived_properties["extraction_operator"] = None
+        self._derived_properties["extraction_indexes"]  = None
+        
     def _get_color_trace_mask_(self, traceindex):
         """ Use the tracebuild colors trick
         = Time depends on the subpixelization, 5 takes about 1s =
@@ -601,9 +1215,7 @@ class TraceMatch( BaseObject ):
               measure.block_reduce(mask, (self.subpixelization, self.subpixelization) )/float(self.subpixelization**2)
               
     def _get_shapely_trace_mask_(self, traceindex):
-        """ Based on Shapely, measure the intersection area between traces and pixels.
-        = Takes about 1s =
-        """
+        """ Measure the intersection area between traces and pixels (see verts_to_mask). """
         return verts_to_mask(self.trace_vertices[traceindex])
     
     def _load_trace_mask_(self, traceindexe ):
@@ -787,11 +1399,17 @@ class TraceMatch( BaseObject ):
     @property
     def trace_linestring(self):
         """ Central line of the trace | Shapely.MultiLineString """
+        if self._properties["trace_linestring"] is None and getattr(self, "_xys", None) is not None:
+            # geometry set without the shapely objects (see set_trace_geometry)
+            self._properties["trace_linestring"] = {i:geometry.LineString( xy )
+                                                    for i, xy in zip(self.trace_indexes, self._xys)}
         return self._properties["trace_linestring"]
     
     @property
     def ntraces(self):
         """ """
+        if self._properties["trace_indexes"] is not None:
+            return len(self._properties["trace_indexes"])
         return None if self.trace_linestring is None else len( self.trace_linestring )
     
     @property
@@ -821,8 +1439,17 @@ class TraceMatch( BaseObject ):
         """ Shapely polygon of the traces based on their vertices"""
         if not _HAS_SHAPELY:
             raise ImportError("You do not have shapely. this porpoerty needs it. pip install Shapely")
+        if self._derived_properties["trace_polygons"] is None and self.trace_linestring is not None:
+            self._derived_properties["trace_polygons"] = {i:p.buffer(self.width) for i, p in self.trace_linestring.items()}
         return self._derived_properties["trace_polygons"]
 
+    @property
+    def columnindex(self):
+        """ ccd column -> crossing traces lookup table (see build_columnindex) """
+        if self._derived_properties["columnindex"] is None:
+            self.build_columnindex()
+        return self._derived_properties["columnindex"]
+    
     @property
     def ij_offset(self):
         """ By how much the traces are offseted in comparison to the night_tracematch """
@@ -0,0 +1,385 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Lightweight per-stage instrumentation of the pipeline (wall time, cpu time and memory).
+
+The instrumentation is disabled by default: stage() and frame() are then no-op context managers.
+
+```
+from pysedm.utils import timing
+timer = timing.enable(hooks={"extract_cube": [timing.CProfileHook("extract_%(frame)s.prof")]})
+build_cubes(...)   # stages are recorded per frame
+timer.writeto("night_Timing") # .json and .csv
+timing.disable()
+```
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from propobject import BaseObject
+
+# header keywords (<=8 characters) of the cube stages (wall time in seconds)
+STAGE_KEYWORDS = {"load_ccd": "PTLOAD",
+                  "traceflexure": "PTJFLX",
+                  "trace_masks": "PTMASK",
+                  "background": "PTBKGD",
+                  "guider": "PTGUIDE",
+                  "pixel_spectra": "PTPIXSP",
+                  "extract_cube": "PTEXTR",
+                  "flexure_mapping": "PTFLXMAP",
+                  "flexure_telluric_fit": "PTTELFIT",
+                  "flexure_sodium_fit": "PTNAFIT",
+                  "flexure_extraction": "PTEXTR2"}
+
+RECORD_COLUMNS = ["frame", "stage", "parent", "start", "wall", "cpu", "rss_mb", "maxrss_mb", "maxrss_increase_mb"]
+
+_TIMER = None
+
+__all__ = ["enable", "disable", "get_timer", "stage", "frame"]
+
+
+# ================== #
+#                    #
+#   Main Functions   #
+#                    #
+# ================== #
+def enable(hooks=None):
+    """ enable the instrumentation (a new StageTimer is created if none is active)
+
+    Parameters
+    ----------
+    hooks: [dict] -optional-
+        {stage: [hook, ...]}, see CProfileHook, TracemallocHook, CallbackHook
+        and parse_hooks().
+
+    Returns
+    -------
+    StageTimer
+    """
+    global _TIMER
+    if _TIMER is None:
+        _TIMER = StageTimer()
+    if hooks is not None:
+        for stage_, hooks_ in hooks.items():
+            for hook in hooks_:
+                _TIMER.add_hook(stage_, hook)
+    return _TIMER
+
+def disable():
+    """ disable the instrumentation. Returns the StageTimer that was active (or None) """
+    global _TIMER
+    timer, _TIMER = _TIMER, None
+    return timer
+
+def get_timer():
+    """ the active StageTimer (None if the instrumentation is disabled) """
+    return _TIMER
+
+def is_enabled():
+    """ """
+    return _TIMER is not None
+
+@contextmanager
+def stage(name):
+    """ time the block as the stage `name` (no-op if the instrumentation is disabled) """
+    if _TIMER is None:
+        yield None
+        return
+    with _TIMER.stage(name) as record:
+        yield record
+
+@contextmanager
+def frame(name):
+    """ the stages of the block are associated to the frame `name` (e.g. the ccd filename) """
+    if _TIMER is None:
+        yield None
+        return
+    with _TIMER.frame(name) as record:
+        yield record
+
+def set_header_keywords(header, frame=None):
+    """ write the timing summary of the frame in the given header (no-op if disabled) """
+    if _TIMER is None:
+        return
+    _TIMER.set_header_keywords(header, frame=frame)
+
+def write_report(savefile):
+    """ write the records of the active timer (no-op if disabled), see StageTimer.writeto() """
+    if _TIMER is None:
+        return
+    _TIMER.writeto(savefile)
+
+# ------------------ #
+#   Measurements     #
+# ------------------ #
+def get_cputime():
+    """ user+system cpu time of the process and its (terminated) children """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def get_maxrss():
+    """ peak resident memory [MB] of the process (high-water mark since its start) """
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return maxrss/1024**2 if sys.platform == "darwin" else maxrss/1024.
+
+def get_rss():
+    """ current resident memory [MB] of the process (None if /proc is not available) """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (IOError, OSError, ValueError):
+        return None
+
+# ------------------ #
+#   Hooks            #
+# ------------------ #
+def parse_hooks(hookstring, savedir="./"):
+    """ hooks from a command line string.
+
+    Parameters
+    ----------
+    hookstring: [string]
+        coma separated list of stage:kind, kind being:
+        - cprofile: the stage is profiled, stats saved in `savedir`/profile_{stage}_{frame}.prof
+        - tracemalloc: the python memory peak of the stage is added to its record.
+        - module.function: function(record) is called at the end of the stage.
+        e.g. "extract_cube:cprofile,background:tracemalloc"
+
+    Returns
+    -------
+    dict {stage: [hook, ...]}
+    """
+    hooks = {}
+    for hookstr in hookstring.split(","):
+        if len(hookstr.strip()) == 0:
+            continue
+        stage_, kind = hookstr.strip().split(":", 1)
+        if kind == "cprofile":
+            hook = CProfileHook(os.path.join(savedir, "profile_%(stage)s_%(frame)s.prof"))
+        elif kind == "tracemalloc":
+            hook = TracemallocHook()
+        else:
+            import importlib
+            module, func = kind.rsplit(".", 1)
+            hook = CallbackHook(getattr(importlib.import_module(module), func))
+        hooks.setdefault(stage_, []).append(hook)
+    return hooks
+
+
+class CProfileHook( object ):
+    """ profile the stage with cProfile and dump the stats.
+    savefile could contain %(stage)s and %(frame)s """
+    def __init__(self, savefile):
+        self.savefile = savefile
+
+    def start(self, record):
+        """ """
+        import cProfile
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def stop(self, record):
+        """ """
+        self._profiler.disable()
+        frame_ = os.path.basename(str(record["frame"])).replace(".fits", "")
+        savefile = self.savefile%{"stage": record["stage"], "frame": frame_}
+        self._profiler.dump_stats(savefile)
+        record["profile"] = savefile
+
+class TracemallocHook( object ):
+    """ add the python memory peak of the stage (tracemalloc_peak_mb) to its record """
+    def start(self, record):
+        """ """
+        import tracemalloc
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+
+    def stop(self, record):
+        """ """
+        import tracemalloc
+        record["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1]/1024**2
+        if self._started:
+            tracemalloc.stop()
+
+class CallbackHook( object ):
+    """ call func(record) at the end of the stage """
+    def __init__(self, func):
+        self.func = func
+
+    def start(self, record):
+        """ """
+        pass
+
+    def stop(self, record):
+        """ """
+        self.func(record)
+
+
+# ================== #
+#                    #
+#   StageTimer       #
+#                    #
+# ================== #
+class StageTimer( BaseObject ):
+    """ records the wall time, cpu time and memory of the pipeline stages.
+
+    Each record is a dict (see RECORD_COLUMNS):
+    - frame: frame being processed (None for the night stages)
+    - stage, parent: name of the stage and of the stage it is nested in (if any)
+    - wall, cpu: [s] (cpu includes the terminated children processes)
+    - rss_mb: resident memory at the end of the stage
+    - maxrss_mb, maxrss_increase_mb: process memory high-water mark at the end of the
+      stage and how much the stage raised it.
+    """
+    PROPERTIES      = ["records", "hooks"]
+    SIDE_PROPERTIES = ["frame", "framestart"]
+    DERIVED_PROPERTIES = ["stack"]
+
+    # ================ #
+    #  Main Methods    #
+    # ================ #
+    @contextmanager
+    def stage(self, name):
+        """ time the block as the stage `name` """
+        record = {"frame": self.current_frame, "stage": name,
+                  "parent": self._stack[-1] if len(self._stack)>0 else None,
+                  "start": time.time()}
+        hooks = self.hooks.get(name, [])
+        for hook in hooks:
+            hook.start(record)
+        self._stack.append(name)
+        maxrss, cpu, wall = get_maxrss(), get_cputime(), time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter()-wall
+            record["cpu"]  = get_cputime()-cpu
+            record["rss_mb"] = get_rss()
+            record["maxrss_mb"] = get_maxrss()
+            record["maxrss_increase_mb"] = record["maxrss_mb"]-maxrss
+            self._stack.pop()
+            for hook in hooks:
+                hook.stop(record)
+            self.records.append(record)
+
+    @contextmanager
+    def frame(self, name):
+        """ the stages of the block are associated to the frame `name`.
+        The whole frame is recorded as the stage 'frame'. """
+        previous = self.current_frame, self._side_properties["framestart"]
+        self._side_properties["frame"] = name
+        self._side_properties["framestart"] = [time.perf_counter(), get_cputime()]
+        try:
+            with self.stage("frame") as record:
+                yield record
+        finally:
+            self._side_properties["frame"], self._side_properties["framestart"] = previous
+
+    def add_hook(self, stage, hook):
+        """ hook.start(record) and hook.stop(record) are called at the beginning and the end of the stage """
+        self.hooks.setdefault(stage, []).append(hook)
+
+    def add_records(self, records):
+        """ add records made elsewhere (e.g. by a worker process) """
+        self.records.extend(records)
+
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def get_records(self, frame=None, stage=None):
+        """ list of the records of the given frame and/or stage (all if None) """
+        return [r for r in self.records if (frame is None or r["frame"]==frame)
+                    and (stage is None or r["stage"]==stage)]
+
+    def get_summary(self, frame=None):
+        """ total wall time per stage {stage: wall} of the given frame """
+        summary = {}
+        for r in self.get_records(frame=frame):
+            summary[r["stage"]] = summary.get(r["stage"], 0) + r["wall"]
+        return summary
+
+    def get_dataframe(self):
+        """ pandas.DataFrame of the records """
+        import pandas
+        return pandas.DataFrame(self.records, columns=RECORD_COLUMNS+
+                                    sorted(set(k for r in self.records for k in r if k not in RECORD_COLUMNS)))
+
+    def set_header_keywords(self, header, frame=None):
+        """ write the wall time of the stages (STAGE_KEYWORDS) of the given frame,
+        as well as the frame wall and cpu times so far and the memory high-water mark """
+        if frame is None:
+            frame = self.current_frame
+        for stage_, wall in self.get_summary(frame=frame).items():
+            if stage_ in STAGE_KEYWORDS:
+                header[STAGE_KEYWORDS[stage_]] = (round(wall, 3), "[s] wall time of pipeline stage %s"%stage_)
+        if frame == self.current_frame and self._side_properties["framestart"] is not None:
+            wall, cpu = self._side_properties["framestart"]
+            header["PTWALL"] = (round(time.perf_counter()-wall, 3), "[s] wall time to build this cube")
+            header["PTCPU"]  = (round(get_cputime()-cpu, 3), "[s] cpu time to build this cube")
+        header["PTMAXRSS"] = (round(get_maxrss(), 1), "[MB] peak memory of the building process")
+
+    # --------- #
+    #  I/O      #
+    # --------- #
+    def writeto(self, savefile, merge=True):
+        """ write the records as `savefile`.json and `savefile`.csv
+
+        merge: [bool] -optional-
+            keep the records of an existing report except those of the same frame and stage
+            (i.e. re-ran stages are replaced).
+        """
+        import json
+        savefile = savefile.replace(".json", "")
+        records = self.records
+        if merge and os.path.isfile(savefile+".json"):
+            known = set((r["frame"], r["stage"]) for r in records)
+            previous = json.load(open(savefile+".json"))["records"]
+            records = [r for r in previous if (r["frame"], r["stage"]) not in known] + records
+
+        with open(savefile+".json", "w") as fout:
+            json.dump({"records": records}, fout, indent=1)
+        StageTimer.from_records(records).get_dataframe().to_csv(savefile+".csv", index=False)
+
+    @classmethod
+    def from_records(cls, records):
+        """ """
+        this = cls()
+        this.add_records(records)
+        return this
+
+    # ================ #
+    #  Properties      #
+    # ================ #
+    @property
+    def records(self):
+        """ list of the stage records """
+        if self._properties["records"] is None:
+            self._properties["records"] = []
+        return self._properties["records"]
+
+    @property
+    def hooks(self):
+        """ {stage: [hooks]} """
+        if self._properties["hooks"] is None:
+            self._properties["hooks"] = {}
+        return self._properties["hooks"]
+
+    @property
+    def current_frame(self):
+        """ frame being processed """
+        return self._side_properties["frame"]
+
+    @property
+    def _stack(self):
+        """ names of the running stages """
+        if self._derived_properties["stack"] is None:
+            self._derived_properties["stack"] = []
+        return self._derived_properties["stack"]
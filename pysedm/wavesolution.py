@@ -23,6 +23,7 @@ import modefit
 
 # - Internal Modules
 from .ccd import CCD
+from .utils.tools import is_arraylike
 
 # Vacuum wavelength
 # from KECK https://www2.keck.hawaii.edu/inst/lris/arc_calibrations.html
@@ -85,6 +86,9 @@ XE_LINES = {"air": [ 7119.614 ,  7642.0124,  8231.6305,  8231.6305,  8280.1113,
 #  SEDM          #
 # -------------- #
 REFWAVELENGTH = 7000
+# Dense wavelength grid used to invert the wavelength solutions (pixels->lbda)
+INVERSE_LBDARANGE = [3000, 10500]
+INVERSE_LBDASTEP  = 5
 
 # For Information:
 #    Sodium skyline fitted by SNIFS is at 5892.346 Angstrom
@@ -177,15 +181,36 @@ def get_arcspectrum(x, y, databound, dy=None, name=None):
 
 def get_arccollection(traceindex, lamps):
     """ """
+    return get_arccollection_from_spectra([lamp.get_spectrum(traceindex, on="data") for lamp in lamps],
+                                          [lamp.objname for lamp in lamps],
+                                          [lamp.tracematch.get_trace_xbounds(traceindex) for lamp in lamps])
+
+def get_arccollection_from_spectra(spectra, names, xbounds):
+    """ Build the ArcSpectrumCollection of a trace from its already extracted lamp spectra.
+
+    Parameters
+    ----------
+    spectra: [list of arrays]
+        flux per ccd-pixel of the trace for each lamp (as given by CCD.get_spectrum())
+
+    names: [list of str]
+        name of the lamps (objname)
+
+    xbounds: [list of [float,float]]
+        trace x-boundaries for each lamp (as given by TraceMatch.get_trace_xbounds())
+
+    Returns
+    -------
+    ArcSpectrumCollection
+    """
     sol_ = ArcSpectrumCollection()
-    
-    for lamp in lamps:
-        spec_ = lamp.get_spectrum(traceindex, on="data")[::-1]
+    for spec_, name_, xbounds_ in zip(spectra, names, xbounds):
+        spec_ = np.asarray(spec_)[::-1]
         lbda_ = np.arange(len(spec_))
         sol_.add_arcspectrum( get_arcspectrum(x=lbda_, y=spec_,
-                                            databound= np.sort(len(spec_) - lamp.tracematch.get_trace_xbounds(traceindex)),
-                                            name=lamp.objname))
-    sol_.set_databounds(*np.sort(len(spec_) - lamp.tracematch.get_trace_xbounds(traceindex)))
+                                            databound= np.sort(len(spec_) - np.asarray(xbounds_)),
+                                            name=name_))
+    sol_.set_databounds(*np.sort(len(spec_) - np.asarray(xbounds_)))
     return sol_
 
 # ==================== #
@@ -206,7 +231,7 @@ def merge_wavesolutions(wavesolutions):
 def fit_spaxel_wavelesolution(arccollection, sequential=True,
                               contdegree=3, wavedegree=5,
                               saveplot=None, show=False,
-                        plotprop={}):
+                        plotprop={}, line_guesses=None, method="modefit"):
     """ Fit the wavelength solution of the given trace.
     
     This matching is made in two steps:
@@ -235,17 +260,266 @@ def fit_spaxel_wavelesolution(arccollection, sequential=True,
             
     show: [bool] -optional-
         Should the wavelength solution figure be shown?
-        
+
+    line_guesses: [dict] -optional-
+        Expected pixel position of the lines {line: pixel}, e.g. from the neighboring
+        traces (see get_neighbors_line_guesses()).
+
+    method: [string] -optional-
+        line fitter: modefit (~3s) or lsq (ArcLineFitter, analytic Jacobian)
+
     Returns
     -------
     None
     """
-    # 3s 
-    arccollection.fit_lineposition(contdegree=contdegree, sequential=sequential)
+    # 3s (modefit)
+    arccollection.fit_lineposition(contdegree=contdegree, sequential=sequential,
+                                   line_guesses=line_guesses, method=method)
     # 0.01s
     arccollection.fit_wavelengthsolution(wavedegree, legendre=False)
     return arccollection
 
+def sort_traces_by_neighbors(traceindexes, hexagrid):
+    """ Sort the traces from the center of the hexagonal grid outwards
+    (breadth-first walk through the neighbors), such that each trace
+    has solved neighbors when fitted sequentially.
+    Traces that are not in the hexagrid are appended at the end.
+
+    Returns
+    -------
+    list
+    """
+    from collections import deque
+    traceindexes = list(traceindexes)
+    intrace = set(traceindexes)
+    ingrid  = [i_ for i_ in traceindexes if i_ in hexagrid.ids_index]
+    if len(ingrid) == 0:
+        return traceindexes
+
+    # the (0,0) reference is the central trace (the xy positions are not stored in the hexagrid files)
+    center = hexagrid.index_to_ids(hexagrid.ref_idx[0] if hexagrid.ref_idx is not None else
+                                   hexagrid.get_central_index())
+    start  = center if center in intrace else ingrid[0]
+    ordered, seen, tovisit = [], set([start]), deque([start])
+    while len(tovisit)>0 or len(seen)<len(ingrid):
+        if len(tovisit) == 0: # disconnected part of the grid
+            tovisit.append([i_ for i_ in ingrid if i_ not in seen][0])
+            seen.add(tovisit[0])
+        i_ = tovisit.popleft()
+        ordered.append(i_)
+        for n_ in hexagrid.get_idx_neighbors(hexagrid.ids_to_index(i_)):
+            n_ = hexagrid.index_to_ids(n_)
+            if n_ in intrace and n_ not in seen:
+                seen.add(n_)
+                tovisit.append(n_)
+
+    return ordered + [i_ for i_ in traceindexes if i_ not in hexagrid.ids_index]
+
+def get_neighbors_line_guesses(wavesolutions, traceindex, hexagrid, databounds, nmin=1):
+    """ Expected line pixel positions of the given trace based on the
+    already fitted lines of its neighbors on the hexagonal grid.
+
+    Lines are located relative to the trace boundaries (`databounds`),
+    such that the neighbors' shifts along the ccd are accounted for.
+
+    Parameters
+    ----------
+    wavesolutions: [dict]
+        already solved traces {traceindex: data} (see WaveSolution.wavesolutions)
+
+    traceindex: [int]
+        trace for which the guesses are requested.
+
+    hexagrid: [HexagoneProjection]
+        hexagonal grid of the night (traceindex <-> neighbors)
+
+    databounds: [float, float]
+        boundaries of the trace (see ArcSpectrumCollection.databounds)
+
+    nmin: [int] -optional-
+        minimal number of solved neighbors to provide guesses.
+
+    Returns
+    -------
+    dict ({line: pixel}, empty if not enough neighbors)
+    """
+    if traceindex not in hexagrid.ids_index:
+        return {}
+
+    neighbors = [hexagrid.index_to_ids(i_) for i_ in hexagrid.get_idx_neighbors(hexagrid.ids_to_index(traceindex))]
+    relpos = {}
+    nsolved = 0
+    for n_ in neighbors:
+        data_ = wavesolutions.get(n_, None)
+        if data_ is None or data_.get("databounds", None) is None or data_.get("fit_linepos", None) is None:
+            continue
+        nsolved += 1
+        for line, mu in zip(data_["usedlines"], data_["fit_linepos"]):
+            relpos.setdefault(line, []).append(mu - data_["databounds"][0])
+
+    if nsolved < nmin:
+        return {}
+    return {line: np.median(v)+databounds[0] for line, v in relpos.items()}
+
+# - Shared Memory Pool
+_SHARED_WAVESOLUTION = {}
+
+def _init_shared_wavesolution_(shmname, shape, dtype, rows, names, xbounds, fitprop):
+    """ Pool initializer: attaches the worker to the lamp spectra in shared memory """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shmname)
+    _SHARED_WAVESOLUTION["shm"]     = shm # keep the reference alive
+    _SHARED_WAVESOLUTION["spectra"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _SHARED_WAVESOLUTION["rows"]    = rows
+    _SHARED_WAVESOLUTION["names"]   = names
+    _SHARED_WAVESOLUTION["xbounds"] = xbounds
+    _SHARED_WAVESOLUTION["fitprop"] = fitprop
+
+def _fit_shared_wavesolution_(task):
+    """ Pool task: fit the wavelength solution of the given chunk of traces
+    task: [traceindexes, {traceindex: line_guesses}] (see fit_wavesolution_parallel()) """
+    traceindexes, line_guesses = task
+    spectra, rows = _SHARED_WAVESOLUTION["spectra"], _SHARED_WAVESOLUTION["rows"]
+    fitprop = _SHARED_WAVESOLUTION["fitprop"].copy()
+    saveplot = fitprop.pop("saveplot", None)
+
+    results = []
+    for traceindex in traceindexes:
+        try:
+            arccollection = get_arccollection_from_spectra(spectra[:, rows[traceindex]],
+                                                           _SHARED_WAVESOLUTION["names"],
+                                                           _SHARED_WAVESOLUTION["xbounds"][traceindex])
+            fit_spaxel_wavelesolution(arccollection, line_guesses=line_guesses.get(traceindex, None), **fitprop)
+            if saveplot is not None:
+                arccollection.show(show_guesses=True, savefile=saveplot%traceindex)
+                mpl.close("all")
+            results.append([traceindex, arccollection.data])
+        except Exception as e:
+            warnings.warn("wavelength solution failed for trace %d: %s"%(traceindex, e))
+            results.append([traceindex, None])
+
+    return results
+
+def fit_wavesolution_parallel(lamps, traceindexes, wavesolution=None,
+                              ncore=None, chunksize=4,
+                              contdegree=3, wavedegree=5, sequential=True,
+                              hexagrid=None, method="modefit",
+                              saveplot=None, show_progress=False):
+    """ Fit the wavelength solution of the given traces within a multiprocessing Pool.
+
+    The lamp spectra of all the traces are extracted once (see CCD.get_spectra()),
+    and stored in shared memory. The workers attach to it (no copy, no file reloading),
+    get small chunks of traces dynamically, and the results are streamed back
+    into a single WaveSolution (no merging needed).
+
+    If a hexagrid is given, the traces are fitted from the center of the MLA outwards
+    and the line positions of each chunk are seeded by the already solved neighboring
+    traces (see get_neighbors_line_guesses()).
+
+    Parameters
+    ----------
+    lamps: [list of CCD]
+        the arc lamp ccds (Hg, Cd, Xe) with their tracematch.
+
+    traceindexes: [list of int]
+        traces for which the wavelength solution should be fitted.
+
+    wavesolution: [WaveSolution] -optional-
+        the WaveSolution to be filled. If None, a new one is created from the lamps.
+
+    ncore: [int] -optional-
+        number of processes. If None, all but one cpu.
+
+    chunksize: [int] -optional-
+        number of traces sent to the workers at once.
+
+    contdegree, wavedegree, sequential, method: -optional-
+        see fit_spaxel_wavelesolution()
+
+    hexagrid: [HexagoneProjection] -optional-
+        hexagonal grid of the night, used to seed the line positions by the neighboring traces.
+
+    saveplot: [string] -optional-
+        filename format (with a %d for the traceindex) to save individual solution plots.
+
+    show_progress: [bool] -optional-
+        display a progress bar.
+
+    Returns
+    -------
+    WaveSolution
+    """
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    if wavesolution is None:
+        wavesolution = get_wavesolution(*lamps)
+
+    traceindexes = list(traceindexes)
+    if hexagrid is not None:
+        traceindexes = sort_traces_by_neighbors(traceindexes, hexagrid)
+    if ncore is None:
+        ncore = np.max([multiprocessing.cpu_count() - 1, 1])
+
+    # - Lamp spectra, once for all traces
+    spectra = np.asarray([lamp.get_spectra(traceindexes, on="data") for lamp in lamps], dtype="float")
+    xbounds = {i_:[lamp.tracematch.get_trace_xbounds(i_) for lamp in lamps] for i_ in traceindexes}
+    rows    = {i_:k for k,i_ in enumerate(traceindexes)}
+    names   = [lamp.objname for lamp in lamps]
+    fitprop = dict(contdegree=contdegree, wavedegree=wavedegree, sequential=sequential,
+                   method=method, saveplot=saveplot)
+
+    shm = shared_memory.SharedMemory(create=True, size=spectra.nbytes)
+    try:
+        np.ndarray(spectra.shape, dtype=spectra.dtype, buffer=shm.buf)[:] = spectra
+        initargs = (shm.name, spectra.shape, spectra.dtype, rows, names, xbounds, fitprop)
+        spectra_width = spectra.shape[-1]
+        del spectra
+
+        chunks = [traceindexes[i:i+chunksize] for i in range(0, len(traceindexes), chunksize)]
+        if show_progress:
+            from .utils import tools
+            bar = ProgressBar( len(traceindexes), ipython_widget=tools.is_running_from_notebook())
+        else:
+            bar = None
+
+        def _get_task_(chunk):
+            # line guesses are computed when the chunk is sent, i.e. from the latest solutions
+            if hexagrid is None:
+                return [chunk, {}]
+            return [chunk, {i_: get_neighbors_line_guesses(wavesolution.wavesolutions, i_, hexagrid,
+                                                         np.sort(spectra_width - np.asarray(xbounds[i_][-1])))
+                            for i_ in chunk}]
+
+        import queue
+        done  = queue.Queue()
+        ndone, nsent = 0, 0
+        with multiprocessing.Pool(ncore, initializer=_init_shared_wavesolution_, initargs=initargs) as p:
+            # - dynamic scheduling: a new chunk is sent each time one is returned.
+            for chunk in chunks[:2*ncore]:
+                p.apply_async(_fit_shared_wavesolution_, (_get_task_(chunk),), callback=done.put,
+                              error_callback=done.put)
+            nsent = np.min([2*ncore, len(chunks)])
+            for j in range(len(chunks)):
+                results = done.get()
+                if isinstance(results, Exception):
+                    raise results
+                for traceindex, data in results:
+                    if data is not None:
+                        wavesolution.add_trace_wavesolution(traceindex, data, replace=True)
+                ndone += len(results)
+                if bar is not None:
+                    bar.update(ndone)
+                if nsent < len(chunks):
+                    p.apply_async(_fit_shared_wavesolution_, (_get_task_(chunks[nsent]),), callback=done.put,
+                                  error_callback=done.put)
+                    nsent += 1
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return wavesolution
+
 def fit_wavesolution(lamps, indexes, multiprocess=True):
     """ """
     from .utils import tools
@@ -283,10 +557,202 @@ def _fit_wavesolution_notebook_(lamps, indexes, multiprocess=True):
         bar.update(len(indexes))
         return res
     
-    # - No multiprocessing 
+    # - No multiprocessing
     return {indexes[i_]: fit_spaxel_wavelesolution(arccollection)
                 for i_,arccollection in enumerate(arccollections)}
 
+# --------------------- #
+#  Polynomial Arrays    #
+# --------------------- #
+def polyval_horner(polycoefs, x):
+    """ Evaluate many polynomials at once using Horner's scheme.
+
+    Parameters
+    ----------
+    polycoefs: [2d array]
+        (npoly x degree+1) coefficients, in decreasing powers (np.poly1d convention).
+
+    x: [float/array]
+        where the polynomials should be evaluated.
+        Either a 1d array (same x for every polynomial) or a (npoly x N) array.
+
+    Returns
+    -------
+    (npoly x N) array
+    """
+    polycoefs = np.atleast_2d(polycoefs)
+    x = np.atleast_1d(x)
+    if x.ndim == 1:
+        x = x[None,:]
+
+    values = np.zeros(np.broadcast(polycoefs[:,:1], x).shape) + polycoefs[:,:1]
+    for coef in polycoefs[:,1:].T:
+        values = values*x + coef[:,None]
+
+    return values
+
+def polyder_array(polycoefs):
+    """ Coefficients (decreasing powers) of the derivative of many polynomials at once.
+    (npoly x degree+1) -> (npoly x degree)
+    """
+    polycoefs = np.atleast_2d(polycoefs)
+    degree = polycoefs.shape[1]-1
+    if degree == 0:
+        return np.zeros((len(polycoefs),1))
+    return polycoefs[:,:-1] * np.arange(degree, 0, -1)
+
+def build_inverse_table(polycoefs, lbdarange=None, lbdastep=None):
+    """ Evaluate the pixel<->wavelength polynomials on a dense wavelength grid
+    to be used as a monotonic lookup table for the pixels->wavelength conversion.
+
+    Parameters
+    ----------
+    polycoefs: [2d array]
+        (ntraces x degree+1) lbda->pixels polynomial coefficients
+        (decreasing powers, defined for lbda-REFWAVELENGTH).
+
+    lbdarange, lbdastep: [float, float] -optional-
+        wavelength range and wavelength step of the grid [in Angstrom].
+        If None INVERSE_LBDARANGE and INVERSE_LBDASTEP are used.
+
+    Returns
+    -------
+    dict ({"lbda": grid, "pixels": (ntraces x ngrid) increasing pixel values, "sign": ntraces})
+    (pixels are multiplied by `sign` such that they increase along the table)
+    """
+    if lbdarange is None:
+        lbdarange = INVERSE_LBDARANGE
+    if lbdastep is None:
+        lbdastep = INVERSE_LBDASTEP
+
+    lbda   = np.arange(lbdarange[0], lbdarange[1]+lbdastep, lbdastep)
+    pixels = polyval_horner(polycoefs, lbda-REFWAVELENGTH)
+    sign   = np.sign(pixels[:,-1]-pixels[:,0])
+    sign[sign==0] = 1
+    pixels *= sign[:,None]
+
+    flagnonmonotonic = np.any(np.diff(pixels, axis=1)<=0, axis=1)
+    if np.any(flagnonmonotonic):
+        warnings.warn("%d wavelength solution(s) are not monotonic within %s Angstrom. pixels->lbda is not reliable for these."%(
+            flagnonmonotonic.sum(), lbdarange))
+
+    return {"lbda":lbda, "pixels":pixels, "sign":sign}
+
+def polyinverse_array(polycoefs, pixels, inversetable, niter=3):
+    """ Convert pixels into wavelength for many wavelength solutions at once.
+
+    The first guess is a linear interpolation of the dense monotonic lookup table
+    (see build_inverse_table()). This is then refined by `niter` Newton-Raphson
+    iterations on the actual polynomials. On the default grid,
+    this is accurate to better than 1e-6 pixels.
+
+    Parameters
+    ----------
+    polycoefs: [2d array]
+        (ntraces x degree+1) lbda->pixels polynomial coefficients
+        (decreasing powers, defined for lbda-REFWAVELENGTH).
+
+    pixels: [float/array]
+        pixel(s) to be converted. Either 1d array (same for every traces)
+        or (ntraces x N) array.
+
+    inversetable: [dict]
+        output of build_inverse_table() for the same `polycoefs`.
+
+    niter: [int] -optional-
+        number of Newton-Raphson iterations.
+
+    Returns
+    -------
+    (ntraces x N) array (wavelength in Angstrom)
+    """
+    tpixels, sign = inversetable["pixels"], inversetable["sign"]
+    ntraces, ngrid = tpixels.shape
+    pixels = np.atleast_1d(np.asarray(pixels, dtype="float"))
+    if pixels.ndim == 1:
+        pixels = pixels[None,:]
+    pixels = np.broadcast_to(pixels, (ntraces, pixels.shape[-1]))
+
+    # - Batched lookup: each trace's table is shifted such that they are stacked
+    #   one after the other in a unique increasing array.
+    origin  = tpixels[:,:1]
+    spans   = tpixels[:,-1]-tpixels[:,0]
+    offsets = np.arange(ntraces)[:,None] * (np.nanmax(spans)+1)
+    flat    = (tpixels - origin + offsets).ravel()
+    query   = np.clip(sign[:,None]*pixels - origin, 0, spans[:,None]) + offsets
+
+    rows    = np.arange(ntraces)[:,None]*ngrid
+    index_  = np.clip(np.searchsorted(flat, query.ravel()).reshape(query.shape) - 1 - rows, 0, ngrid-2)
+    p0      = np.take_along_axis(tpixels, index_, axis=1)
+    p1      = np.take_along_axis(tpixels, index_+1, axis=1)
+    lbda0   = inversetable["lbda"][index_]
+    lbdastep= inversetable["lbda"][1]-inversetable["lbda"][0]
+    lbda    = lbda0 + lbdastep * (sign[:,None]*pixels-p0)/(p1-p0)
+
+    # - Newton Refinement
+    dercoefs = polyder_array(polycoefs)
+    for i in range(niter):
+        x = lbda-REFWAVELENGTH
+        lbda = lbda - (polyval_horner(polycoefs, x)-pixels) / polyval_horner(dercoefs, x)
+
+    return lbda
+
+
+def polyinverse_pairs(polycoefs, rows, pixels, inversetable, niter=3):
+    """ Element-wise version of polyinverse_array(): convert each pixel
+    with its own wavelength solution (polycoefs[rows]).
+    The (npixels x degree+1) coefficient array is never built.
+
+    Parameters
+    ----------
+    polycoefs: [2d array]
+        (ntraces x degree+1) lbda->pixels polynomial coefficients
+        
+    rows: [array of int]
+        row of polycoefs (and of the inversetable) for each pixel.
+
+    pixels: [array]
+        pixels to be converted (same size as rows)
+
+    inversetable: [dict]
+        output of build_inverse_table() for the same `polycoefs`.
+
+    niter: [int] -optional-
+        number of Newton-Raphson iterations.
+
+    Returns
+    -------
+    array (wavelength in Angstrom, same size as pixels)
+    """
+    tpixels, sign = inversetable["pixels"], inversetable["sign"]
+    ntraces, ngrid = tpixels.shape
+    rows   = np.asarray(rows, dtype="int")
+    pixels = np.asarray(pixels, dtype="float")
+
+    # - Lookup (stacked tables, see polyinverse_array)
+    origin  = tpixels[:,0]
+    spans   = tpixels[:,-1]-tpixels[:,0]
+    offsets = np.arange(ntraces) * (np.nanmax(spans)+1)
+    flat    = (tpixels - origin[:,None] + offsets[:,None]).ravel()
+    query   = np.clip(sign[rows]*pixels - origin[rows], 0, spans[rows]) + offsets[rows]
+    index_  = np.clip(np.searchsorted(flat, query) - 1 - rows*ngrid, 0, ngrid-2)
+    tflat   = np.asarray(tpixels).ravel()
+    p0, p1  = tflat[rows*ngrid+index_], tflat[rows*ngrid+index_+1]
+    lbdastep= inversetable["lbda"][1]-inversetable["lbda"][0]
+    lbda    = inversetable["lbda"][index_] + lbdastep * (sign[rows]*pixels-p0)/(p1-p0)
+
+    # - Newton Refinement
+    dercoefs = polyder_array(polycoefs)
+    for i in range(niter):
+        x = lbda-REFWAVELENGTH
+        value, derivative = polycoefs[rows,0], dercoefs[rows,0]
+        for coef in polycoefs.T[1:]:
+            value = value*x + coef[rows]
+        for coef in dercoefs.T[1:]:
+            derivative = derivative*x + coef[rows]
+        lbda = lbda - (value-pixels) / derivative
+
+    return lbda
 
 ###########################
 #                         #
@@ -388,10 +854,10 @@ class Flexure( BaseObject ):
     def _get_delta_i_(self, which="sodium", method="mean", as_slice=True):
         """ """
         mu_nad_eff, mu_nad_eff_err = self.get_line_position(which, method=method)
-        ijs_nad_eff = self.mapper.get_lbda_ij(mu_nad_eff)
-        ijs_nad_ref = self.mapper.get_lbda_ij(self.reference[which])
-        data_ = [ijs_nad_eff[traceindex][0]-ijs_nad_ref[traceindex][0]
-                    for traceindex in self.cube.indexes]
+        # - i of every traces at both wavelengths at once 
+        i_nad = self.mapper.get_lbda_ij([mu_nad_eff, self.reference[which]],
+                                         traceindexes=self.cube.indexes, as_dict=False)[0]
+        data_ = i_nad[:,0] - i_nad[:,1]
         
         if not as_slice:
             return {traceindex:d_ for traceindex,d_ in zip(self.cube.indexes, data_)}
@@ -466,15 +932,13 @@ class Flexure( BaseObject ):
             self.load_telluric_spec()
         
         flaglocal = (self.cube.lbda > TELLURIC_REF_LBDA-wavebuffer) & (self.cube.lbda < TELLURIC_REF_LBDA+wavebuffer)
-        fit_tell = []
-        for spec_ in self.spec_telluric:
-            fg = modefit.get_normpolyfit(spec_.lbda[flaglocal], spec_.data[flaglocal], spec_.data[flaglocal]/30, 2, 1)
-            fg.fit(sig0_guess=30, sig0_boundaries=[2,None],
-                       mu0_guess= self.reference["telluric"],
-                       mu0_boundaries= [self.reference["telluric"]-30, self.reference["telluric"]+30])
-            fit_tell.append(fg)
+        data = np.asarray([spec_.data[flaglocal] for spec_ in self.spec_telluric])
+        fitter = SkyLineBatchFitter(self.cube.lbda[flaglocal], data, data/30)
+        fitter.fit(sig0_guess=30, sig0_boundaries=[2,None],
+                   mu0_guess= self.reference["telluric"],
+                   mu0_boundaries= [self.reference["telluric"]-30, self.reference["telluric"]+30])
             
-        self._derived_properties["fit_telluric"] = fit_tell
+        self._derived_properties["fit_telluric"] = fitter.get_fitters()
     
     def load_sodium_fit(self, wavebuffer=300):
         """ """
@@ -482,15 +946,13 @@ class Flexure( BaseObject ):
             self.load_sodium_spec()
         
         flaglocal = (self.cube.lbda > SODIUM_SKYLINE_LBDA-wavebuffer) & (self.cube.lbda < SODIUM_SKYLINE_LBDA+wavebuffer)
-        fit_nad = []
-        for spec_ in self.spec_sodium:
-            fg = modefit.get_normpolyfit(spec_.lbda[flaglocal], spec_.data[flaglocal], spec_.data[flaglocal]/30, 2, 1)
-            fg.fit(sig0_guess=10, sig0_boundaries=[2,None],
-                       mu0_guess= self.reference["sodium"],
-                       mu0_boundaries= [self.reference["sodium"]-50, self.reference["sodium"]+50])
-            fit_nad.append(fg)
+        data = np.asarray([spec_.data[flaglocal] for spec_ in self.spec_sodium])
+        fitter = SkyLineBatchFitter(self.cube.lbda[flaglocal], data, data/30)
+        fitter.fit(sig0_guess=10, sig0_boundaries=[2,None],
+                   mu0_guess= self.reference["sodium"],
+                   mu0_boundaries= [self.reference["sodium"]-50, self.reference["sodium"]+50])
             
-        self._derived_properties["fit_sodium"] = fit_nad
+        self._derived_properties["fit_sodium"] = fitter.get_fitters()
         
     # --------- #
     #  SETTER   #
@@ -573,7 +1035,8 @@ class Flexure( BaseObject ):
 class WaveSolution( BaseObject ):
     """ """
     PROPERTIES = ["lamps"]
-    DERIVED_PROPERTIES = ["wavesolutions","solutions"]
+    DERIVED_PROPERTIES = ["wavesolutions","solutions",
+                          "polycoefs", "polyindexes", "inversetable"]
 
     # ================== #
     #  Main Methods      #
@@ -603,7 +1066,8 @@ class WaveSolution( BaseObject ):
     # BUILDER  #
     # -------- #
     def fit_wavelesolution(self, traceindex, sequential=True, contdegree=4, wavedegree=5,
-                            saveplot=None, show=False, plotprop={}):
+                            saveplot=None, show=False, plotprop={},
+                            hexagrid=None, method="modefit"):
         """ Fit the wavelength solution of the given trace.
 
         This matching is made in two steps:
@@ -634,19 +1098,29 @@ class WaveSolution( BaseObject ):
             
         show: [bool] -optional-
             Should the wavelength solution figure be shown?
-        
+
+        hexagrid: [HexagoneProjection] -optional-
+            If given, the line position guesses are based on the already solved
+            neighboring traces (see get_neighbors_line_guesses())
+
+        method: [string] -optional-
+            line fitter: modefit (~3s) or lsq (ArcLineFitter, analytic Jacobian)
+
         Returnsemus
         -------
         None
         """
          # <0.1s # with saved masks
         wsol_ = get_arccollection(traceindex, [self.lampccds[i] for i in self.lampnames])
-        # 3s 
-        wsol_.fit_lineposition(contdegree=contdegree, sequential=sequential)
+        line_guesses = None if hexagrid is None else \
+          get_neighbors_line_guesses(self.wavesolutions, traceindex, hexagrid, wsol_.databounds)
+        # 3s (modefit)
+        wsol_.fit_lineposition(contdegree=contdegree, sequential=sequential,
+                               line_guesses=line_guesses, method=method)
         # 0.01s
         wsol_.fit_wavelengthsolution(wavedegree, legendre=False)
         self.wavesolutions[traceindex] = wsol_.data
-
+        self._reset_polynomial_array_()
                                          
         self._wsol = wsol_
         if saveplot is not None or show:
@@ -666,22 +1140,231 @@ class WaveSolution( BaseObject ):
         return self._solution[traceindex]
 
     def _load_full_solutions_(self):
-        """ """
+        """ Loads the wavelength solution of every traces as a unique polynomial array
+        (see load_polynomial_array()) """
         for traceindex in self.wavesolutions.keys():
             if traceindex not in self._solution:
                 self._solution[traceindex] = SpaxelWaveSolution(self.wavesolutions[traceindex]["wavesolution"])
-                
-            self._solution[traceindex].load_pixel_to_lbda_solution()
-            
-    
+
+        self.load_polynomial_array()
+
+    def load_polynomial_array(self, lbdarange=None, lbdastep=None):
+        """ Stores the polynomial coefficients of all the traces as a unique
+        (ntraces x degree+1) array and build the associated pixels->lbda lookup table.
+
+        Parameters
+        ----------
+        lbdarange, lbdastep: [float, float] -optional-
+            wavelength range and step of the lookup table used to inverse
+            the wavelength solutions. (see build_inverse_table())
+
+        Returns
+        -------
+        Void
+        """
+        traceindexes = np.sort(self.traceindexes)
+        coefs  = [np.atleast_1d(self.wavesolutions[i_]["wavesolution"]) for i_ in traceindexes]
+        ncoefs = np.max([len(c_) for c_ in coefs])
+        # lower degree polynomials are padded with leading zeros
+        polycoefs = np.zeros((len(coefs), ncoefs))
+        for k, c_ in enumerate(coefs):
+            polycoefs[k, ncoefs-len(c_):] = c_
+
+        self._derived_properties["polycoefs"]    = polycoefs
+        self._derived_properties["polyindexes"]  = {i_:k for k,i_ in enumerate(traceindexes)}
+        self._derived_properties["inversetable"] = build_inverse_table(polycoefs, lbdarange=lbdarange, lbdastep=lbdastep)
+
+    def set_polynomial_array(self, polycoefs, traceindexes, inversetable):
+        """ Directly provide the polynomial array and its lookup table
+        (as built by load_polynomial_array()).
+        This is used when loading a night calibration bundle, the arrays possibly being memory-mapped.
+
+        Parameters
+        ----------
+        polycoefs: [(ntraces x degree+1) array]
+            polynomial coefficients (decreasing powers) of the traces.
+
+        traceindexes: [array]
+            traces corresponding to the polycoefs rows.
+
+        inversetable: [dict]
+            lookup table {"lbda","pixels","sign"} (see build_inverse_table())
+
+        Returns
+        -------
+        Void
+        """
+        self._derived_properties["polycoefs"]    = polycoefs
+        self._derived_properties["polyindexes"]  = {i_:k for k,i_ in enumerate(traceindexes)}
+        self._derived_properties["inversetable"] = inversetable
+
+    def _reset_polynomial_array_(self):
+        """ """
+        self._derived_properties["polycoefs"]    = None
+        self._derived_properties["polyindexes"]  = None
+        self._derived_properties["inversetable"] = None
+
+    def get_lbda_to_pixels(self, lbda, traceindexes=None):
+        """ Convert the wavelength(s) into pixels for many traces at once.
+
+        Parameters
+        ----------
+        lbda: [float/array]
+            Wavelength(s) in Angstrom. 1d array (same for every traces)
+            or (ntraces x N) array.
+
+        traceindexes: [list of int] -optional-
+            traces for which the conversion is made. If None, all (sorted).
+
+        Returns
+        -------
+        (ntraces x N) array
+        """
+        polycoefs = self._get_polycoefs_(traceindexes)
+        return polyval_horner(polycoefs, np.asarray(lbda, dtype="float")-REFWAVELENGTH)
+
+    def get_pixels_to_lbda(self, pixels, traceindexes=None, niter=3):
+        """ Convert pixel(s) into wavelength for many traces at once.
+        (see polyinverse_array())
+
+        Parameters
+        ----------
+        pixels: [float/array]
+            ccd-pixel(s). 1d array (same for every traces) or (ntraces x N) array.
+
+        traceindexes: [list of int] -optional-
+            traces for which the conversion is made. If None, all (sorted).
+
+        niter: [int] -optional-
+            number of Newton-Raphson iterations refining the lookup table interpolation.
+
+        Returns
+        -------
+        (ntraces x N) array (wavelength in Angstrom)
+        """
+        polycoefs = self._get_polycoefs_(traceindexes)
+        if traceindexes is None:
+            table = self._inversetable
+        else:
+            rows  = self._get_polyrows_(traceindexes)
+            table = {"lbda":self._inversetable["lbda"],
+                     "pixels":self._inversetable["pixels"][rows],
+                     "sign":self._inversetable["sign"][rows]}
+
+        return polyinverse_array(polycoefs, pixels, table, niter=niter)
+
+    def get_pixels_to_lbda_pairs(self, pixels, traceindexes, niter=3):
+        """ Convert each pixel into wavelength using the wavelength solution
+        of the corresponding trace (element-wise, see polyinverse_pairs()).
+
+        Parameters
+        ----------
+        pixels: [array]
+            ccd-pixels.
+
+        traceindexes: [array of int]
+            trace of each pixel (same size as pixels).
+
+        niter: [int] -optional-
+            number of Newton-Raphson iterations refining the lookup table interpolation.
+
+        Returns
+        -------
+        array (wavelength in Angstrom)
+        """
+        if self._polycoefs is None:
+            self.load_polynomial_array()
+        known = np.asarray(list(self._derived_properties["polyindexes"].keys()))
+        krows = np.asarray(list(self._derived_properties["polyindexes"].values()))
+        order = np.argsort(known)
+        pos   = np.clip(np.searchsorted(known[order], traceindexes), 0, len(known)-1)
+        if np.any(known[order][pos] != traceindexes):
+            raise ValueError("Unknown wavelength solution for some of the given traceindexes")
+        
+        return polyinverse_pairs(self._polycoefs, krows[order][pos], pixels, self._inversetable, niter=niter)
+
+    def _get_polyrows_(self, traceindexes):
+        """ row of the given traceindexes within the polynomial array """
+        if self._polycoefs is None:
+            self.load_polynomial_array()
+        try:
+            return np.asarray([self._derived_properties["polyindexes"][i_] for i_ in np.atleast_1d(traceindexes)], dtype="int")
+        except KeyError as e:
+            raise ValueError("Unknown wavelength solution for the spaxels #%s"%e)
+
+    def _get_polycoefs_(self, traceindexes=None):
+        """ """
+        if self._polycoefs is None:
+            self.load_polynomial_array()
+        if traceindexes is None:
+            return self._polycoefs
+        return self._polycoefs[self._get_polyrows_(traceindexes)]
+
     def pixels_to_lbda(self, pixel, traceindex):
-        """ Pick the requested spaxel and get the wavelength [in angstrom] that goes with the given pixel """
+        """ Pick the requested spaxel and get the wavelength [in angstrom] that goes with the given pixel.
+        If traceindex is a list, this returns a (ntraces x npixels) array (see get_pixels_to_lbda) """
+        if is_arraylike(traceindex):
+            return self.get_pixels_to_lbda(pixel, traceindex)
+        if self._polycoefs is not None:
+            lbda = self.get_pixels_to_lbda(pixel, [traceindex])[0]
+            return lbda if is_arraylike(pixel) else lbda[0]
+
         return self.get_spaxel_wavesolution(traceindex).pixels_to_lbda(pixel)
-    
+
     def lbda_to_pixels(self, lbda, traceindex):
-        """ Pick the requested spaxel and get the pixel that goes with the given wavelength [in angstrom] """
+        """ Pick the requested spaxel and get the pixel that goes with the given wavelength [in angstrom].
+        If traceindex is a list, this returns a (ntraces x nlbda) array (see get_lbda_to_pixels) """
+        if is_arraylike(traceindex):
+            return self.get_lbda_to_pixels(lbda, traceindex)
+
         return self.get_spaxel_wavesolution(traceindex).lbda_to_pixels(lbda)
-    
+
+    def get_wavesolution_rms(self, kind="wrms", traceindexes=None):
+        """ Residual of the wavelength solution fit of many traces at once.
+        (see SpaxelWaveSolution.get_wavesolution_rms())
+
+        Parameters
+        ----------
+        kind: [str] -optional-
+            Which statistic: std (or rms), nmad or wrms
+
+        traceindexes: [list of int] -optional-
+            traces for which the residuals are measured. If None, all (sorted).
+
+        Returns
+        -------
+        array (ntraces)
+        """
+        if traceindexes is None:
+            traceindexes = np.sort(self.traceindexes)
+
+        # - Padding the (various size) fitted lines
+        nlines    = np.max([len(self.wavesolutions[i_]["usedlines"]) for i_ in traceindexes])
+        usedlines = np.zeros((len(traceindexes), nlines))*np.NaN
+        linepos   = np.zeros((len(traceindexes), nlines))*np.NaN
+        lineerr   = np.zeros((len(traceindexes), nlines))*np.NaN
+        for k, i_ in enumerate(traceindexes):
+            n_ = len(self.wavesolutions[i_]["usedlines"])
+            usedlines[k,:n_] = self.wavesolutions[i_]["usedlines"]
+            linepos[k,:n_]   = self.wavesolutions[i_]["fit_linepos"]
+            lineerr[k,:n_]   = self.wavesolutions[i_]["fit_linepos.err"]
+
+        res = self.get_pixels_to_lbda(np.where(np.isnan(linepos), 0, linepos), traceindexes) - usedlines
+        known_kind = ["std or rms", "nmad", "wrms"]
+
+        if kind in ["std", "rms"]:
+            return np.nanstd(res, axis=1)
+        if kind in ['nMAD', 'nmad','mad_std']:
+            from astropy.stats import mad_std
+            return mad_std(res, axis=1, ignore_nan=True)
+        if kind in ["wrms", "wRMS"]:
+            flagnan = np.isnan(res)
+            res_    = np.where(flagnan, 0, res)
+            wmean   = np.sum(np.where(flagnan, 0, 1./lineerr**2)*res_, axis=1)/np.nansum(1./lineerr**2, axis=1)
+            weights = np.where(flagnan, 0, 1./lineerr*2)
+            return np.sqrt(np.sum((res_-wmean[:,None])**2*weights, axis=1)/np.sum(weights, axis=1))
+        raise ValueError("unknown kind %s."%kind+" use: "+", ".join(known_kind))
+
     # -------- #
     #  I/O     #
     # -------- #
@@ -699,6 +1382,7 @@ class WaveSolution( BaseObject ):
         
         self.wavesolutions[traceindex] = data
         self._solution[traceindex]     = SpaxelWaveSolution(data["wavesolution"], datafitted=[data["usedlines"], data["fit_linepos"], data['fit_linepos.err']])
+        self._reset_polynomial_array_()
         
 
         
@@ -728,8 +1412,8 @@ class WaveSolution( BaseObject ):
                             clabel=r"nMAD [$\AA$]", **kwargs):
         """ """
         from pysedm.sedm import display_on_hexagrid
-        traceindexes = list(self._solution.keys())
-        value = nmad = [self._solution[i].get_wavesolution_rms(kind="nMAD") for i in traceindexes]
+        traceindexes = np.sort(self.traceindexes)
+        value = nmad = self.get_wavesolution_rms(kind="nMAD", traceindexes=traceindexes)
         return display_on_hexagrid(value, traceindexes,hexagrid=hexagrid, 
                                        ax=ax, vmin=vmin, vmax=vmax,
                                        clabel=clabel, savefile=savefile, show=show,
@@ -741,14 +1425,11 @@ class WaveSolution( BaseObject ):
     def calc_dispersion_stats(self, savefile=None):
         """ Calculate disperson solution statistics """
 
-        traceindexes = list(self._solution.keys())
+        traceindexes = np.sort(self.traceindexes)
 
-        rms = [self._solution[i].get_wavesolution_rms(kind="rms")
-               for i in traceindexes]
-        mad = [self._solution[i].get_wavesolution_rms(kind="nmad")
-               for i in traceindexes]
-        wrms = [self._solution[i].get_wavesolution_rms(kind="wrms")
-                for i in traceindexes]
+        rms  = self.get_wavesolution_rms(kind="rms",  traceindexes=traceindexes)
+        mad  = self.get_wavesolution_rms(kind="nmad", traceindexes=traceindexes)
+        wrms = self.get_wavesolution_rms(kind="wrms", traceindexes=traceindexes)
         if savefile:
             stat_f = open(savefile, "w")
             stat_f.write("NSpax: %d\n" % len(rms))
@@ -798,6 +1479,18 @@ class WaveSolution( BaseObject ):
     def traceindexes(self):
         """ list of indexes having wavelengh solution loaded. """
         return list(self.wavesolutions.keys())
+
+    @property
+    def _polycoefs(self):
+        """ (ntraces x degree+1) polynomial coefficients (sorted traceindexes). see load_polynomial_array() """
+        return self._derived_properties["polycoefs"]
+
+    @property
+    def _inversetable(self):
+        """ pixels->lbda lookup table of the polynomial array. see load_polynomial_array() """
+        if self._derived_properties["inversetable"] is None:
+            self.load_polynomial_array()
+        return self._derived_properties["inversetable"]
     
 class SpaxelWaveSolution( BaseObject ):
     """ """
@@ -969,12 +1662,33 @@ class SpaxelWaveSolution( BaseObject ):
         """
         return self._wavesolution(wavelength-REFWAVELENGTH)
 
-    def load_pixel_to_lbda_solution(self):
-        """ """
-        if _HASPYNVERSE:
+    def load_pixel_to_lbda_solution(self, use_pynverse=False):
+        """ Loads the pixels->lbda function.
+
+        Parameters
+        ----------
+        use_pynverse: [bool] -optional-
+            If True, pynverse's inversefunc is used (numerical root-finding per point).
+            Otherwise, this interpolates a dense monotonic lookup table refined by
+            Newton-Raphson iterations (see polyinverse_array()).
+
+        Returns
+        -------
+        Void
+        """
+        if use_pynverse:
+            if not _HASPYNVERSE:
+                raise ImportError("You need pynverse | pip install pynverse")
             self._properties["inverse_wavesolution"] = inversefunc(self.lbda_to_pixels)
-        else:
-            raise ImportError("You need pynverse | pip install pynverse")
+            return
+
+        polycoefs    = np.atleast_2d(self.data)
+        inversetable = build_inverse_table(polycoefs)
+        def pixels_to_lbda(pixels):
+            lbda = polyinverse_array(polycoefs, np.ravel(pixels), inversetable)[0]
+            return lbda.reshape(np.shape(pixels)) if is_arraylike(pixels) else lbda[0]
+
+        self._properties["inverse_wavesolution"] = pixels_to_lbda
             
     @property
     def pixels_to_lbda(self):
@@ -1112,7 +1826,8 @@ class VirtualArcSpectrum( BaseObject ):
                              exclude_reddest_part=True,
                              red_buffer=30,
                              exclude_bluest_part=True,
-                             blue_buffer=30, line_to_skip=None
+                             blue_buffer=30, line_to_skip=None,
+                             line_guesses=None, method="modefit"
                               ):
         """ Fit gaussian profiles of expected arclamp emmisions.
         The list of fitted lines are given in `usedlines`.
@@ -1140,25 +1855,39 @@ class VirtualArcSpectrum( BaseObject ):
            How much redder than the reddest emission line should the fit conserve.
            This is ignored if *exclude_reddest_part* is False
 
+        line_guesses: [dict] -optional-
+            Expected pixel position of the lines {line: pixel}, e.g. from already
+            solved neighboring traces (see get_neighbors_line_guesses()).
+            These replace the LINES (+line_shift) guesses for the given lines.
+
+        method: [string] -optional-
+            Which fitter to use:
+            - modefit: modefit's get_normpolyfit (minuit)
+            - lsq: ArcLineFitter (scipy's least_squares with analytic Jacobian)
+
         Returns
         -------
         Void (sets linefitter)
         """
         from modefit import get_normpolyfit
+        if line_guesses is None:
+            line_guesses = {}
         
         # where to look at? (~1ms)
         flagin = (self.lbda>=self.databounds[0])  * (self.lbda<=self.databounds[1]) # 1ms
 
         # Building guess (~1ms)
         self._normguesses = {}
-        if line_shift is None:
+        if line_shift is not None:
+            lines_shift = line_shift
+        elif np.any([l not in line_guesses for l in self.usedlines]):
             lines_shift = self.get_line_shift()
             
         for i,l in enumerate(self.usedlines):
             self._normguesses["ampl%d_guess"%i]      = self.arclines[l]["ampl"]
             self._normguesses["ampl%d_boundaries"%i] = [self.arclines[l]["ampl"]*0.2, self.arclines[l]["ampl"]*3]
             
-            self._normguesses["mu%d_guess"%i]        = self.arclines[l]["mu"]+lines_shift
+            self._normguesses["mu%d_guess"%i]        = line_guesses[l] if l in line_guesses else self.arclines[l]["mu"]+lines_shift
             self._normguesses["mu%d_boundaries"%i]   = [self._normguesses["mu%d_guess"%i]-2, self._normguesses["mu%d_guess"%i]+2]
             
             self._normguesses["sig%d_guess"%i]       = 1.1 if (not "doublet" in self.arclines[l] or not self.arclines[l]["doublet"]) else 1.8
@@ -1180,16 +1909,24 @@ class VirtualArcSpectrum( BaseObject ):
         lbdas = self.lbda[flagin].copy()
         errors = self.errors[flagin]/norm if self.has_errors() else np.nanstd(self.flux[flagin])/norm/5.
         
-        self._derived_properties["linefitter"] = \
-          get_normpolyfit(lbdas,self.flux[flagin]/norm,
-                              errors,
-                              contdegree, ngauss=len(self.usedlines), legendre=True)
+        if method in ["lsq"]:
+            self._derived_properties["linefitter"] = \
+              ArcLineFitter(lbdas, self.flux[flagin]/norm, errors,
+                                contdegree, ngauss=len(self.usedlines))
+        elif method in ["modefit"]:
+            self._derived_properties["linefitter"] = \
+              get_normpolyfit(lbdas,self.flux[flagin]/norm,
+                                  errors,
+                                  contdegree, ngauss=len(self.usedlines), legendre=True)
+        else:
+            raise ValueError("unknown line fitting method %s (modefit or lsq)"%method)
 
     def fit_lineposition(self, contdegree=2, line_shift=None,
                              exclude_reddest_part=True,
                              red_buffer=30,
                              exclude_bluest_part=True,
-                             blue_buffer=30, line_to_skip=None
+                             blue_buffer=30, line_to_skip=None,
+                             line_guesses=None, method="modefit"
                              ):
         # VirtualArcSpectrum
         """ Fit gaussian profiles of expected arclamp emmisions.
@@ -1218,6 +1955,9 @@ class VirtualArcSpectrum( BaseObject ):
            How much redder than the reddest emission line should the fit conserve.
            This is ignored if *exclude_reddest_part* is False
 
+        line_guesses, method: -optional-
+            see _load_lineposition_()
+
         Returns
         -------
         Void (sets linefitter)
@@ -1229,7 +1969,8 @@ class VirtualArcSpectrum( BaseObject ):
                                          exclude_reddest_part=exclude_reddest_part,
                                          red_buffer=red_buffer,
                                          exclude_bluest_part=exclude_bluest_part,
-                                         blue_buffer=blue_buffer, line_to_skip=line_to_skip)
+                                         blue_buffer=blue_buffer, line_to_skip=line_to_skip,
+                                         line_guesses=line_guesses, method=method)
         # The actual fit ~4s
         self._normguesses["a0_guess"] = np.percentile(self.linefitter.data, 25)
 
@@ -1282,7 +2023,8 @@ class VirtualArcSpectrum( BaseObject ):
                 "usedlines": self.usedlines,
                 "fit_linepos":mus,"fit_linepos.err":emus,
                 "wavesolution": self.wavesolution.data if self.has_wavesolution() else None,
-                "line_fitvalues":fitvalue
+                "line_fitvalues":fitvalue,
+                "databounds": self.databounds
                     }
 
     def set_databounds(self, xmin, xmax):
@@ -1457,7 +2199,8 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
                              exclude_reddest_part=True,
                              red_buffer=30,
                              exclude_bluest_part=True,
-                             blue_buffer=30
+                             blue_buffer=30,
+                             line_guesses=None, method="modefit"
                              ):
         # ArcSpectrumCollection
         """ Fit gaussian profiles of expected arclamp emmisions.
@@ -1489,6 +2232,14 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
            How much redder than the reddest emission line should the fit conserve.
            This is ignored if *exclude_reddest_part* is False
 
+        line_guesses: [dict] -optional-
+            Expected pixel position of the lines {line: pixel} (any lamp),
+            see get_neighbors_line_guesses().
+
+        method: [string] -optional-
+            line fitter: modefit or lsq (see ArcLineFitter).
+            All the lines of a lamp are fitted jointly.
+
         Returns
         -------
         Void (sets linefitter)
@@ -1499,7 +2250,8 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
                         exclude_reddest_part=exclude_reddest_part,
                         red_buffer=red_buffer,
                         exclude_bluest_part=exclude_bluest_part,
-                        blue_buffer=blue_buffer)
+                        blue_buffer=blue_buffer,
+                        line_guesses=line_guesses, method=method)
         
         if not sequential:
             super(ArcSpectrumCollection, self).fit_lineposition(**lineprop )
@@ -1782,3 +2534,420 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
 
 
     
+
+###########################
+#                         #
+#  Fast Arc Line Fitter   #
+#                         #
+###########################
+class ArcLineFitter( BaseObject ):
+    """ Gaussian lines + Legendre polynomial continuum least-squares fitter.
+
+    This is the model of modefit's get_normpolyfit(legendre=True) (same parameter names,
+    same `fitvalues` structure) but solved with scipy's least_squares (trust region
+    reflective, i.e. handles boundaries) using the analytic Jacobian of the model.
+    """
+    PROPERTIES         = ["xdata", "data", "errors", "contdegree", "ngauss"]
+    DERIVED_PROPERTIES = ["fitvalues", "param_input", "xscaled", "parameters"]
+
+    def __init__(self, x, y, dy, contdegree, ngauss):
+        """ """
+        self.__build__()
+        self._properties["xdata"]      = np.asarray(x, dtype="float")
+        self._properties["data"]       = np.asarray(y, dtype="float")
+        self._properties["errors"]     = np.ones(len(self.xdata))*dy
+        self._properties["contdegree"] = contdegree
+        self._properties["ngauss"]     = ngauss
+        # - as modefit: Legendre continuum on x scaled within [-1,1]
+        self._derived_properties["xscaled"] = (self.xdata-np.min(self.xdata))/(np.max(self.xdata)-np.min(self.xdata))*2-1.
+
+    # ================ #
+    #  Main Methods    #
+    # ================ #
+    def get_model(self, parameters=None, x=None):
+        """ continuum + gaussian lines for the given parameters (FREEPARAMETERS order) """
+        if parameters is None:
+            parameters = self._parameters
+        if x is None:
+            x, xscaled = self.xdata, self._xscaled
+        else:
+            x = np.asarray(x, dtype="float")
+            xscaled = (x-np.min(self.xdata))/(np.max(self.xdata)-np.min(self.xdata))*2-1.
+
+        cont, mu, sig, ampl = self._split_parameters_(parameters)
+        from numpy.polynomial import legendre
+        gauss = np.exp(-0.5*((x[:,None]-mu)/sig)**2)/(np.sqrt(2*np.pi)*sig)*ampl
+        return legendre.legval(xscaled, cont) + np.sum(gauss, axis=1)
+
+    def get_jacobian(self, parameters):
+        """ analytic Jacobian of the model (npoints x nparameters) """
+        from numpy.polynomial import legendre
+        cont, mu, sig, ampl = self._split_parameters_(parameters)
+        dx    = self.xdata[:,None]-mu
+        pdf   = np.exp(-0.5*(dx/sig)**2)/(np.sqrt(2*np.pi)*sig)
+        gauss = pdf*ampl
+        return np.concatenate([legendre.legvander(self._xscaled, self.contdegree-1),
+                               gauss*dx/sig**2,               # d/dmu
+                               gauss*(dx**2/sig**3 - 1./sig), # d/dsig
+                               pdf], axis=1)                  # d/dampl
+
+    def fit(self, **kwargs):
+        """ Fit the model. kwargs follow modefit's convention:
+        `NAME_guess`, `NAME_boundaries` ([min,max], None for no limit) and `NAME_fixed`
+        with NAME any of FREEPARAMETERS.
+        """
+        from scipy.optimize import least_squares
+        self._derived_properties["param_input"] = kwargs
+        guess, lower, upper, fixed = [], [], [], []
+        for name in self.FREEPARAMETERS:
+            bounds_ = kwargs.get("%s_boundaries"%name, None)
+            lo, hi  = [-np.inf, np.inf] if bounds_ is None else \
+              [-np.inf if bounds_[0] is None else float(np.ravel(bounds_[0])[0]),
+                np.inf if bounds_[1] is None else float(np.ravel(bounds_[1])[0])]
+            guess.append(float(np.ravel(kwargs.get("%s_guess"%name, 1. if "sig" in name else 0.))[0]))
+            lower.append(lo); upper.append(hi)
+            fixed.append(kwargs.get("%s_fixed"%name, False))
+
+        guess, lower, upper, fixed = [np.asarray(a_) for a_ in [guess, lower, upper, fixed]]
+        free = ~fixed
+        # least_squares needs the guess strictly within the boundaries
+        eps   = 1e-8*np.maximum(np.abs(guess), 1)
+        guess = np.where(guess<=lower, lower+eps, np.where(guess>=upper, upper-eps, guess))
+
+        weights = 1./self.errors
+        def _residuals_(p_):
+            param = guess.copy()
+            param[free] = p_
+            return (self.get_model(param)-self.data)*weights
+
+        def _jacobian_(p_):
+            param = guess.copy()
+            param[free] = p_
+            return self.get_jacobian(param)[:,free]*weights[:,None]
+
+        res = least_squares(_residuals_, guess[free], jac=_jacobian_,
+                            bounds=(lower[free], upper[free]), method="trf", x_scale="jac")
+
+        # - Output, modefit format
+        parameters = guess.copy()
+        parameters[free] = res.x
+        errors = np.zeros(len(parameters))
+        try:
+            errors[free] = np.sqrt(np.abs(np.diag(np.linalg.inv(np.dot(res.jac.T, res.jac)))))
+        except np.linalg.LinAlgError:
+            errors[free] = np.NaN
+
+        self._set_fit_output_(parameters, errors, np.sum(res.fun**2))
+
+    def show(self, savefile=None, show=True, ax=None, show_gaussian=False,
+                 modelcolor="k", modellw=2, ecolor=None, **kwargs):
+        """ """
+        from astrobject.utils.mpladdon import figout
+        if ax is None:
+            fig = mpl.figure(figsize=[8,5])
+            ax = fig.add_axes([0.1,0.1,0.8,0.8])
+        else:
+            fig = ax.figure
+
+        prop = dict(color="0.5")
+        prop.update(kwargs)
+        ax.plot(self.xdata, self.data, **prop)
+        if ecolor is not None:
+            ax.fill_between(self.xdata, self.data-np.abs(self.errors), self.data+np.abs(self.errors),
+                            color=ecolor, alpha=prop.get("alpha",1)*0.5, lw=0)
+        if self.has_fit_run():
+            ax.plot(self.xdata, self.get_model(), color=modelcolor, lw=modellw,
+                        scalex=False, scaley=False)
+            if show_gaussian:
+                from numpy.polynomial import legendre
+                cont, mu, sig, ampl = self._split_parameters_(self._parameters)
+                continuum = legendre.legval(self._xscaled, cont)
+                for mu_, sig_, ampl_ in zip(mu, sig, ampl):
+                    gauss_ = np.exp(-0.5*((self.xdata-mu_)/sig_)**2)/(np.sqrt(2*np.pi)*sig_)*ampl_
+                    ax.plot(self.xdata, continuum+gauss_, ls="-", lw=modellw/2., alpha=0.5,
+                            color=modelcolor, scalex=False, scaley=False)
+
+        fig.figout(savefile=savefile, show=show)
+        return {"ax":ax, "figure":fig}
+
+    def has_fit_run(self):
+        """ """
+        return len(self.fitvalues) > 0
+
+    # - internal
+    def _set_fit_output_(self, parameters, errors, chi2):
+        """ store the best fitted parameters in the modefit `fitvalues` format """
+        self._derived_properties["parameters"] = np.asarray(parameters, dtype="float")
+        self._derived_properties["fitvalues"]  = {}
+        for name, v_, e_ in zip(self.FREEPARAMETERS, parameters, errors):
+            self.fitvalues[name]        = v_
+            self.fitvalues[name+".err"] = e_
+        self.fitvalues["chi2"] = chi2
+
+    def _split_parameters_(self, parameters):
+        """ continuum, mu, sig and ampl parameters """
+        parameters = np.asarray(parameters, dtype="float")
+        cont, gauss = parameters[:self.contdegree], parameters[self.contdegree:]
+        return cont, gauss[:self.ngauss], gauss[self.ngauss:2*self.ngauss], gauss[2*self.ngauss:]
+
+    # ================ #
+    #  Properties      #
+    # ================ #
+    @property
+    def FREEPARAMETERS(self):
+        """ name of the parameters (modefit convention) """
+        return ["a%d"%i for i in range(self.contdegree)] + ["mu%d"%i for i in range(self.ngauss)] +\
+          ["sig%d"%i for i in range(self.ngauss)] + ["ampl%d"%i for i in range(self.ngauss)]
+
+    @property
+    def xdata(self):
+        """ """
+        return self._properties["xdata"]
+
+    @property
+    def data(self):
+        """ """
+        return self._properties["data"]
+
+    @property
+    def errors(self):
+        """ """
+        return self._properties["errors"]
+
+    @property
+    def contdegree(self):
+        """ number of Legendre polynomials of the continuum (modefit convention) """
+        return self._properties["contdegree"]
+
+    @property
+    def ngauss(self):
+        """ number of gaussian lines """
+        return self._properties["ngauss"]
+
+    @property
+    def fitvalues(self):
+        """ dictionary containing the best-fitted values """
+        if self._derived_properties["fitvalues"] is None:
+            self._derived_properties["fitvalues"] = {}
+        return self._derived_properties["fitvalues"]
+
+    @property
+    def param_input(self):
+        """ dictionary of the fit input (guesses, boundaries) """
+        return self._derived_properties["param_input"]
+
+    @property
+    def _parameters(self):
+        """ """
+        return self._derived_properties["parameters"]
+
+    @property
+    def _xscaled(self):
+        """ """
+        return self._derived_properties["xscaled"]
+
+
+class SkyLineBatchFitter( BaseObject ):
+    """ One gaussian line + linear continuum fitted simultaneously on a stack of spectra.
+
+    All the spectra share the same wavelength sampling. The model and parameter names are
+    those of ArcLineFitter(contdegree=2, ngauss=1), i.e. [a0, a1, mu0, sig0, ampl0] with a
+    Legendre continuum on the wavelength scaled within [-1,1]. The fit is a projected
+    Levenberg-Marquardt made on all the spectra at once (batched normal equations with the
+    analytic Jacobian) with boundaries on mu0 and sig0.
+    """
+    PROPERTIES         = ["xdata", "data", "errors"]
+    DERIVED_PROPERTIES = ["xscaled", "parameters", "parameter_errors", "chi2", "param_input"]
+
+    FREEPARAMETERS = ["a0", "a1", "mu0", "sig0", "ampl0"]
+
+    def __init__(self, x, y, dy):
+        """ 
+        Parameters
+        ----------
+        x: [array]
+            wavelength sampling (npoints)
+
+        y, dy: [2d-array]
+            stacked spectra and their errors (nspectra x npoints)
+        """
+        self.__build__()
+        self._properties["xdata"]  = np.asarray(x, dtype="float")
+        self._properties["data"]   = np.atleast_2d(np.asarray(y, dtype="float"))
+        self._properties["errors"] = np.ones(self.data.shape)*dy
+        self._derived_properties["xscaled"] = (self.xdata-np.min(self.xdata))/(np.max(self.xdata)-np.min(self.xdata))*2-1.
+
+    # ================ #
+    #  Main Methods    #
+    # ================ #
+    def get_model(self, parameters=None):
+        """ model of every spectra (nspectra x npoints) for the given (nspectra x 5) parameters """
+        if parameters is None:
+            parameters = self.parameters
+        a0, a1, mu, sig, ampl = np.asarray(parameters, dtype="float").T[:,:,None]
+        gauss = np.exp(-0.5*((self.xdata-mu)/sig)**2)/(np.sqrt(2*np.pi)*sig)*ampl
+        return a0 + a1*self._xscaled + gauss
+
+    def get_jacobian(self, parameters):
+        """ analytic Jacobian of the model (nspectra x npoints x 5) """
+        a0, a1, mu, sig, ampl = np.asarray(parameters, dtype="float").T[:,:,None]
+        dx    = self.xdata-mu
+        pdf   = np.exp(-0.5*(dx/sig)**2)/(np.sqrt(2*np.pi)*sig)
+        gauss = pdf*ampl
+        return np.stack([np.ones(dx.shape), np.ones(dx.shape)*self._xscaled,
+                         gauss*dx/sig**2,               # d/dmu
+                         gauss*(dx**2/sig**3 - 1./sig), # d/dsig
+                         pdf], axis=-1)                 # d/dampl
+
+    def get_initial_guess(self, mu0_guess, sig0_guess):
+        """ parameters (nspectra x 5) to start the fit from.
+        The continuum is fitted outside mu0_guess +/- 3 sig0_guess and the amplitude is the
+        integral of the continuum subtracted data within it.
+        """
+        mu0_guess = np.ones(self.nspectra)*mu0_guess
+        inline    = np.abs(self.xdata[None,:]-mu0_guess[:,None]) < 3*sig0_guess
+        # - continuum, one weighted linear least-squares per spectrum
+        w_   = np.where(inline, 0, 1./self.errors**2)
+        vand = np.stack([np.ones(len(self.xdata)), self._xscaled], axis=-1)
+        ata  = np.einsum("kn,ni,nj->kij", w_, vand, vand)
+        aty  = np.einsum("kn,ni,kn->ki", w_, vand, self.data)
+        cont = np.linalg.solve(ata, aty[...,None])[...,0]
+        # - line flux
+        residual = np.where(inline, self.data-np.dot(cont, vand.T), 0)
+        ampl = np.trapz(residual, self.xdata, axis=1)
+        return np.stack([cont[:,0], cont[:,1], mu0_guess,
+                        np.ones(self.nspectra)*sig0_guess, ampl], axis=-1)
+
+    def fit(self, mu0_guess, sig0_guess, mu0_boundaries=None, sig0_boundaries=None,
+                niter=50, tol=1e-8, lmlambda=1e-3):
+        """ Fit all the spectra.
+
+        Parameters
+        ----------
+        mu0_guess, sig0_guess: [float or array]
+            initial line centroid and dispersion (one value or one per spectrum)
+
+        mu0_boundaries, sig0_boundaries: [None or [min,max]] -optional-
+            boundaries of the line centroid and dispersion (None for no limit)
+
+        niter: [int] -optional-
+            maximum number of Levenberg-Marquardt iterations.
+
+        tol: [float] -optional-
+            a spectrum has converged once its chi2 relative improvement is below tol.
+
+        lmlambda: [float] -optional-
+            initial Levenberg-Marquardt damping.
+
+        Returns
+        -------
+        Void (see parameters, parameter_errors, chi2 or get_fitters())
+        """
+        self._derived_properties["param_input"] = dict(mu0_guess=mu0_guess, sig0_guess=sig0_guess,
+                                                       mu0_boundaries=mu0_boundaries,
+                                                       sig0_boundaries=sig0_boundaries)
+        lower, upper = np.full(5, -np.inf), np.full(5, np.inf)
+        for i_, bounds_ in [[2, mu0_boundaries], [3, sig0_boundaries]]:
+            if bounds_ is None: continue
+            if bounds_[0] is not None: lower[i_] = bounds_[0]
+            if bounds_[1] is not None: upper[i_] = bounds_[1]
+
+        params  = np.clip(self.get_initial_guess(mu0_guess, sig0_guess), lower, upper)
+        weights = 1./self.errors
+        res     = (self.get_model(params)-self.data)*weights
+        chi2    = np.sum(res**2, axis=1)
+        lambda_ = np.full(self.nspectra, float(lmlambda))
+        active  = np.isfinite(chi2)
+        for i in range(niter):
+            jac = self.get_jacobian(params[active])*weights[active][...,None]
+            jtj = np.einsum("kni,knj->kij", jac, jac)
+            jtr = np.einsum("kni,kn->ki", jac, res[active])
+            diag_ = np.einsum("kii->ki", jtj)
+            damped = jtj + (lambda_[active,None]*diag_)[...,None]*np.eye(5)
+            try:
+                step = -np.linalg.solve(damped, jtr[...,None])[...,0]
+            except np.linalg.LinAlgError:
+                step = -np.einsum("kij,kj->ki", np.linalg.pinv(damped), jtr)
+
+            newparams = np.clip(params[active]+step, lower, upper)
+            newres    = (self.get_model(newparams)-self.data[active])*weights[active]
+            newchi2   = np.sum(newres**2, axis=1)
+            better    = newchi2 < chi2[active]
+            # - update the improved spectra
+            idx  = np.argwhere(active)[:,0]
+            ibetter = idx[better]
+            converged = np.zeros(self.nspectra, dtype="bool")
+            converged[ibetter] = (chi2[ibetter]-newchi2[better]) <= tol*chi2[ibetter]
+            params[ibetter] = newparams[better]
+            res[ibetter]    = newres[better]
+            chi2[ibetter]   = newchi2[better]
+            lambda_[idx]    = np.where(better, lambda_[idx]/10., lambda_[idx]*10.)
+            active &= ~converged & (lambda_ < 1e10)
+            if not np.any(active):
+                break
+
+        # - Output, modefit format
+        jac = self.get_jacobian(params)*weights[...,None]
+        cov = np.linalg.pinv(np.einsum("kni,knj->kij", jac, jac))
+        self._derived_properties["parameters"]       = params
+        self._derived_properties["parameter_errors"] = np.sqrt(np.abs(np.einsum("kii->ki", cov)))
+        self._derived_properties["chi2"]             = chi2
+
+    def get_fitters(self):
+        """ list of ArcLineFitter (one per spectrum) holding the fit results.
+        They have the modefit `fitvalues` dictionary and the show() method. """
+        fitters = []
+        for i in range(self.nspectra):
+            fitter_ = ArcLineFitter(self.xdata, self.data[i], self.errors[i], 2, 1)
+            fitter_._set_fit_output_(self.parameters[i], self.parameter_errors[i], self.chi2[i])
+            fitter_._derived_properties["param_input"] = self.param_input
+            fitters.append(fitter_)
+        return fitters
+
+    # ================ #
+    #  Properties      #
+    # ================ #
+    @property
+    def xdata(self):
+        """ """
+        return self._properties["xdata"]
+
+    @property
+    def data(self):
+        """ """
+        return self._properties["data"]
+
+    @property
+    def errors(self):
+        """ """
+        return self._properties["errors"]
+
+    @property
+    def nspectra(self):
+        """ number of spectra fitted simultaneously """
+        return len(self.data)
+
+    @property
+    def parameters(self):
+        """ best fitted parameters (nspectra x 5, FREEPARAMETERS order) """
+        return self._derived_properties["parameters"]
+
+    @property
+    def parameter_errors(self):
+        """ errors on the best fitted parameters (nspectra x 5) """
+        return self._derived_properties["parameter_errors"]
+
+    @property
+    def chi2(self):
+        """ chi2 of the fit of each spectrum """
+        return self._derived_properties["chi2"]
+
+    @property
+    def param_input(self):
+        """ dictionary of the fit input (guesses, boundaries) """
+        return self._derived_properties["param_input"]
+
+    @property
+    def _xscaled(self):
+        """ """
+        return self._derived_properties["xscaled"]
@@ -74,7 +74,8 @@ if __name__ == "__main__":
                    "bin/derive_wavesolution.py",
                    "bin/quality_check.py",
                    "bin/build_guider.py",
-                   "bin/rm_cubecr.py"],
+                   "bin/rm_cubecr.py",
+                   "bin/pysedm_bench.py"],
           packages=packages,
           include_package_data=True,
           package_data={'pysedm': ['data/*.*']},
@@ -0,0 +1,18 @@
+""" Tests of the ccd background image (pysedm.background.Background) """
+
+import numpy as np
+
+from pysedm import background
+
+
+def test_build_non_square_shape():
+    """ build(width, height) gives a (nrows, ncolumns) = (height, width) image """
+    contvalues = {i: {"a%d"%d: 10.+i if d==0 else 0. for d in range(background.DEGREE)}
+                  for i in range(0, 40, 10)}
+    back = background.get_background(contvalues, size=[30, 20])
+    assert back.shape == (20, 30)
+    image = back.get_background()
+    assert image.shape == (20, 30)
+    # the input columns go along the ccd-x axis
+    assert np.all(np.diff(image[10]) > 0)
+    np.testing.assert_allclose(back.get_background(rows=slice(2, 5), columns=slice(7, 9)), image[2:5, 7:9])
@@ -0,0 +1,48 @@
+""" Tests of the guider image stacking (pysedm.rainbowcam.stack_images) """
+
+import numpy as np
+from astropy.io import fits
+
+from pysedm import rainbowcam
+
+
+def _write_frames_(tmp_path, frames, dtype):
+    """ write the frames as fits files of the given dtype (astropy sets BZERO for unsigned ints) """
+    files = []
+    for i, frame in enumerate(frames):
+        filename = str(tmp_path / ("rc%d.fits"%i))
+        fits.PrimaryHDU(frame.astype(dtype)).writeto(filename)
+        files.append(filename)
+    return files
+
+
+def test_stack_uint16_bzero_frames(tmp_path):
+    """ uint16 frames are stored as int16 + BZERO=32768: they must stack as the baseline getdata did """
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(30000, 60000, size=(40, 30)) for i in range(5)]
+    files = _write_frames_(tmp_path, frames, "uint16")
+    assert fits.getheader(files[0])["BZERO"] == 32768
+
+    for method in ["median", "clipmean"]:
+        # small memory budget: several chunks of rows
+        stacked, nframes, avscale = rainbowcam.stack_images(files, method=method, memory_budget=0.01)
+        datas = [fits.getdata(f_).astype("float") for f_ in files]
+        scales = np.asarray([np.median(d_[::4, ::4]) for d_ in datas])
+        expected = np.median([d_/s_ for d_, s_ in zip(datas, scales)], axis=0)*np.mean(scales)
+        assert nframes == 5
+        np.testing.assert_allclose(avscale, np.mean(scales))
+        if method == "median":
+            np.testing.assert_allclose(stacked, expected)
+        else:
+            assert np.all(np.isfinite(stacked))
+            assert stacked.min() > 30000 and stacked.max() < 60000
+
+
+def test_stack_float_frames_threads(tmp_path):
+    """ float frames, no scaling, with threads """
+    rng = np.random.default_rng(2)
+    frames = [rng.normal(100, 5, size=(25, 20)) for i in range(3)]
+    files = _write_frames_(tmp_path, frames, "float32")
+    stacked, nframes, avscale = rainbowcam.stack_images(files, scale=None, memory_budget=0.005, nworkers=2)
+    np.testing.assert_allclose(stacked, np.median(np.asarray(frames, dtype="float32"), axis=0), rtol=1e-6)
+    assert avscale == 1
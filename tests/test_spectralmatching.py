@@ -0,0 +1,46 @@
+""" Tests of the trace polygon rasterization (pysedm.spectralmatching). """
+
+import numpy as np
+import pytest
+
+pytest.importorskip("shapely")
+from pysedm import spectralmatching
+from pysedm.sedm import SEDM_CCD_SIZE
+
+
+def _trace_vertices_(x_start, y_start, length=240, slope=0.03, width=1.5):
+    """ SEDM-like trace polygon: a slightly tilted band around a line. """
+    x = np.linspace(x_start, x_start+length, 5)
+    y = y_start + slope*(x-x_start) + 2e-5*(x-x_start)**2
+    return np.concatenate([np.asarray([x, y-width]).T,
+                           np.asarray([x[::-1], y[::-1]+width]).T])
+
+@pytest.fixture(scope="module")
+def traces():
+    rng = np.random.default_rng(20)
+    vertices = [_trace_vertices_(x_, y_, slope=s_, width=w_)
+                for x_, y_, s_, w_ in zip(rng.uniform(10, 1790, 30), rng.uniform(10, 2030, 30),
+                                          rng.uniform(-0.1, 0.1, 30), rng.uniform(1, 3, 30))]
+    # traces touching the first and last ccd columns.
+    vertices.append(_trace_vertices_(0.2, 1000.3))
+    vertices.append(_trace_vertices_(2046.4-240, 700.8, slope=-0.05))
+    return vertices
+
+def test_polygons_to_weights_matches_shapely(traces):
+    """ the numpy rasterizer must match the shapely pixel intersection areas,
+    whatever the batching of the polygons """
+    rasters = [spectralmatching.polygons_to_weights(traces, shape=SEDM_CCD_SIZE[::-1], batchsize=batchsize)
+               for batchsize in [200, 7]]
+    for k, verts in enumerate(traces):
+        expected = spectralmatching.verts_to_mask(verts, use_shapely=True)
+        for polygons, j, i, weights in rasters:
+            mask = np.zeros(SEDM_CCD_SIZE[::-1])
+            flag = polygons == k
+            mask[j[flag], i[flag]] = weights[flag]
+            np.testing.assert_allclose(mask, expected, atol=1e-8)
+
+def test_verts_to_mask_edge_trace(traces):
+    """ the trace at the ccd edge covers the first column, nothing is lost """
+    mask = spectralmatching.verts_to_mask(traces[-2], use_shapely=False)
+    assert mask[:, 0].sum() > 0
+    np.testing.assert_allclose(mask.sum(), spectralmatching.verts_to_mask(traces[-2], use_shapely=True).sum())